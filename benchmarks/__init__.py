@@ -0,0 +1,35 @@
+"""
+Benchmarks, run from the repository root as modules, e.g. python -m benchmarks.search_latency --help
+
+Blackbook modules read current_app.config when they are imported, so the benchmarks run in the tests'
+application context, and against their couchstub server where they need a CouchDB.
+"""
+from tests import app
+from tests import server
+
+__author__ = 'ievans3024'
+
+
+def percentiles(timings, points=(50, 90, 99)):
+    """
+    Get percentiles of some timings, nearest rank.
+    :param timings: The timings, in seconds
+    :param points: The percentiles to get
+    :returns: dict percentile -> timing, with "max" for the slowest
+    """
+    timings = sorted(timings)
+    result = {point: timings[max(0, -(-len(timings) * point // 100) - 1)] for point in points}
+    result["max"] = timings[-1]
+    return result
+
+
+def format_timings(timings):
+    """
+    Format the percentiles of some timings in milliseconds, e.g. "p50 1.20ms  p90 ...".
+    :param timings: The timings, in seconds
+    :returns: str
+    """
+    return "  ".join(
+        "{name} {ms:.2f}ms".format(name=point if point == "max" else "p" + str(point), ms=timing * 1000)
+        for point, timing in percentiles(timings).items()
+    )
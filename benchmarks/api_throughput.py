@@ -0,0 +1,147 @@
+"""
+Requests per second through the contact API, with the couch backend and the asyncio one.
+
+Each backend's blueprint is served by a threaded werkzeug server, and --clients client threads make requests
+to it at once for --duration seconds. Each client is authenticated as a user of its own, and asks in turn for the
+first page of its contacts, the same page through /api/user/<id>/contacts/, and one of those contacts. Both
+backends read the same database on the couchstub stand-in server, which takes --latency seconds for every
+request, like a round trip to a real CouchDB would.
+
+    python -m benchmarks.api_throughput --clients 50 --latency 0.005
+"""
+import argparse
+import collections
+import http.client
+import logging
+import threading
+import time
+import uuid
+
+import blackbook.database.aiocouch.api
+import blackbook.database.aiocouch.database
+import blackbook.database.couch.api
+import blackbook.database.couch.database
+import werkzeug.serving
+
+from benchmarks import app
+from benchmarks import format_timings
+from benchmarks import server
+from flask import Flask
+from tests import user_docs
+from tests.test_couch_api import session_doc
+
+__author__ = 'ievans3024'
+
+
+def serve(database, contact_api):
+    """
+    Serve the api blueprint for a database on a threaded werkzeug server, in a background thread.
+    :returns: tuple (the Flask app, the server)
+    """
+    flask_app = Flask('blackbook')
+    flask_app.config.update(app.config)
+    flask_app.register_blueprint(
+        blackbook.database.couch.api.init_api(flask_app, database=database, contact_api=contact_api)
+    )
+    http_server = werkzeug.serving.make_server('127.0.0.1', 0, flask_app, threaded=True)
+    # not a line per request
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    return flask_app, http_server
+
+
+def run_clients(flask_app, http_server, tokens, duration):
+    """
+    Make requests to a server from a client thread per session token, for a while.
+    :returns: tuple (seconds taken, list of the time each request took, Counter of response statuses)
+    """
+    timings = []
+    statuses = collections.Counter()
+    paths = ('/api/contact/', '/api/user/{user}/contacts/', '/api/contact/{user}-c{n}/')
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    start = threading.Barrier(len(tokens) + 1)
+    stop = threading.Event()
+
+    def client(user_id, token):
+        headers = {'Cookie': '{name}={value}'.format(
+            name=flask_app.config['SESSION_COOKIE_NAME'], value=serializer.dumps({'id': token})
+        )}
+        connection = http.client.HTTPConnection('127.0.0.1', http_server.server_port)
+        start.wait()
+        n = 0
+        while not stop.is_set():
+            path = paths[n % len(paths)].format(user=user_id, n=n % 5)
+            started = time.perf_counter()
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            timings.append(time.perf_counter() - started)
+            statuses[response.status] += 1
+            n += 1
+        connection.close()
+
+    workers = [threading.Thread(target=client, args=item) for item in tokens.items()]
+    for worker in workers:
+        worker.start()
+    start.wait()
+    started = time.perf_counter()
+    time.sleep(duration)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started, timings, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=50, help="client threads making requests at once")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to make requests for")
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds the server takes per request")
+    parser.add_argument("--max-connections", type=int, default=50, help="couch connections per backend")
+    args = parser.parse_args()
+
+    app.config.update(
+        COUCHDB_NAME="benchmark-" + uuid.uuid4().hex,
+        COUCHDB_MAX_CONNECTIONS=args.max_connections,
+        API_PAGINATION_PER_PAGE=10
+    )
+    couch_db = blackbook.database.couch.database.CouchDatabase()
+    async_db = blackbook.database.aiocouch.database.AsyncCouchDatabase()
+    backends = [
+        ("couch", couch_db, blackbook.database.couch.api.Contact),
+        ("aiocouch", async_db, blackbook.database.aiocouch.api.Contact)
+    ]
+    # sessions of their own for each backend, so neither starts with the other's cached
+    users = ["u{n}".format(n=n) for n in range(args.clients)]
+    sessions = {name: {user_id: uuid.uuid4().hex for user_id in users} for name, db, api in backends}
+    for user_id in users:
+        couch_db.db.update(
+            user_docs(user_id, contacts=5) + [session_doc(user_id, tokens[user_id]) for tokens in sessions.values()]
+        )
+
+    server.latency = args.latency
+    try:
+        for name, database, contact_api in backends:
+            flask_app, http_server = serve(database, contact_api)
+            with server.lock:
+                couch_requests = server.requests
+            try:
+                seconds, timings, statuses = run_clients(flask_app, http_server, sessions[name], args.duration)
+            finally:
+                http_server.shutdown()
+            with server.lock:
+                couch_requests = server.requests - couch_requests
+            print("{name:<9} {rate:4.0f} requests/s  {timings}  {statuses}  {couch:.1f} couch requests each".format(
+                name=name, rate=len(timings) / seconds, timings=format_timings(timings),
+                statuses=dict(statuses), couch=couch_requests / len(timings)
+            ))
+    finally:
+        server.latency = 0
+        async_db.client.close()
+        async_db.loop.call_soon_threadsafe(async_db.loop.stop)
+        with server.lock:
+            server.databases.pop(couch_db.dbname, None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Concurrency of the CouchDB connection pool, against the couchstub stand-in server.
+
+Client threads each load contacts and list a page of a user's contacts, as API requests do, through:
+
+- couchdb-python's own session, which opens a connection whenever none is idle and keeps every one
+- a PooledSession without keep-alive, opening a connection for every request
+- a PooledSession capped at each of --max-connections
+
+The stand-in server takes --latency seconds for every request, like a round trip to a real CouchDB would.
+
+    python -m benchmarks.pool_concurrency --threads 64 --max-connections 4 16 64
+"""
+import argparse
+import random
+import threading
+import time
+import uuid
+
+import blackbook.database.couch.database
+import blackbook.database.couch.models as couch_models
+import blackbook.database.couch.pool
+import couchdb
+import couchdb.http
+
+from benchmarks import app
+from benchmarks import format_timings
+from benchmarks import server
+from tests import user_docs
+
+__author__ = 'ievans3024'
+
+
+def run_clients(db, threads, requests, users):
+    """
+    Run client threads reading from a database at once.
+    :param db: The couchdb.Database to read from
+    :param threads: The number of client threads
+    :param requests: The number of reads each thread makes
+    :param users: The number of users whose contacts are read
+    :returns: tuple (seconds taken, list of the time each read took, number of errors)
+    """
+    timings = []
+    errors = []
+    start = threading.Barrier(threads + 1)
+
+    def client(seed):
+        rng = random.Random(seed)
+        start.wait()
+        for n in range(requests):
+            user_id = "u{n}".format(n=rng.randrange(users))
+            started = time.perf_counter()
+            try:
+                if n % 2:
+                    couch_models.Contact.by_user(db, key=user_id, limit=10).rows
+                else:
+                    db.get(user_id + "-c0")
+            except Exception as e:
+                errors.append(e)
+            timings.append(time.perf_counter() - started)
+
+    workers = [threading.Thread(target=client, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    start.wait()
+    started = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - started, timings, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=32, help="client threads reading at once")
+    parser.add_argument("--requests", type=int, default=100, help="reads per client thread")
+    parser.add_argument("--max-connections", type=int, nargs="+", default=[4, 16, 32])
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds the server takes per request")
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+
+    app.config["COUCHDB_NAME"] = "benchmark-" + uuid.uuid4().hex
+    database = blackbook.database.couch.database.CouchDatabase()
+    for n in range(args.users):
+        database.db.update(user_docs("u{n}".format(n=n), contacts=5))
+    server.latency = args.latency
+
+    sessions = [
+        ("couchdb-python", couchdb.http.Session()),
+        ("no keep-alive", blackbook.database.couch.pool.PooledSession(
+            max_connections=max(args.threads, max(args.max_connections)), keep_alive=0
+        ))
+    ]
+    sessions += [
+        ("max {n}".format(n=n), blackbook.database.couch.pool.PooledSession(max_connections=n))
+        for n in args.max_connections
+    ]
+    try:
+        for name, session in sessions:
+            db = couchdb.Server(server.url, session=session)[database.dbname]
+            seconds, timings, errors = run_clients(db, args.threads, args.requests, args.users)
+            if isinstance(session, blackbook.database.couch.pool.PooledSession):
+                stats = session.stats
+                pool = "created {created}, reused {reused}, waits {waits} ({wait_time:.2f}s)".format(**stats)
+            else:
+                pool = "open {open}".format(open=sum(len(conns) for conns in session.connection_pool.conns.values()))
+            print("{name:<15} {rate:7.0f} reads/s  {timings}  errors {errors}  {pool}".format(
+                name=name, rate=len(timings) / seconds, timings=format_timings(timings), errors=errors, pool=pool
+            ))
+    finally:
+        server.latency = 0
+        with server.lock:
+            server.databases.pop(database.dbname, None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Query latency of the contact search index on a synthetic corpus.
+
+Contacts are made up from blackbook.test_data, each with an address, an email and a phone number, and indexed
+the way CouchDatabase indexes them. Queries run like the ?q= query on /api/contact/ does: a page of results,
+either across every contact or within one user's.
+
+    python -m benchmarks.search_latency --contacts 1000000
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import blackbook.database.couch.database
+import blackbook.test_data
+
+from benchmarks import format_timings
+from blackbook.lib.search import InvertedIndex
+
+__author__ = 'ievans3024'
+
+
+def corpus(contacts, users, seed=0):
+    """
+    Generate raw contact documents, and the address, email and phone documents they own.
+    :param contacts: The number of contacts
+    :param users: The number of users owning them
+    :param seed: The random seed
+    :returns: A generator of documents
+    """
+    rng = random.Random(seed)
+    data = blackbook.test_data
+    for n in range(contacts):
+        contact_id = "c{n}".format(n=n)
+        first, last = rng.choice(data.test_first_names), rng.choice(data.test_last_names)
+        yield {
+            "_id": contact_id, "type": "contact", "user": "u{n}".format(n=n % users),
+            "name_first": first, "name_last": last
+        }
+        yield {
+            "_id": contact_id + "-a", "type": "contactaddress", "contact": contact_id,
+            "line_1": rng.choice(data.test_address_line_1s), "line_2": rng.choice(data.test_address_line_2s),
+            "city": rng.choice(data.test_cities), "state": rng.choice(data.test_states),
+            "zip": rng.choice(data.test_zipcodes), "country": "US"
+        }
+        yield {
+            "_id": contact_id + "-e", "type": "contactemail", "contact": contact_id,
+            "address": "{first}.{last}{n}@example.com".format(first=first, last=last, n=n).lower()
+        }
+        yield {
+            "_id": contact_id + "-p", "type": "contactphone", "contact": contact_id,
+            "number": "555-" + rng.choice(data.test_phone_numbers)
+        }
+
+
+def index_document(index, doc):
+    # as CouchDatabaseBase._index_document does
+    fields = blackbook.database.couch.database.CouchDatabaseBase.search_fields[doc["type"]]
+    text = [(doc.get(field), weight) for field, weight in fields]
+    if doc["type"] == "contact":
+        index.add(doc["_id"], text, source=doc["_id"], scope=doc["user"])
+    else:
+        index.add(doc["contact"], text, source=doc["_id"])
+
+
+def queries(rng, users):
+    """
+    The kinds of queries timed, as name -> function making (query, scope) pairs.
+    """
+    data = blackbook.test_data
+    return {
+        "first name": lambda: (rng.choice(data.test_first_names), None),
+        "full name": lambda: (rng.choice(data.test_first_names) + " " + rng.choice(data.test_last_names), None),
+        "name prefix": lambda: (rng.choice(data.test_last_names)[:3], None),
+        "email": lambda: ("{first}.{last}@example".format(
+            first=rng.choice(data.test_first_names), last=rng.choice(data.test_last_names)
+        ).lower(), None),
+        "phone number": lambda: ("555-" + rng.choice(data.test_phone_numbers), None),
+        "street": lambda: (" ".join(rng.choice(data.test_address_line_1s).split()[:2]), None),
+        "one user's": lambda: (rng.choice(data.test_first_names), "u{n}".format(n=rng.randrange(users)))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--contacts", type=int, default=100000, help="contacts in the corpus")
+    parser.add_argument("--users", type=int, default=1000, help="users the contacts are spread across")
+    parser.add_argument("--queries", type=int, default=500, help="queries timed of each kind")
+    parser.add_argument("--limit", type=int, default=10, help="results per query, as a page of them")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    index = InvertedIndex()
+    started = time.perf_counter()
+    for doc in corpus(args.contacts, args.users, seed=args.seed):
+        index_document(index, doc)
+    index.sort_tokens()
+    print("built: {contacts} contacts, {tokens} tokens in {seconds:.1f}s".format(
+        contacts=len(index), tokens=len(index._postings), seconds=time.perf_counter() - started
+    ))
+
+    rng = random.Random(args.seed)
+    for name, make_query in queries(rng, args.users).items():
+        timings = []
+        results = 0
+        for _ in range(args.queries):
+            query, scope = make_query()
+            started = time.perf_counter()
+            results += len(index.search(query, scope=scope, limit=args.limit))
+            timings.append(time.perf_counter() - started)
+        print("{name:<14} {timings}  ({results:.1f} results)".format(
+            name=name, timings=format_timings(timings), results=results / args.queries
+        ))
+
+    # kept up to date as contacts change, e.g. renamed
+    timings = []
+    for _ in range(args.queries):
+        contact_id = "c{n}".format(n=rng.randrange(args.contacts))
+        started = time.perf_counter()
+        index.add(contact_id, [(rng.choice(blackbook.test_data.test_first_names), 3)], source=contact_id)
+        timings.append(time.perf_counter() - started)
+    print("{name:<14} {timings}".format(name="update", timings=format_timings(timings)))
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "index.json")
+        started = time.perf_counter()
+        index.save(path)
+        saved = time.perf_counter() - started
+        started = time.perf_counter()
+        InvertedIndex.load(path)
+        print("saved in {saved:.1f}s ({size:.0f}MB), loaded in {loaded:.1f}s".format(
+            saved=saved, size=os.path.getsize(path) / 2 ** 20, loaded=time.perf_counter() - started
+        ))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
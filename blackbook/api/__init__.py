@@ -1,4 +1,4 @@
-import blackbook.database
+import blackbook.database.models
 
 from flask import current_app
 from flask.views import MethodView
@@ -17,18 +17,23 @@ class APIType(object):
             self.cls = cls
         else:
             raise TypeError("Parameter 'cls' must be a class.")
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
 
     def __get__(self, instance, owner):
         if instance is None:
             return self
         else:
-            if self.get_own_name(owner) in instance.__dict__.keys():
-                return instance.__dict__.get(self.get_own_name(owner))
-            else:
+            name = self.name or self.get_own_name(owner)
+            try:
+                return instance.__dict__[name]
+            except KeyError:
                 raise AttributeError(
                     "'{cls}' object has no attribute '{name}'".format(
                         cls=owner.__name__,
-                        name=self.get_own_name(owner)
+                        name=name
                     )
                 )
 
@@ -40,16 +45,21 @@ class APIType(object):
                         cls=".".join([self.cls.__module__, self.cls.__name__])
                     )
                 )
-            instance.__dict__[self.get_own_name(type(instance))] = value
+            instance.__dict__[self.name or self.get_own_name(type(instance))] = value
 
     def __delete__(self, instance):
         if instance:
-            del instance.__dict__[self.get_own_name(type(instance))]
+            del instance.__dict__[self.name or self.get_own_name(type(instance))]
 
     def get_own_name(self, owner):
-        for attr in dir(owner):
-            if getattr(owner, attr) is self:
-                return attr
+        # Fallback for descriptors that never had __set_name__ called, resolved once and cached
+        if self.name is None:
+            for klass in owner.__mro__:
+                for attr, value in vars(klass).items():
+                    if value is self:
+                        self.name = attr
+                        return attr
+        return self.name
 
 
 class APIField(APIType):
@@ -62,14 +72,14 @@ class APIField(APIType):
                     cls=".".join([self.cls.__module__, self.cls.__name__])
                 )
             )
-        instance.__dict__[self.get_own_name(type(instance))] = value
+        instance.__dict__[self.name or self.get_own_name(type(instance))] = value
 
 
 class API(MethodView):
     """Abstract Base Class for API Method Views"""
 
     db = APIField(object)
-    model = APIType(blackbook.database.Model)
+    model = APIType(blackbook.database.models.Model)
 
     def __init__(self, db, model):
         """
@@ -90,7 +100,12 @@ class API(MethodView):
         """
         raise NotImplementedError()
 
-    def _get_authenticated_user(self, user_api, session_api):
+    def _get_authenticated_user(self):
+        """
+        Get the user authenticated for the current request.
+
+        Implementations should return None if the request is not authenticated.
+        """
         raise NotImplementedError()
 
     def delete(self, *args, **kwargs):
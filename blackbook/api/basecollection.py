@@ -1,4 +1,4 @@
-import blackbook.database
+import blackbook.database.models
 
 from blackbook.api import API_URI_PREFIX
 from blackbook.lib import collection_plus_json
@@ -13,13 +13,59 @@ class ModelCollection(collection_plus_json.Collection):
         uri = '/'.join([p for p in uri.split('/') if p != ''])
         super(ModelCollection, self).__init__(href=uri, **kwargs)
 
-    def add_items(self, item):
-        if isinstance(item, blackbook.database.Model):
-            self.items = self.items + item.get_collection_items()
+    def add_items(self, items):
+        """
+        Add the collection+json items for a model, or for each model in an iterable of models.
+        Items are appended in place, so building a page of N models does not copy or re-validate N times.
+        :param items: A Model instance or an iterable of Model instances
+        """
+        if isinstance(items, blackbook.database.models.Model):
+            items = (items,)
+        collection_items = self.items
+        for item in items:
+            if isinstance(item, blackbook.database.models.Model):
+                collection_items.extend(item.get_collection_items())
+
+
+class TemplateRegistry(object):
+    """
+    Builds each template variant once, and keeps it compiled for splicing into responses.
+
+        templates.get(UserCreateTemplate, public=False)
+
+    Variants are told apart by the keyword arguments they are built with.
+    See collection_plus_json.CompiledTemplate, the templates are shared and must not be changed.
+    """
+
+    def __init__(self):
+        self._templates = {}
+
+    def get(self, cls, **kwargs):
+        """
+        Get a compiled template, building it the first time.
+        :param cls: The Template subclass, e.g. UserCreateTemplate
+        :param kwargs: The arguments to build it with, e.g. public=False
+        :return: collection_plus_json.CompiledTemplate
+        """
+        key = (cls, tuple(sorted(kwargs.items())))
+        template = self._templates.get(key)
+        if template is None:
+            # built at most once per thread racing here, and they all end up using the same one
+            template = self._templates.setdefault(key, collection_plus_json.CompiledTemplate(cls(**kwargs)))
+        return template
+
+
+templates = TemplateRegistry()
 
 
 class ContactCreateTemplate(collection_plus_json.Template):
-    pass
+
+    def __init__(self, **kwargs):
+        data = [
+            {'name': 'name_first', 'placeholder': 'John', 'prompt': 'First Name', 'value': ''},
+            {'name': 'name_last', 'placeholder': 'Doe', 'prompt': 'Last Name', 'value': ''}
+        ]
+        super(ContactCreateTemplate, self).__init__(data=data, **kwargs)
 
 
 class ContactUpdateTemplate(ContactCreateTemplate):
@@ -27,9 +73,7 @@ class ContactUpdateTemplate(ContactCreateTemplate):
 
 
 class ContactCollection(ModelCollection):
-
-    def __init__(self, href, template=ContactCreateTemplate(), **kwargs):
-        super(ContactCollection, self).__init__(href, template=template, **kwargs)
+    pass
 
 
 class SessionCreateTemplate(collection_plus_json.Template):
@@ -43,9 +87,7 @@ class SessionCreateTemplate(collection_plus_json.Template):
 
 
 class SessionCollection(ModelCollection):
-
-    def __init__(self, href, template=SessionCreateTemplate(), **kwargs):
-        super(SessionCollection, self).__init__(href, template=template, **kwargs)
+    pass
 
 
 class UserCreateTemplate(collection_plus_json.Template):
@@ -73,6 +115,4 @@ class UserUpdateTemplate(UserCreateTemplate):
 
 
 class UserCollection(ModelCollection):
-
-    def __init__(self, href, template=UserCreateTemplate(), **kwargs):
-        super(UserCollection, self).__init__(href=href, template=template, **kwargs)
+    pass
@@ -12,8 +12,27 @@ SESSION_COOKIE_SECURE = False  # True in https production
 # Custom Options
 PASSWORD_HASH_METHOD = 'pbkdf2:sha512'  # only methods supported by functions in werkzueg.security
 PASSWORD_SALT_LENGTH = 12
+PASSWORD_HASH_WORKERS = None  # processes used for password hashing, None for one per CPU
+PASSWORD_HASH_QUEUE = 32  # max pending hash/check jobs before logins get 429 Too Many Requests
 PUBLIC_REGISTRATION = False  # Set to True to allow anyone to make an account
-DATABASE_PLUGIN = "blackbook.couch"
+DATABASE_PLUGIN = "blackbook.database.couch"  # "blackbook.database.aiocouch" for the asyncio couchdb backend
 COUCHDB_URI = "http://localhost:5984"
+COUCHDB_MAX_CONNECTIONS = 10  # max open connections to couchdb per process
+COUCHDB_KEEP_ALIVE = 60  # seconds an idle connection is kept open for reuse
+COUCHDB_TIMEOUT = 30  # socket timeout per request in seconds, None for no timeout
+COUCHDB_POOL_TIMEOUT = 10  # seconds to wait for a free connection, None to wait forever
+COUCHDB_READ_RETRIES = 3  # retries for reads failing with a connection error or a 5xx response
+COUCHDB_RETRY_BACKOFF = 0.1  # seconds before the first retry, doubling after each one
+COUCHDB_BULK_BATCH_SIZE = 500  # documents per _bulk_docs request
+COUCHDB_UPDATE_HANDLER = True  # send only changed fields to an update handler, one request per update
+COUCHDB_UPDATE_RETRIES = 10  # retries for updates conflicting with concurrent writes
+COUCHDB_WARM_UP_VIEWS = True  # build view indexes during setup, so requests never wait on them after a deploy
+COUCHDB_STALE_VIEWS = None  # "update_after" to serve listings from the last built index without waiting on a rebuild
+COUCHDB_CONTACT_CARDS = False  # list contacts with their addresses, emails and phone numbers in one view read
+SEARCH_INDEX_PATH = None  # file to persist the contact search index to, None to rebuild it on every start
+SEARCH_INDEX_SAVE_EVERY = 1000  # changes between saves of the search index
+SEARCH_INDEX_POLL_INTERVAL = 5  # seconds between reads of the _changes feed, for other processes' writes
 API_ROOT = '/api/'
-API_PAGINATION_PER_PAGE = 10
\ No newline at end of file
+API_PAGINATION_PER_PAGE = 10
+SESSION_CACHE_TTL = 60  # seconds an authenticated session is trusted before re-checking the database
+SESSION_CACHE_SIZE = 10000  # max number of cached sessions per process
\ No newline at end of file
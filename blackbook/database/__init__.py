@@ -6,6 +6,11 @@ class DatabaseError(BaseException):
     pass
 
 
+class ConflictError(DatabaseError):
+    """Error class for when an entry is still being changed by others after retrying the change."""
+    pass
+
+
 class DatabaseNotReadyError(DatabaseError):
     """Error class for databases that need to run Database.setup()"""
     pass
@@ -72,6 +77,30 @@ class Database(object):
         """
         raise NotImplementedError()
 
+    def create_many(self, models, batch_size=None):
+        """
+        Create many new entries in the database.
+
+        Implementations should write the entries in as few round trips
+        as the database allows, in batches of batch_size entries, and
+        should not stop at the first entry that cannot be created.
+
+        This default implementation calls create() for each model.
+
+        :param models: An iterable of blackbook.database.models.Model instances.
+        :param batch_size: Optional. How many entries to write at a time.
+        :return: A list of (model, error) tuples in input order, error is None if the model was created.
+        """
+        results = []
+        for data in models:
+            try:
+                self.create(data)
+            except DatabaseError as e:
+                results.append((data, e))
+            else:
+                results.append((data, None))
+        return results
+
     def delete(self, data):
         """
         Delete an existing entry from the database.
@@ -87,7 +116,8 @@ class Database(object):
         Implementations should not attempt to recurse through the data
         to delete related entries, and should only delete entries for
         the specified model. The API is expected to recurse through model
-        properties and call this method for each Model instance it comes across.
+        properties and call this method for each Model instance it comes across,
+        unless the implementation provides delete_cascade().
 
         Implementations should not return anything and should raise
         informative errors should any problems occur.
@@ -97,6 +127,25 @@ class Database(object):
         """
         raise NotImplementedError()
 
+    def delete_cascade(self, data, batch_size=None, progress=None):
+        """
+        Delete an existing entry and every entry it owns, recursively.
+
+        Implementations should find the owned entries and delete them in as
+        few round trips as the database allows, in batches of batch_size
+        entries, and remove references to the deleted entries from entries
+        that are not deleted. The entry itself should be deleted last, so an
+        interrupted delete can be finished by calling this again.
+
+        Implementations should raise NotFoundError if the entry does not exist.
+
+        :param data: The Model instance to delete along with everything it owns.
+        :param batch_size: Optional. How many entries to read or write at a time.
+        :param progress: Optional. Called with the statistics dict after every batch.
+        :return: A dict of statistics, at least the number of entries found and deleted.
+        """
+        raise NotImplementedError()
+
     def read(self, model, _id=None):
         """
         Read one or more entries from the database.
@@ -125,23 +174,61 @@ class Database(object):
         """
         raise NotImplementedError()
 
-    def replicate(self, database):
+    @property
+    def replication_id(self):
+        """
+        A stable name for this database, e.g. its address.
+
+        Replication checkpoints are kept per source database under this name.
+
+        :return: str
+        """
+        raise NotImplementedError()
+
+    def iter_changes(self, since=None, batch_size=None):
+        """
+        Stream the entries in the database a batch at a time, for replicate().
+
+        Implementations should yield batches in the order the entries were
+        last changed, and each batch should come with a checkpoint. When
+        "since" is one of those checkpoints, only entries changed after it
+        should be yielded, so an interrupted replication can pick up where
+        it left off and a repeat run only copies what changed.
+
+        Entries are (model, _id, data) tuples, where model is the
+        blackbook.database.models.Model subclass the entry is an instance
+        of and data is a dict of its fields. Deleted entries are yielded
+        as (None, _id, None).
+
+        :param since: Optional. A checkpoint from a previous batch.
+        :param batch_size: Optional. Max number of entries per batch.
+        :return: An iterator of (checkpoint, entries) tuples.
+        """
+        raise NotImplementedError()
+
+    def replicate(self, database, batch_size=None, progress=None):
         """
         Replicate the data contained in another Database instance.
 
         For the "database" parameter, implementations should accept
-        an instance of Database, and call its read() method for each
-        model type the implementation is meant to store.
+        an instance of Database, and read its entries with its
+        iter_changes() method, so that nothing needs to be held in memory
+        beyond one batch.
 
         It is left up to the discretion of the implementation how
-        it dissects and stores the information supplied by the read()
-        method of the other database.
+        it dissects and stores the information supplied by the
+        iter_changes() method of the other database.
 
-        Implementations should not return anything and should raise
-        informative errors should any problems occur.
+        Implementations should store the checkpoint of each batch written
+        and resume from it the next time the same database is replicated.
+
+        Implementations should raise informative errors should any
+        problems occur.
 
         :param database: An instance of blackbook.database.Database
-        :return:
+        :param batch_size: Optional. Max number of entries to write at a time.
+        :param progress: Optional. Called with the statistics dict after every batch.
+        :return: A dict of statistics: entries written and deleted, errors, seconds taken and entries per second.
         """
         raise NotImplementedError()
 
@@ -0,0 +1,11 @@
+import importlib
+
+__all__ = ['api', 'client', 'database']
+__author__ = 'ievans3024'
+
+
+def __getattr__(name):
+    # imported on first use, see blackbook.database.couch
+    if name in __all__:
+        return importlib.import_module('.'.join([__name__, name]))
+    raise AttributeError("module '{module}' has no attribute '{name}'".format(module=__name__, name=name))
@@ -0,0 +1,244 @@
+import asyncio
+import collections
+import datetime
+import blackbook.api.basecollection
+import blackbook.api.errors
+import blackbook.database
+import blackbook.database.couch.api
+import blackbook.database.couch.models as couch_models
+
+from blackbook.api import APIField
+from blackbook.database.aiocouch.database import AsyncCouchDatabase
+from flask import current_app
+from flask import g
+from flask import request
+from flask import Response
+from flask import session
+
+__author__ = 'ievans3024'
+
+
+class AsyncCouchAPI(blackbook.database.couch.api.CouchAPI):
+    """
+    Abstract Base Class for API views backed by an AsyncCouchDatabase.
+
+    Handlers are coroutines run on the database's event loop, so they can await independent queries
+    at once with asyncio.gather(). Flask's request, session and g aren't available there: the regular
+    method reads what the handler needs from them and passes it in.
+    """
+
+    db = APIField(AsyncCouchDatabase)
+
+    async def _get_authenticated_user_async(self, token):
+        if not token:
+            return None
+        user = self.session_cache.get(token)
+        if user is None:
+            sessions_by_token = await self.db.query(couch_models.Session.by_token, key=token)
+            if sessions_by_token and sessions_by_token[0].expiry > datetime.datetime.now():
+                get_session = sessions_by_token[0]
+                user = await self._read_one_async(couch_models.User, get_session.user)
+                if user is not None:
+                    if user.groups:
+                        user.load_groups(await self.db.read(couch_models.Group, user.groups))
+                    self.session_cache.set(token, user, get_session.expiry)
+        return user
+
+    def _get_authenticated_user(self):
+        if "authenticated_user" not in g:
+            g.authenticated_user = self.db.run(self._get_authenticated_user_async(session.get("id")))
+        return g.authenticated_user
+
+    async def _read_one_async(self, model, _id):
+        try:
+            return (await self.db.read(model, _id))[0]
+        except blackbook.database.NotFoundError:
+            return None
+
+
+class Contact(AsyncCouchAPI, blackbook.database.couch.api.Contact):
+    """
+    Contact API class for the asyncio backend, see blackbook.database.couch.api.Contact
+    """
+
+    def get(self, contact_id=None, user_id=None):
+        if not self._request_origin_consistent():
+            # TODO: handle bad CSRF -- APIBadRequestError?
+            pass
+
+        return self.db.run(
+            self.get_async(
+                contact_id=contact_id,
+                user_id=user_id,
+                token=session.get("id"),
+                args=request.args,
+                base_url=request.base_url,
+                per_page=current_app.config.get("API_PAGINATION_PER_PAGE") or 10
+            )
+        )
+
+    async def get_async(self, contact_id=None, user_id=None, token=None, args=None, base_url="", per_page=10):
+        args = args or {}
+        document = self._generate_document()
+
+        if contact_id:
+            # the contact doesn't depend on who is asking, fetch both at once
+            user, contact = await asyncio.gather(
+                self._get_authenticated_user_async(token),
+                self._read_one_async(self.model, contact_id)
+            )
+            if not user:
+                document.error = blackbook.api.errors.APIUnauthorizedError()
+                return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
+
+            template = blackbook.api.basecollection.ContactUpdateTemplate
+            template_meta = self.api_spec["template_meta"]["update"]
+            if (not contact) or \
+                    (
+                        contact.user != user.id and
+                        not user.has_permission(".".join([self.db.dbname, "read", self.model.__name__.lower()]))
+                    ):
+                document.error = blackbook.api.errors.APINotFoundError()
+                return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
+            owned = await self.db.read_owned([contact])
+            return self._render_contacts(document, user, [contact], template, template_meta, owned=owned)
+
+        template = blackbook.api.basecollection.ContactCreateTemplate
+        template_meta = self.api_spec["template_meta"]["create"]
+
+        user = await self._get_authenticated_user_async(token)
+        if not user:
+            document.error = blackbook.api.errors.APIUnauthorizedError()
+            return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
+
+        if user_id:
+            if not (user.id == user_id or user.has_permission(
+                    ".".join([self.db.dbname, "read", couch_models.User.__name__.lower()]))):
+                document.error = blackbook.api.errors.APINotFoundError()
+                return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
+            # the user may see them, fetch the owner and the listing at once
+            paginator = self._paginator("by_user", key=user_id, per_page=per_page)
+            owner, listing = await asyncio.gather(
+                self._read_one_async(couch_models.User, user_id),
+                self._list_contacts(paginator, args, owner=user_id)
+            )
+            if not owner:
+                document.error = blackbook.api.errors.APINotFoundError()
+                return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
+        elif user.has_permission(".".join([self.db.dbname, "read", self.model.__name__.lower()])):
+            paginator = self._paginator("all", per_page=per_page)
+            listing = await self._list_contacts(paginator, args)
+        else:
+            paginator = self._paginator("by_user", key=user.id, per_page=per_page)
+            listing = await self._list_contacts(paginator, args, owner=user.id)
+
+        if isinstance(listing, blackbook.api.errors.APIError):
+            document.error = listing
+            return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
+        contacts, page = listing
+        if page is not None:
+            self._add_page_links(document, page, base_url)
+        # cards come with what the contacts own, otherwise it takes one more request
+        owned = page.owned if page is not None and page.owned is not None else await self.db.read_owned(contacts)
+
+        return self._render_contacts(document, user, contacts, template, template_meta, owned=owned)
+
+    def _update(self, contact_id, complete):
+        return self.db.run(self._update_async(contact_id, complete, session.get("id"), self._template_values()))
+
+    async def _update_async(self, contact_id, complete, token, values):
+        user, contact = await asyncio.gather(
+            self._get_authenticated_user_async(token),
+            self._read_one_async(self.model, contact_id) if contact_id else asyncio.sleep(0)
+        )
+        document = self._generate_document()
+
+        error = self._prepare_update(document, user, contact, values, complete)
+        if error is not None:
+            return error
+        try:
+            contact = await self.db.update(contact)
+        except blackbook.database.DatabaseError as e:
+            return self._update_error(document, e)
+
+        template = blackbook.api.basecollection.ContactUpdateTemplate
+        template_meta = self.api_spec["template_meta"]["update"]
+        owned = await self.db.read_owned([contact])
+        return self._render_contacts(document, user, [contact], template, template_meta, owned=owned)
+
+    def _delete(self, contact_id):
+        return self.db.run(self._delete_async(contact_id, session.get("id")))
+
+    async def _delete_async(self, contact_id, token):
+        user, contact = await asyncio.gather(
+            self._get_authenticated_user_async(token),
+            self._read_one_async(self.model, contact_id) if contact_id else asyncio.sleep(0)
+        )
+        document = self._generate_document()
+
+        error = self._prepare_delete(document, user, contact)
+        if error is not None:
+            return error
+        try:
+            await self.db.delete_cascade(contact)
+        except blackbook.database.NotFoundError:
+            # deleted by someone else meanwhile
+            pass
+        return Response(response="", status=204)
+
+    async def _list_contacts(self, paginator, args, owner=None):
+        """
+        Get the contacts matching the query args, or a page of contacts if there are none.
+        :return: tuple (contacts, pagination Page or None), or the APIError to respond with if a pagination
+                 cursor is malformed or the search index is being built
+        """
+        try:
+            queried = await self._query_by_fields_async(args, owner=owner, limit=paginator.per_page)
+        except blackbook.database.DatabaseNotReadyError:
+            return blackbook.api.errors.APIServiceUnavailableError()
+        if queried is not None:
+            # indexed lookups are narrow enough to skip pagination
+            return queried, None
+        try:
+            page = await paginator.page_async(self.db, after=args.get("after"), before=args.get("before"))
+        except ValueError:
+            return blackbook.api.errors.APIBadRequestError()
+        return page.items, page
+
+    async def _query_by_fields_async(self, args, owner=None, limit=None):
+        """
+        Coroutine version of _query_by_fields, running every lookup at once.
+        """
+        lookups = []
+        if args.get("q"):
+            # ranked, so it goes first and everything else only narrows it down
+            lookups.append(self.db.search(args["q"], model=self.model, owner=owner, limit=limit))
+        for arg, (view_name, normalize) in self.query_views.items():
+            value = args.get(arg)
+            if value:
+                lookups.append(self.db.query(
+                    getattr(self.model, view_name), key=normalize(value), include_docs=True, **self.listing_view_options
+                ))
+        if not lookups:
+            return None
+
+        results = None
+        for contacts in await asyncio.gather(*lookups):
+            found = collections.OrderedDict(
+                (contact.doc_id, contact) for contact in contacts
+                # linked rows for since-deleted contacts wrap as empty documents
+                if contact.type == "contact" and (owner is None or contact.user == owner)
+            )
+            if results is None:
+                results = found
+            else:
+                results = collections.OrderedDict((k, v) for k, v in results.items() if k in found)
+        return list(results.values())
+
+
+def init_api(app):
+
+    with app.app_context():
+        database = AsyncCouchDatabase()
+
+    return blackbook.database.couch.api.init_api(app, database=database, contact_api=Contact)
@@ -0,0 +1,579 @@
+import blackbook.database
+import blackbook.database.couch.database
+import asyncio
+import collections
+import couchdb
+import functools
+import hashlib
+import threading
+import time
+
+from blackbook.database.aiocouch.client import AsyncCouchClient
+from blackbook.lib.search import InvertedIndex
+from flask import current_app
+from urllib.parse import quote
+
+__author__ = 'ievans3024'
+
+CouchDatabaseBase = blackbook.database.couch.database.CouchDatabaseBase
+DESIGN_HASH_FIELD = blackbook.database.couch.database.DESIGN_HASH_FIELD
+UPDATE_HANDLER = blackbook.database.couch.database.UPDATE_HANDLER
+
+_view_wrapper = object()  # default for AsyncCouchDatabase.query(), use the view's own wrapper
+
+
+class AsyncCouchDatabase(CouchDatabaseBase):
+    """
+    CouchDB through asyncio.
+
+    Implements the blackbook.database.Database interface with coroutines, so independent queries
+    can run concurrently with asyncio.gather(). They all run on one event loop in a background
+    thread owned by the database, and share its connections; call run() to wait on one from
+    a regular (WSGI) thread.
+
+    Documents are the same couch model instances blackbook.database.couch uses, and what doesn't
+    make requests is shared with it, see CouchDatabaseBase.
+    """
+
+    def __init__(self):
+        super(AsyncCouchDatabase, self).__init__()
+        self.client = AsyncCouchClient(
+            current_app.config.get('COUCHDB_URI') or 'http://localhost:5984',
+            self.dbname,
+            max_connections=current_app.config.get('COUCHDB_MAX_CONNECTIONS') or 10,
+            keep_alive=current_app.config.get('COUCHDB_KEEP_ALIVE') or 60,
+            timeout=current_app.config.get('COUCHDB_TIMEOUT'),
+            read_retry_delays=self.read_retry_delays
+        )
+
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, name='aiocouch', daemon=True)
+        self._loop_thread.start()
+
+        try:
+            exists = self.run(self.client.exists())
+        except (ConnectionRefusedError, OSError) as e:
+            raise blackbook.database.DatabaseUnreachableError(
+                'The connection to the database was refused. (Error: {error})\n'.format(error=e) +
+                'Please ensure option "COUCHDB_URI" is set and correct in config.py'
+            )
+        except couchdb.Unauthorized as e:
+            raise blackbook.database.DatabaseUnreachableError(
+                'The connection to the database was refused. (Error: {error})\n'.format(error=e.args[0]) +
+                'Please ensure options "COUCHDB_USER" and "COUCHDB_PASSWORD" are set and correct in config.py '
+            )
+        if not exists or not self.is_setup:
+            self.run(self.setup())
+
+    def run(self, coroutine, timeout=None):
+        """
+        Run a coroutine on the database's event loop and wait for its result.
+
+        Must not be called from the event loop itself, await the coroutine there instead.
+        :param coroutine: The coroutine, e.g. db.read(Contact, contact_id)
+        :param timeout: Optional. Seconds to wait for the result
+        :return: The coroutine's result
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    @property
+    def pool_stats(self):
+        """
+        Connection pool utilization: open connections in use and idle, connections created, reused,
+        expired and discarded after errors, and read retries.
+        """
+        return self.client.stats
+
+    @property
+    def is_setup(self):
+        return self.run(self.check_setup())
+
+    async def check_setup(self):
+        """
+        Coroutine version of is_setup.
+        :return: bool
+        """
+        try:
+            return not await self._outdated_design_docs()
+        except couchdb.http.ResourceNotFound:
+            return False
+
+    async def _outdated_design_docs(self):
+        """
+        Find the design docs missing or out of date with the spec, see CouchDatabase._outdated_design_docs().
+        """
+        rows = await self.query('_all_docs', keys=[design['_id'] for design in self.design_docs], include_docs=True)
+        current = {row.id: row.doc for row in rows if row.doc is not None}
+        outdated = []
+        for design in self.design_docs:
+            doc = current.get(design['_id'])
+            if doc is None or doc.get(DESIGN_HASH_FIELD) != design[DESIGN_HASH_FIELD]:
+                outdated.append((design, doc['_rev'] if doc is not None else None))
+        return outdated
+
+    async def query(self, view, keys=None, wrapper=_view_wrapper, **options):
+        """
+        Query a view.
+        :param view: A couchdb.design.ViewDefinition (e.g. couch Contact.by_user), or a view name like "_all_docs"
+        :param keys: Optional. Only get rows with these keys, in one request
+        :param wrapper: Optional. Called on each row, defaults to the view's wrapper. None for raw rows.
+        :param options: Optional. View options, e.g. startkey, limit, include_docs
+        :return: A list of rows, as returned by wrapper
+        """
+        if isinstance(view, str):
+            name = view
+            wrapper = None if wrapper is _view_wrapper else wrapper
+        else:
+            name = '/'.join([view.design, view.name])
+            options = dict(view.defaults, **options)
+            wrapper = view.wrapper if wrapper is _view_wrapper else wrapper
+        rows = await self.client.view(name, keys=keys, **options)
+        return [wrapper(row) for row in rows] if wrapper is not None else rows
+
+
+    async def create(self, data):
+        doc = self._to_document(data)
+
+        if await self.client.get(doc.id) is not None:
+            raise blackbook.database.EntryExistsError()
+
+        await self.client.save(doc.unwrap())
+
+        if data.id is None:
+            data.id = doc.id
+
+        await asyncio.get_running_loop().run_in_executor(None, self._index_document, data.id, doc)
+        data.mark_clean()
+
+        return data
+
+    async def create_many(self, models, batch_size=None):
+        """
+        Create many entries with _bulk_docs, writing batch_size documents per request,
+        with every batch in flight at once.
+
+        :param models: An iterable of blackbook.database.models.Model instances
+        :param batch_size: Optional. Documents per request, defaults to config option COUCHDB_BULK_BATCH_SIZE.
+        :return: A list of (model, error) tuples in input order, error is None if the model was created.
+        """
+        batch_size = batch_size or self.batch_size
+        results = []
+        batches = [[]]
+
+        for data in models:
+            try:
+                doc = self._to_document(data)
+            except blackbook.database.InvalidModelError as e:
+                results.append((data, e))
+            else:
+                results.append((data, None))
+                if len(batches[-1]) >= batch_size:
+                    batches.append([])
+                batches[-1].append((len(results) - 1, doc))
+
+        await asyncio.gather(*(self._write_batch(batch, results) for batch in batches if batch))
+        return results
+
+    async def _write_batch(self, batch, results):
+        try:
+            written = await self.client.bulk_docs([doc.unwrap() for position, doc in batch])
+        except couchdb.HTTPError as e:
+            raise blackbook.database.DatabaseError(
+                'There was an error writing a batch of {count} documents. (Error: {error})'.format(
+                    count=len(batch),
+                    error=e.args[0]
+                )
+            )
+
+        created = []
+        for (position, doc), result in zip(batch, written):
+            data = results[position][0]
+            if 'error' not in result:
+                if data.id is None:
+                    data.id = result['id']
+                created.append((result['id'], doc))
+                data.mark_clean()
+            elif result['error'] == 'conflict':
+                results[position] = (data, blackbook.database.EntryExistsError(result['id']))
+            else:
+                results[position] = (data, blackbook.database.DatabaseError(result['id'], result['reason']))
+        await asyncio.get_running_loop().run_in_executor(None, self._index_documents, created)
+
+    async def delete(self, data):
+        existing = await self.client.get(data.id)
+        if existing is None:
+            raise blackbook.database.NotFoundError()
+
+        await self.client.delete(existing)
+        await asyncio.get_running_loop().run_in_executor(None, self._unindex_document, data.id, existing)
+        if existing.get('type') == 'user':
+            self._user_changed(data.id)
+
+    async def delete_cascade(self, data, batch_size=None, progress=None, retries=None):
+        """
+        Delete an entry and everything it owns, see CouchDatabase.delete_cascade().
+
+        Each level of owned documents is read with every batch in flight at once.
+        """
+        batch_size = batch_size or self.batch_size
+        retries = self.update_retries if retries is None else retries
+        stats = {'found': 0, 'deleted': 0, 'dereferenced': 0, 'conflicts': 0, 'seconds': 0.0}
+        started = time.monotonic()
+
+        def report():
+            stats['seconds'] = time.monotonic() - started
+            if progress is not None:
+                progress(dict(stats))
+
+        doc_id = self._document_id(data)
+        levels = [await self._fetch_documents([doc_id])]
+        if doc_id not in levels[0]:
+            raise blackbook.database.NotFoundError()
+        stats['found'] = 1
+
+        while True:
+            owned = self._cascade_owned(levels)
+            level = collections.OrderedDict()
+            for found in await asyncio.gather(*(
+                self._fetch_documents(owned[start:start + batch_size]) for start in range(0, len(owned), batch_size)
+            )):
+                level.update(self._cascade_level(levels[-1], found))
+            stats['found'] += len(level)
+            report()
+            if not level:
+                break
+            levels.append(level)
+
+        referenced = self._cascade_references(levels)
+        owners = await self._fetch_documents(referenced)
+
+        # deepest first, and the entry last, so nothing is left unreachable from it
+        deletes = [(i, doc) for level in reversed(levels[1:]) for i, doc in level.items()]
+        for start in range(0, len(deletes), batch_size):
+            await self._cascade_batch(collections.OrderedDict(deletes[start:start + batch_size]), {}, {}, stats, retries)
+            report()
+        await self._cascade_batch(levels[0], owners, referenced, stats, retries)
+        report()
+
+        return stats
+
+
+    async def _cascade_batch(self, deletes, owners, referenced, stats, retries):
+        attempt = 0
+        while deletes or owners:
+            docs = self._cascade_docs(deletes, owners, referenced)
+            if not docs:
+                return
+            try:
+                written = await self.client.bulk_docs(docs)
+            except couchdb.HTTPError as e:
+                raise blackbook.database.DatabaseError(
+                    'There was an error writing a batch of {count} documents. (Error: {error})'.format(
+                        count=len(docs),
+                        error=e.args[0]
+                    )
+                )
+            failed = {result['id']: result['error'] for result in written if 'error' in result}
+            conflicted = await asyncio.get_running_loop().run_in_executor(
+                None, self._cascade_written, deletes, owners, failed, stats
+            )
+            if not conflicted:
+                return
+            await asyncio.sleep(self._update_conflict(conflicted[0], attempt, retries))
+            attempt += 1
+            # deleted by others meanwhile is as good as deleted here
+            current = await self._fetch_documents(conflicted)
+            deletes = collections.OrderedDict((i, current[i]) for i in conflicted if i in deletes and i in current)
+            owners = collections.OrderedDict((i, current[i]) for i in conflicted if i in owners and i in current)
+
+    async def _fetch_documents(self, ids):
+        documents = collections.OrderedDict()
+        keys = list(collections.OrderedDict.fromkeys(i for i in ids if i is not None))
+        if not keys:
+            return documents
+        for row in await self.query('_all_docs', keys=keys, include_docs=True):
+            if row.doc is None:
+                continue
+            model = self.type_map.get(row.doc.get('type'))
+            if model is not None:
+                documents[row.id] = model.wrap(row.doc)
+        return documents
+
+    async def read(self, model, _id=None):
+        """
+        Read one or more entries from the database, see CouchDatabase.read().
+        """
+        couch_model = self.model_map.get(model, model)
+        if couch_model not in self.type_map.values():
+            raise blackbook.database.InvalidModelError()
+        type_name = couch_model.__name__.lower()
+
+        if _id is None:
+            return [
+                couch_model.wrap(row.doc) for row in await self.query('_all_docs', include_docs=True)
+                if row.doc is not None and row.doc.get('type') == type_name
+            ]
+
+        single = isinstance(_id, str)
+        documents = await self._fetch_documents([_id] if single else _id)
+        found = [doc for doc in documents.values() if doc.type == type_name]
+
+        if single and not found:
+            raise blackbook.database.NotFoundError()
+        return found
+
+    async def read_owned(self, documents):
+        """
+        Read every document owned by some documents in a single request, see CouchDatabase.read_owned().
+        """
+        return await self._fetch_documents(owned for doc in documents for owned in doc.owns)
+
+    @property
+    def replication_id(self):
+        return '{scheme}://{host}:{port}{prefix}/{dbname}'.format(
+            scheme=self.client.scheme,
+            host=self.client.host,
+            port=self.client.port,
+            prefix=self.client.prefix,
+            dbname=self.dbname
+        )
+
+    def iter_changes(self, since=None, batch_size=None):
+        """
+        Stream documents from the _changes feed, see CouchDatabase.iter_changes().
+
+        A regular iterator rather than a coroutine, so other backends can replicate from this one.
+        """
+        batch_size = batch_size or self.batch_size
+        since = since or 0
+        while True:
+            status, headers, feed = self.run(self.client.request(
+                'GET', '_changes', params={'since': since, 'limit': batch_size, 'include_docs': 'true'}
+            ))
+            results = feed.get('results') or []
+            if not results:
+                return
+            since = feed['last_seq']
+            yield since, [entry for entry in (self._change_entry(change) for change in results) if entry is not None]
+            if len(results) < batch_size:
+                return
+
+
+    async def replicate(self, database, batch_size=None, progress=None):
+        """
+        Copy another database's entries into this one, a batch at a time, see CouchDatabase.replicate().
+
+        database.iter_changes() is a regular iterator, its batches are read in the loop's default executor.
+        :param database: An instance of blackbook.database.Database
+        :param batch_size: Optional. Entries per batch, defaults to config option COUCHDB_BULK_BATCH_SIZE.
+        :param progress: Optional. Called with the statistics dict after every batch.
+        :return: A dict of statistics, see Database.replicate()
+        """
+        checkpoint_id = '_local/replication-' + hashlib.sha1(database.replication_id.encode('utf-8')).hexdigest()
+        checkpoint = await self.client.get(checkpoint_id) or {'_id': checkpoint_id, 'source': database.replication_id}
+        stats = {'written': 0, 'deleted': 0, 'errors': 0, 'seconds': 0.0, 'per_second': 0.0}
+        started = time.monotonic()
+
+        changes = database.iter_changes(since=checkpoint.get('since'), batch_size=batch_size or self.batch_size)
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await loop.run_in_executor(None, next, changes, None)
+            if batch is None:
+                break
+            since, entries = batch
+            await self._replicate_batch(entries, stats)
+            checkpoint['since'] = since
+            await self.client.save(checkpoint)
+            stats['seconds'] = time.monotonic() - started
+            stats['per_second'] = (stats['written'] + stats['deleted']) / stats['seconds'] if stats['seconds'] else 0.0
+            if progress is not None:
+                progress(dict(stats))
+
+        stats['seconds'] = time.monotonic() - started
+        stats['per_second'] = (stats['written'] + stats['deleted']) / stats['seconds'] if stats['seconds'] else 0.0
+        return stats
+
+    async def _replicate_batch(self, entries, stats):
+        if not entries:
+            return
+        # current revisions, to overwrite or delete what is already here
+        revs = {
+            row.key: row.value['rev'] for row in await self.query('_all_docs', keys=[entry[1] for entry in entries])
+            if row.id is not None and not row.value.get('deleted')
+        }
+        # old versions of deleted documents, to drop them from the search index
+        removed = {}
+        deleted_ids = [doc_id for model, doc_id, data in entries if data is None and doc_id in revs]
+        if deleted_ids:
+            removed = {
+                row.id: row.doc for row in await self.query('_all_docs', keys=deleted_ids, include_docs=True)
+                if row.doc is not None
+            }
+
+        docs = self._replicated_docs(entries, revs, stats)
+        try:
+            written = await self.client.bulk_docs(docs)
+        except couchdb.HTTPError as e:
+            raise blackbook.database.DatabaseError(
+                'There was an error writing a batch of {count} replicated documents. (Error: {error})'.format(
+                    count=len(docs),
+                    error=e.args[0]
+                )
+            )
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._replicated, docs, [('error' not in result, result['id']) for result in written], removed, stats
+        )
+
+
+
+
+    def _read_changes(self, since, limit):
+        """
+        Read a batch of the _changes feed, see CouchDatabase._read_changes(). Not on the event loop.
+        """
+        status, headers, feed = self.run(self.client.request(
+            'GET', '_changes', params={'since': since or 0, 'limit': limit, 'include_docs': 'true'}
+        ))
+        return feed
+
+    async def rebuild_search_index(self):
+        """
+        Build the search index from scratch with one pass over the _changes feed, and save it.
+
+        The feed is read from the loop's default executor, see CouchDatabase.rebuild_search_index().
+        """
+        index = InvertedIndex()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._catch_up_search_index, index)
+        self.search_index = index
+        await loop.run_in_executor(None, self.save_search_index)
+
+    async def search(self, query, model=None, owner=None, limit=None):
+        """
+        Full-text search over contacts, see CouchDatabase.search().
+        """
+        # ranking a common term goes through a lot of postings, keep it off the event loop
+        hits = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(self._search_hits, query, model=model, owner=owner, limit=limit)
+        )
+        documents = await self._fetch_documents(key for key, score in hits)
+        return [documents[key] for key, score in hits if key in documents]
+
+    async def setup(self):
+        if not await self.check_setup():
+            try:
+                await self.client.create()
+            except couchdb.http.PreconditionFailed as e:
+                if e.args[0][0] != 'file_exists':
+                    raise blackbook.database.DatabaseError(
+                        'There was an error when trying to create database "{dbname}" (Error: {error})'.format(
+                            dbname=self.dbname,
+                            error=e.args[0]
+                        )
+                    )
+            except couchdb.http.ServerError as e:
+                raise blackbook.database.DatabaseError(
+                    'There was an error when trying to create database "{dbname}" (Error: {error})\n'.format(
+                        dbname=self.dbname,
+                        error=e.args[0]
+                    ) +
+                    'Please ensure couchdb options are set and correct in config.py'
+                )
+
+            docs = []
+            for design, rev in await self._outdated_design_docs():
+                # the spec replaces whatever is there
+                docs.append(dict(design, _rev=rev) if rev is not None else dict(design))
+            for result in await self.client.bulk_docs(docs):
+                if 'error' in result:
+                    raise blackbook.database.DatabaseError(
+                        'There was an error saving design doc "{doc_id}" (Error: {error})'.format(
+                            doc_id=result['id'],
+                            error=(result['error'], result.get('reason'))
+                        )
+                    )
+            if docs and self.warm_up_views:
+                await self.warm_up(designs=docs)
+
+
+    async def warm_up(self, designs=None, progress=None, poll_interval=1.0):
+        """
+        Build the view indexes of design docs ahead of the queries that need them, see CouchDatabase.warm_up().
+        """
+        pending = self._view_paths(self.design_docs if designs is None else designs)
+        started = time.monotonic()
+        await asyncio.gather(*(self.query(path, limit=0, stale='update_after') for path in pending.values()))
+
+        built = collections.OrderedDict()
+        while pending:
+            try:
+                status, headers, tasks = await self.client.request('GET', '/_active_tasks')
+                building = self._indexing_progress(tasks)
+            except (couchdb.http.Unauthorized, couchdb.http.Forbidden):
+                building = {}
+            done = [design_id for design_id in pending if design_id not in building]
+            # no build running, or it hasn't shown up yet: a regular query returns once the index is current
+            await asyncio.gather(*(self.query(pending.pop(design_id), limit=0) for design_id in done))
+            for design_id in done:
+                built[design_id] = time.monotonic() - started
+            if progress is not None:
+                report = {design_id: 100.0 for design_id in built}
+                report.update((design_id, float(building.get(design_id, 0))) for design_id in pending)
+                progress(report)
+            if pending:
+                await asyncio.sleep(poll_interval)
+
+        return built
+
+
+    async def update(self, data, retries=None):
+        """
+        Update an existing entry, writing only the fields that changed, see CouchDatabase.update().
+        """
+        doc_id, changes, loaded = self._update_plan(data)
+        if not changes:
+            return data
+        retries = self.update_retries if retries is None else retries
+
+        attempt = 0
+        while True:
+            try:
+                if self.update_handler:
+                    doc = await self._patch_document(doc_id, changes)
+                else:
+                    doc = await self._save_changes(doc_id, changes, loaded)
+                break
+            except couchdb.http.ResourceConflict:
+                await asyncio.sleep(self._update_conflict(doc_id, attempt, retries))
+                attempt += 1
+                loaded = None
+
+        return await asyncio.get_running_loop().run_in_executor(None, self._updated, data, doc)
+
+    async def _patch_document(self, doc_id, changes):
+        path = '/'.join(['_design', UPDATE_HANDLER.replace('/', '/_update/'), quote(doc_id, safe='')])
+        try:
+            status, headers, doc = await self.client.request('PUT', path, body=changes)
+        except couchdb.http.ResourceNotFound:
+            raise blackbook.database.NotFoundError()
+        except (couchdb.http.Forbidden, couchdb.http.ServerError) as e:
+            raise blackbook.database.DatabaseError(
+                'There was an error updating document "{doc_id}" (Error: {error})'.format(doc_id=doc_id, error=e.args[0])
+            )
+        doc['_rev'] = headers.get('x-couch-update-newrev', doc.get('_rev'))
+        return doc
+
+    async def _save_changes(self, doc_id, changes, loaded=None):
+        doc = loaded
+        if doc is None:
+            doc = await self.client.get(doc_id)
+            if doc is None:
+                raise blackbook.database.NotFoundError()
+        doc.update(changes)
+        try:
+            await self.client.save(doc)
+        except (couchdb.http.Forbidden, couchdb.http.ServerError) as e:
+            raise blackbook.database.DatabaseError(
+                'There was an error updating document "{doc_id}" (Error: {error})'.format(doc_id=doc_id, error=e.args[0])
+            )
+        return doc
@@ -1,3 +1,12 @@
+import importlib
+
 __all__ = ['api', 'database', 'models']
 __author__ = 'ievans3024'
 
+
+def __getattr__(name):
+    # imported on first use, blackbook.app gets init_api() through DATABASE_PLUGIN's api attribute;
+    # importing it up front would be circular, the api imports the other submodules through this package
+    if name in __all__:
+        return importlib.import_module('.'.join([__name__, name]))
+    raise AttributeError("module '{module}' has no attribute '{name}'".format(module=__name__, name=name))
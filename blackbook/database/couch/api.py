@@ -1,7 +1,14 @@
+import collections
 import datetime
+import json
+import re
+import secrets
+import threading
 import couchdb
 import couchdb.mapping
 import blackbook.database.couch.database
+import blackbook.database.models
+import blackbook.tools.hashing
 import blackbook.tools.tools
 import blackbook.api.basecollection
 import blackbook.api.errors
@@ -9,9 +16,12 @@ import blackbook.api.errors
 from blackbook.api import APIField
 from blackbook.api import APIType
 from blackbook.api import API
+from blackbook.database.couch.pagination import CardPaginator
+from blackbook.database.couch.pagination import KeysetPaginator
 from blackbook.lib import collection_plus_json
 from flask import Blueprint
 from flask import current_app
+from flask import g
 from flask import request
 from flask import Response
 from flask import session
@@ -19,12 +29,95 @@ from flask import session
 __author__ = 'ievans3024'
 
 
+class SessionCache(object):
+    """
+    Process-wide cache of session token -> authenticated couch User document.
+
+    Entries are kept until the session expires or max_age seconds pass, whichever is sooner,
+    so changes made by other workers are eventually picked up. Call invalidate() when a session
+    is deleted (logout); init_api() has the database call invalidate_user() when a user is updated
+    or deleted through it.
+    """
+
+    def __init__(self, max_age=60, max_entries=10000):
+        self.max_age = datetime.timedelta(seconds=max_age)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+    def get(self, token):
+        """
+        Get the cached user for a session token.
+        :param token: The session token
+        :return: The couch User document, or None if not cached or expired.
+        """
+        now = datetime.datetime.now()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                if entry[0] > now:
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[token]
+            self.misses += 1
+            return None
+
+    def set(self, token, user, expiry):
+        """
+        Cache the user for a session token.
+        :param token: The session token
+        :param user: The couch User document the session belongs to
+        :param expiry: The session's expiry, the entry will never outlive it
+        """
+        now = datetime.datetime.now()
+        expires = min(expiry, now + self.max_age)
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                for key in [k for k, v in self._entries.items() if v[0] <= now]:
+                    del self._entries[key]
+                if len(self._entries) >= self.max_entries:
+                    # still full, drop the oldest entry
+                    del self._entries[next(iter(self._entries))]
+            self._entries[token] = (expires, user)
+
+    def invalidate(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in [k for k, v in self._entries.items() if v[1].id == user_id]:
+                del self._entries[key]
+
+
 class CouchAPI(API):
     """Abstract Base Class for interfacing with couch Document classes"""
 
-    db = APIField(couchdb.Database)
+    db = APIField(blackbook.database.couch.database.CouchDatabase)
     model = APIType(couchdb.mapping.Document)
 
+    # template fields PUT and PATCH can change
+    update_fields = ()
+
+    # where the endpoint is mounted
+    endpoint = "/api/"  # TODO: use config API_ROOT
+
+    # shared by every view, so a token looked up by one endpoint is cached for all of them
+    session_cache = SessionCache(
+        max_age=current_app.config.get('SESSION_CACHE_TTL') or 60,
+        max_entries=current_app.config.get('SESSION_CACHE_SIZE') or 10000
+    )
+
+    # extra options for listing queries, e.g. stale=update_after, so they don't wait on view index builds
+    listing_view_options = {"stale": current_app.config["COUCHDB_STALE_VIEWS"]} \
+        if current_app.config.get("COUCHDB_STALE_VIEWS") else {}
+
     def _generate_document(self, *args, href='/', **kwargs):
         """
         Generate a document
@@ -33,16 +126,56 @@ class CouchAPI(API):
         """
         raise NotImplementedError()
 
-    def _get_authenticated_user(self, user_api, session_api):
+    def _get_authenticated_user(self):
+        # memoized for the rest of the request, then cached per token across requests
+        if "authenticated_user" in g:
+            return g.authenticated_user
         user = None
-        if session.get("id"):
-            sessions_by_token = session_api.model.by_token(key=session["id"])
-            if sessions_by_token.rows:
-                get_session = sessions_by_token.rows[0]
-                if get_session.expiry > datetime.datetime.now():
-                    user = user_api.model.load(self.db, get_session.user)
+        token = session.get("id")
+        if token:
+            user = self.session_cache.get(token)
+            if user is None:
+                sessions_by_token = blackbook.database.couch.models.Session.by_token(self.db.db, key=token)
+                if sessions_by_token.rows:
+                    get_session = sessions_by_token.rows[0]
+                    if get_session.expiry > datetime.datetime.now():
+                        user = self._read_one(blackbook.database.couch.models.User, get_session.user)
+                        if user is not None:
+                            if user.groups:
+                                user.load_groups(self.db.read(blackbook.database.couch.models.Group, user.groups))
+                            self.session_cache.set(token, user, get_session.expiry)
+        g.authenticated_user = user
         return user
 
+    def _read_one(self, model, _id):
+        try:
+            return self.db.read(model, _id)[0]
+        except blackbook.database.NotFoundError:
+            return None
+
+    def _template_values(self, fields=None):
+        """
+        Get the values submitted in a collection+json template.
+        :param fields: Optional. The field names to get, defaults to update_fields
+        :return: dict of field name -> value, empty if the body isn't a template
+        """
+        fields = self.update_fields if fields is None else fields
+        body = request.get_json(silent=True)
+        try:
+            return {
+                item["name"]: item.get("value") for item in body["template"]["data"]
+                if item.get("name") in fields
+            }
+        except (TypeError, KeyError, AttributeError):
+            return {}
+
+    def _request_origin_consistent(self):
+        """
+        Check the request's XSRF token against the session's, see blackbook.tools.tools.check_angular_xsrf().
+        :return: bool
+        """
+        return blackbook.tools.tools.check_angular_xsrf()
+
     def delete(self, *args, **kwargs):
         raise NotImplementedError()
 
@@ -72,7 +205,7 @@ class Contact(CouchAPI):
     """
     Contact API class
 
-    /contact/[?[after=<id>][before=<id>][q=<query>][name=<name>][surname=<surname>][email=<email>][phone=<phone_number>]]
+    /contact/[?[after=<cursor>][before=<cursor>][q=<query>][name=<name>][surname=<surname>][email=<email>][phone=<phone_number>]]
 
         GET: retrieve list of contacts
             - requires authenticated admin user
@@ -214,7 +347,7 @@ class Contact(CouchAPI):
                         - collection.error will contain 404 error code, title and message
 
 
-    /user/<user_id>/contacts/[?[page=<pagenum>][q=<query>][name=<name>][surname=<surname>][email=<email>][phone=<phone_number>]]
+    /user/<user_id>/contacts/[?[after=<cursor>][before=<cursor>][q=<query>][name=<name>][surname=<surname>][email=<email>][phone=<phone_number>]]
 
         GET: retrieve list of contacts for a particular user
             - only displays contacts a specific user has created
@@ -275,9 +408,113 @@ class Contact(CouchAPI):
 
     """
 
+    endpoint = "/api/contact/"  # TODO: use config API_ROOT
+
+    # fields items show, and the templates' fields
+    properties = (("name_first", "First Name"), ("name_last", "Last Name"))
+
+    # dbname -> api_spec
+    _api_specs = {}
+
     def __init__(self, db):
         super(Contact, self).__init__(db, blackbook.database.couch.models.Contact)
 
+    @property
+    def api_spec(self):
+        """
+        The endpoint, its properties and its templates, with the permissions to see each of them.
+
+        Permissions are named after the database, so the spec is built once per database name:
+        <dbname>.read.contact lets a user see every contact's properties, <dbname>.read.contact.<property>
+        one of them, and <dbname>.update.contact the update template. Owners see their own contacts regardless.
+        :return: dict
+        """
+        spec = self._api_specs.get(self.db.dbname)
+        if spec is None:
+            model_permission = ".".join([self.db.dbname, "{action}", self.model.__name__.lower()])
+            spec = {
+                "endpoint": self.endpoint,
+                "properties": [
+                    {
+                        "name": name,
+                        "prompt": prompt,
+                        "permissions": {
+                            "public": False,
+                            "read": [
+                                model_permission.format(action="read"),
+                                ".".join([model_permission.format(action="read"), name])
+                            ]
+                        }
+                    } for name, prompt in self.properties
+                ],
+                "template_meta": {
+                    "create": {"permissions": {"public": True, "read": []}},
+                    "update": {"permissions": {"public": False, "read": [model_permission.format(action="update")]}}
+                }
+            }
+            self._api_specs[self.db.dbname] = spec
+        return spec
+
+    # query arg -> (view name, key normalizer), normalization must match the views in design_docs/contact.json
+    query_views = collections.OrderedDict([
+        ("name", ("by_name", lambda value: value.lower())),
+        ("surname", ("by_surname", lambda value: value.lower())),
+        ("email", ("by_email", lambda value: value.lower())),
+        ("phone", ("by_phone_number", lambda value: re.sub(r"\D", "", value)))
+    ])
+
+    # listing view -> cards view with the same keys, listing the contacts along with what they own
+    card_views = {"all": "cards", "by_user": "cards_by_user"}
+    contact_cards = bool(current_app.config.get("COUCHDB_CONTACT_CARDS"))
+
+    def _paginator(self, view_name, key=None, per_page=10):
+        """
+        Make a paginator for a listing view, or for its cards view if config option COUCHDB_CONTACT_CARDS is set.
+        :param view_name: "all" or "by_user"
+        :return: KeysetPaginator, or CardPaginator
+        """
+        if self.contact_cards:
+            return CardPaginator(
+                getattr(self.model, self.card_views[view_name]), key=key, per_page=per_page,
+                types=self.db.type_map, **self.listing_view_options
+            )
+        return KeysetPaginator(getattr(self.model, view_name), key=key, per_page=per_page, **self.listing_view_options)
+
+    def _query_by_fields(self, args, owner=None, limit=None):
+        """
+        Look up contacts through the search index for the q query arg and the indexed views
+        for the name, surname, email and phone query args.
+
+        Multiple args narrow the results down (AND).
+        :param args: The request args
+        :param owner: Optional. Only return contacts belonging to this User.id
+        :param limit: Optional. The max number of search results, i.e. the best matches for q
+        :return: A list of contacts, or None if none of the query args were given.
+        """
+        results = None
+        if args.get("q"):
+            # ranked, so it goes first and everything else only narrows it down
+            results = collections.OrderedDict(
+                (contact.doc_id, contact)
+                for contact in self.db.search(args["q"], model=self.model, owner=owner, limit=limit)
+            )
+        for arg, (view_name, normalize) in self.query_views.items():
+            value = args.get(arg)
+            if not value:
+                continue
+            view = getattr(self.model, view_name)
+            rows = view(self.db.db, key=normalize(value), include_docs=True, **self.listing_view_options)
+            found = collections.OrderedDict(
+                (contact.doc_id, contact) for contact in rows
+                # linked rows for since-deleted contacts wrap as empty documents
+                if contact.type == "contact" and (owner is None or contact.user == owner)
+            )
+            if results is None:
+                results = found
+            else:
+                results = collections.OrderedDict((k, v) for k, v in results.items() if k in found)
+        return None if results is None else list(results.values())
+
     def _generate_document(self, *args, href='/contact/', **kwargs):
         """
         Generate a Contact document representation.
@@ -287,47 +524,16 @@ class Contact(CouchAPI):
         return document
 
     def delete(self, contact_id=None, *args, **kwargs):
-        user_api = User(self.db)
-        session_api = Session(self.db)
-
-        user = self._get_authenticated_user(user_api, session_api)
-
         if not blackbook.tools.tools.check_angular_xsrf():
-            document = self._generate_document()
-            document.error = blackbook.api.errors.APIBadRequestError()
+            # TODO: handle bad CSRF -- APIBadRequestError?
             pass
 
-        if not user:
-            document = self._generate_document()
-            document.error = blackbook.api.errors.APIUnauthorizedError()
-            return Response(response=str(document), status=int(document.error.code), mimetype=document.mimetype)
-
-        if contact_id:
-            contact = self.model.load(id=contact_id)
-
-            if (not contact) or \
-                    (
-                        contact.user != user.id and
-                        not user.has_permission(
-                            self.db,
-                            ".".join([self.db.name, "delete", self.model.__name__.lower()])
-                        )
-                    ):
-                document = self._generate_document()
-                document.error = blackbook.api.errors.APINotFoundError()
-                return Response(response=str(document), status=int(document.error.code), mimetype=document.mimetype)
-            else:
-                self.db.delete(contact)
-                return Response(response="", status=204)
+        return self._delete(contact_id)
 
     def get(self, contact_id=None, user_id=None):
 
-        user_api = User(self.db)
-        session_api = Session(self.db)
-
-        user = self._get_authenticated_user(user_api, session_api)
+        user = self._get_authenticated_user()
         document = self._generate_document()
-        spec_properties = self.api_spec["properties"]
 
         if not self._request_origin_consistent():
             # TODO: handle bad CSRF -- APIBadRequestError?
@@ -338,110 +544,136 @@ class Contact(CouchAPI):
             return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
 
         if contact_id:
-            contact = self.model.load(id=contact_id)
-            template_data = self.api_spec["template_data"]["update"]
+            contact = self._read_one(self.model, contact_id)
+            template = blackbook.api.basecollection.ContactUpdateTemplate
             template_meta = self.api_spec["template_meta"]["update"]
 
             if (not contact) or \
                     (
                         contact.user != user.id and
-                        not user.has_permission(
-                            self.db,
-                            ".".join([self.db.name, "read", self.model.__name__.lower()])
-                        )
+                        not user.has_permission(".".join([self.db.dbname, "read", self.model.__name__.lower()]))
                     ):
                 document.error = blackbook.api.errors.APINotFoundError()
                 return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
             else:
                 contacts = [contact]
+                owned = self.db.read_owned(contacts)
         else:
-            prev_viewargs = {}
-            next_viewargs = {}
-            _range = {}
-            template_data = self.api_spec["template_data"]["create"]
+            template = blackbook.api.basecollection.ContactCreateTemplate
             template_meta = self.api_spec["template_meta"]["create"]
-
-            if request.args.get("end"):
-                _range["endkey_docid"] = request.args.get("end")
-            if request.args.get("start"):
-                _range["startkey_docid"] = request.args.get("start")
-
-            if (request.args.get("start") and not request.args.get("end")) or \
-                    (request.args.get("end") and not request.args.get("start")):
-                _range["limit"] = current_app.config.get("API_PAGINATION_PER_PAGE") or 10
+            per_page = current_app.config.get("API_PAGINATION_PER_PAGE") or 10
 
             if user_id:
-                if not user_api.model.load(self.db, id=user_id):
+                if not self._read_one(blackbook.database.couch.models.User, user_id):
                     document.error = blackbook.api.errors.APINotFoundError()
                     return Response(response=str(document), status=int(document.error.code), mimetype=document.mimetype)
                 if user.id == user_id or user.has_permission(
-                        ".".join([self.db.name, "read", user_api.model.__name__.lower()])):
-                    contacts = self.model.by_user(key=user_id, **_range)
-                    viewfunc = self.model.by_user
-                    if _range.get("endkey_docid"):
-                        next_viewargs.update(key=user_id, startkey_docid=_range["endkey_docid"], limit=2)
-                    if _range.get("startkey_docid"):
-                        prev_viewargs.update(key=user_id, endkey_docid=_range["startkey_docid"], limit=2)
+                        ".".join([self.db.dbname, "read", blackbook.database.couch.models.User.__name__.lower()])):
+                    paginator = self._paginator("by_user", key=user_id, per_page=per_page)
+                    owner = user_id
                 else:
                     document.error = blackbook.api.errors.APINotFoundError()
                     return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
-            elif user.has_permission(".".join([self.db.name, "read", self.model.__name__.lower()])):
-                contacts = self.model.view(self.db, "_all_docs", **_range)
-                viewfunc = self.model.view
-                if _range.get("endkey_docid"):
-                    next_viewargs.update(viewname="_all_docs", startkey_docid=_range["endkey_docid"], limit=2)
-                if _range.get("startkey_docid"):
-                    prev_viewargs.update(viewname="_all_docs", endkey_docid=_range["startkey_docid"], limit=2)
+            elif user.has_permission(".".join([self.db.dbname, "read", self.model.__name__.lower()])):
+                paginator = self._paginator("all", per_page=per_page)
+                owner = None
             else:
-                contacts = self.model.by_user(key=user.id, **_range)
-                viewfunc = self.model.by_user
-                if _range.get("endkey_docid"):
-                    next_viewargs.update(key=user.id, startkey_docid=_range["endkey_docid"], limit=2)
-                if _range.get("startkey_docid"):
-                    prev_viewargs.update(key=user.id, endkey_docid=_range["startkey_docid"], limit=2)
-                
-            if _range.get("startkey_docid"):
-                # get prev page link, if applicable
-                prev_contacts_endkey = viewfunc(self.db, **prev_viewargs)
-                if prev_contacts_endkey.rows:
-                    key = prev_contacts_endkey.rows[0].id
-                    url = request.url_rule + "?end={docid}".format(docid=key)
-                    document.links.append(collection_plus_json.Link(href=url, rel="prev", name="Previous", prompt="<"))
-            if _range.get("endkey_docid"):
-                # get next page link, if applicable
-                next_contacts_startkey = viewfunc(self.db, **next_viewargs)
-                if next_contacts_startkey.rows:
-                    key = next_contacts_startkey.rows[1].id
-                    url = request.url_rule + "?start={docid}".format(docid=key)
-                    document.links.append(collection_plus_json.Link(href=url, rel="next", name="Next", prompt=">"))
-
+                paginator = self._paginator("by_user", key=user.id, per_page=per_page)
+                owner = user.id
+
+            try:
+                queried = self._query_by_fields(request.args, owner=owner, limit=per_page)
+            except blackbook.database.DatabaseNotReadyError:
+                # the search index is being built
+                document.error = blackbook.api.errors.APIServiceUnavailableError()
+                return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
+            if queried is not None:
+                # indexed lookups are narrow enough to skip pagination
+                contacts = queried
+                owned = self.db.read_owned(contacts)
+            else:
+                try:
+                    page = paginator.page(
+                        self.db.db, after=request.args.get("after"), before=request.args.get("before")
+                    )
+                except ValueError:
+                    document.error = blackbook.api.errors.APIBadRequestError()
+                    return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
+                contacts = page.items
+                # cards come with what the contacts own, otherwise it takes one more request
+                owned = page.owned if page.owned is not None else self.db.read_owned(contacts)
+                self._add_page_links(document, page, request.base_url)
+
+        return self._render_contacts(document, user, contacts, template, template_meta, owned=owned)
+
+    @staticmethod
+    def _add_page_links(document, page, base_url):
+        if page.prev_cursor:
+            url = "{base}?before={cursor}".format(base=base_url, cursor=page.prev_cursor)
+            document.links.append(collection_plus_json.Link(href=url, rel="prev", name="Previous", prompt="<"))
+        if page.next_cursor:
+            url = "{base}?after={cursor}".format(base=base_url, cursor=page.next_cursor)
+            document.links.append(collection_plus_json.Link(href=url, rel="next", name="Next", prompt=">"))
+
+    def _render_contacts(self, document, user, contacts, template, template_meta, owned=None):
+        """
+        Render contacts, with a template for the user to create or update them with if they may see it.
+        :param template: The template class, ContactCreateTemplate or ContactUpdateTemplate
+        :param owned: Optional. dict of id -> couch model instance, the contacts' addresses, emails and phone numbers
+        """
+        api_spec = self.api_spec
+        owner_href = "{endpoint}{id}/".format(endpoint=User.endpoint, id=user.id)
         for contact in contacts:
             document.items.append(
                 collection_plus_json.Item(
-                    href="{endpoint}{id}/".format(endpoint=self.api_spec["endpoint"], id=contact.id),
+                    href="{endpoint}{id}/".format(endpoint=api_spec["endpoint"], id=contact.doc_id),
                     data=[
-                        prop["data"] for prop in spec_properties
-                        # owning users have <dbname>.read.<modelname>.<propertyname>
-                        # admin users have <dbname>.read.<modelname>
-                        if prop["permissions"]["public"] or user.has_permission(*prop["permisisons"]["read"])
-                        ],
+                        collection_plus_json.Data(name=prop["name"], prompt=prop["prompt"],
+                                                  value=getattr(contact, prop["name"]))
+                        for prop in api_spec["properties"]
+                        # owning users see their own contacts
+                        # other users need <dbname>.read.<modelname> or <dbname>.read.<modelname>.<propertyname>
+                        if prop["permissions"]["public"] or contact.user == user.id or
+                        user.has_permission(*prop["permissions"]["read"], operator="or")
+                        ] + self._owned_data(contact, owned),
                     links=[
                         collection_plus_json.Link(
-                            href="{endpoint}{id}/".format(endpoint=user_api.api_spec["endpoint"], id=user.id),
+                            href=owner_href,
                             rel="owner",
-                            prompt="Created by {name}".format(user.name)
+                            prompt="Created by {name}".format(name=user.display_name)
                         )
                     ]
                 )
             )
 
-        # authenticated users have permission <dbname>.update.<modelname>
-        # therefore they can see the update template
+        # owners may update their own contacts, other users need permission <dbname>.update.<modelname>
         if template_meta["permissions"]["public"] or \
-                user.has_permission(self.db, *template_meta["permissions"]["read"]):
-            document.template = collection_plus_json.Template(data=template_data)
+                all(contact.user == user.id for contact in contacts) or \
+                user.has_permission(*template_meta["permissions"]["read"]):
+            document.template = blackbook.api.basecollection.templates.get(template)
 
-        return Response(response=str(document), mimetype=document.mimetype)
+        return Response(response=document.iter_json(), mimetype=document.mimetype)
+
+    @staticmethod
+    def _owned_data(contact, owned):
+        """
+        Item data for a contact's addresses, emails and phone numbers.
+        :param owned: dict of id -> couch model instance, e.g. from CouchDatabase.read_owned(), or None to leave them out
+        :return: list of collection+json Data
+        """
+        if owned is None:
+            return []
+        return [
+            collection_plus_json.Data(
+                name=field,
+                value=[
+                    {k: v for k, v in owned[i].unwrap().items() if not k.startswith("_")}
+                    # only what still belongs to the contact, it can list ids of documents moved elsewhere since
+                    for i in getattr(contact, field) if i in owned and contact.doc_id in owned[i].owner
+                ]
+            )
+            for field in ("addresses", "emails", "phone_numbers")
+        ]
 
     def head(self, *args, **kwargs):
         pass
@@ -449,14 +681,118 @@ class Contact(CouchAPI):
     def options(self, *args, **kwargs):
         pass
 
-    def patch(self, *args, **kwargs):
-        pass
+    def patch(self, contact_id=None, user_id=None):
+        return self._update(contact_id, complete=False)
 
     def post(self, *args, **kwargs):
         pass
 
-    def put(self, *args, **kwargs):
-        pass
+    def put(self, contact_id=None, user_id=None):
+        return self._update(contact_id, complete=True)
+
+    # template fields PUT and PATCH can change
+    update_fields = ("name_first", "name_last")
+
+    def _prepare_update(self, document, user, contact, values, complete):
+        """
+        Check that a user may update a contact with some values, and apply them to it.
+        :param complete: Whether every one of update_fields is required (PUT), or any of them (PATCH)
+        :return: An error Response, or None if the contact is ready to save
+        """
+        if not user:
+            document.error = blackbook.api.errors.APIUnauthorizedError()
+        elif (not contact) or \
+                (
+                    contact.user != user.id and
+                    not user.has_permission(".".join([self.db.dbname, "update", self.model.__name__.lower()]))
+                ):
+            document.error = blackbook.api.errors.APINotFoundError()
+        elif not values or (complete and len(values) < len(self.update_fields)):
+            document.error = blackbook.api.errors.APIBadRequestError()
+        else:
+            for field, value in values.items():
+                setattr(contact, field, value)
+            return None
+        return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
+
+    def _update(self, contact_id, complete):
+        user = self._get_authenticated_user()
+        contact = None
+        if user and contact_id:
+            try:
+                contact = self.db.read(self.model, contact_id)[0]
+            except blackbook.database.NotFoundError:
+                pass
+        document = self._generate_document()
+
+        error = self._prepare_update(document, user, contact, self._template_values(), complete)
+        if error is not None:
+            return error
+        try:
+            # only the changed fields are written, and concurrent edits to other fields are kept
+            contact = self.db.update(contact)
+        except blackbook.database.DatabaseError as e:
+            return self._update_error(document, e)
+
+        template = blackbook.api.basecollection.ContactUpdateTemplate
+        template_meta = self.api_spec["template_meta"]["update"]
+        return self._render_contacts(
+            document, user, [contact], template, template_meta, owned=self.db.read_owned([contact])
+        )
+
+    @staticmethod
+    def _update_error(document, error):
+        """
+        Get the error Response for a contact that couldn't be saved.
+        :param error: The DatabaseError raised by Database.update()
+        """
+        if isinstance(error, blackbook.database.NotFoundError):
+            # deleted by someone else meanwhile
+            document.error = blackbook.api.errors.APINotFoundError()
+        elif isinstance(error, blackbook.database.ConflictError):
+            # still being changed by others after every retry
+            document.error = blackbook.api.errors.APIConflictError()
+        else:
+            document.error = blackbook.api.errors.APIServiceUnavailableError()
+        return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
+
+    def _prepare_delete(self, document, user, contact):
+        """
+        Check that a user may delete a contact.
+        :return: An error Response, or None if the contact may be deleted
+        """
+        if not user:
+            document.error = blackbook.api.errors.APIUnauthorizedError()
+        elif (not contact) or \
+                (
+                    contact.user != user.id and
+                    not user.has_permission(".".join([self.db.dbname, "delete", self.model.__name__.lower()]))
+                ):
+            document.error = blackbook.api.errors.APINotFoundError()
+        else:
+            return None
+        return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
+
+    def _delete(self, contact_id):
+        user = self._get_authenticated_user()
+        contact = None
+        if user and contact_id:
+            try:
+                contact = self.db.read(self.model, contact_id)[0]
+            except blackbook.database.NotFoundError:
+                pass
+        document = self._generate_document()
+
+        error = self._prepare_delete(document, user, contact)
+        if error is not None:
+            return error
+        try:
+            # the contact's addresses, emails and phone numbers go with it, and it is taken off its user
+            self.db.delete_cascade(contact)
+        except blackbook.database.NotFoundError:
+            # deleted by someone else meanwhile
+            pass
+        return Response(response="", status=204)
 
     def search(self, *args, **kwargs):
         pass
@@ -561,17 +897,45 @@ class Session(CouchAPI):
                     - collection.error will contain 404 error code, title and message
     """
 
+    endpoint = "/api/session/"  # TODO: use config API_ROOT
+
     def __init__(self, db):
         super(Session, self).__init__(db, blackbook.database.couch.models.Session)
 
-    def _generate_document(self, *args, **kwargs):
-        pass
+    def _generate_document(self, *args, href='/session/', **kwargs):
+        """
+        Generate a Session document representation.
+        :param **kwargs:
+        """
+        document = blackbook.api.basecollection.SessionCollection(href=href)
+        return document
 
     def delete(self, *args, **kwargs):
-        pass
+        user = self._get_authenticated_user()
+
+        if not user:
+            document = self._generate_document()
+            document.error = blackbook.api.errors.APIUnauthorizedError()
+            return Response(response=str(document), status=int(document.error.code), mimetype=document.mimetype)
+
+        token = session.pop("id")
+        for user_session in self.model.by_token(self.db.db, key=token).rows:
+            self.db.db.delete(user_session)
+        self.session_cache.invalidate(token)
+        g.authenticated_user = None
+        return Response(response="", status=204)
 
     def get(self, *args, **kwargs):
-        pass
+        user = self._get_authenticated_user()
+        document = self._generate_document()
+
+        if not user:
+            # the login form
+            document.template = blackbook.api.basecollection.templates.get(
+                blackbook.api.basecollection.SessionCreateTemplate
+            )
+
+        return Response(response=document.iter_json(), mimetype=document.mimetype)
 
     def head(self, *args, **kwargs):
         pass
@@ -582,8 +946,56 @@ class Session(CouchAPI):
     def patch(self, *args, **kwargs):
         pass
 
+    # template fields POST logs in with
+    login_fields = ("email", "password")
+
     def post(self, *args, **kwargs):
-        pass
+        document = self._generate_document()
+        values = self._template_values(self.login_fields)
+        if not all(values.get(field) for field in self.login_fields):
+            document.error = blackbook.api.errors.APIBadRequestError()
+        else:
+            users = blackbook.database.couch.models.User.by_email(self.db.db, key=values["email"].lower()).rows
+            # the password is checked in the hasher's process pool, raising PasswordHasherBusyError
+            # (429 Too Many Requests) if too many logins are already waiting on it
+            user = next((user for user in users if user.check_password(values["password"])), None)
+            if user is None:
+                document.error = blackbook.api.errors.APIUnauthorizedError()
+            else:
+                return self._login(document, user)
+
+        document.template = blackbook.api.basecollection.templates.get(
+            blackbook.api.basecollection.SessionCreateTemplate
+        )
+        return Response(str(document), status=int(document.error.code), mimetype=document.mimetype)
+
+    def _login(self, document, user):
+        """
+        Start a session for a user whose password checked out.
+        :return: The 201 Response
+        """
+        user_session = self.model(user=user.doc_id, token=secrets.token_urlsafe(32))
+        user_session._data["_id"] = user_session.id
+        user_session.store(self.db.db)
+        session["id"] = user_session.token
+        g.authenticated_user = user
+
+        document.items.append(
+            collection_plus_json.Item(
+                href="{endpoint}{token}/".format(endpoint=self.endpoint, token=user_session.token),
+                data=[
+                    collection_plus_json.Data(name="expiry", prompt="Expires", value=user_session.expiry.isoformat())
+                ],
+                links=[
+                    collection_plus_json.Link(
+                        href="{endpoint}{id}/".format(endpoint=User.endpoint, id=user.doc_id),
+                        rel="owner",
+                        prompt=user.display_name
+                    )
+                ]
+            )
+        )
+        return Response(response=document.iter_json(), status=201, mimetype=document.mimetype)
 
     def put(self, *args, **kwargs):
         pass
@@ -755,6 +1167,8 @@ class User(CouchAPI):
 
     """
 
+    endpoint = "/api/user/"  # TODO: use config API_ROOT
+
     def __init__(self, db):
         super(User, self).__init__(db, blackbook.database.couch.models.User)
 
@@ -786,12 +1200,35 @@ class User(CouchAPI):
         pass
 
 
-def init_api(app):
+def init_api(app, database=None, contact_api=Contact):
+
+    database = database or blackbook.database.couch.database.init_db(app)
+    # cached sessions carry their user's permissions and groups, drop them when the user changes
+    database.user_listeners.append(CouchAPI.session_cache.invalidate_user)
 
-    database = blackbook.database.couch.database.init_db(app)
+    # for User.set_password() and check_password(), e.g. logging in with Session.post();
+    # its processes only start when a password is first hashed or checked
+    password_hasher = blackbook.tools.hashing.PasswordHasher(
+        workers=app.config.get("PASSWORD_HASH_WORKERS"),
+        max_pending=app.config.get("PASSWORD_HASH_QUEUE") or 32
+    )
+    blackbook.database.models.User.password_hasher = password_hasher
+    blackbook.database.couch.models.User.password_hasher = password_hasher
 
     api_blueprint = Blueprint("api", __name__, url_prefix="/api")  # TODO: use config API_ROOT
 
+    def hasher_busy(error):
+        document = collection_plus_json.Collection(
+            href="/api/",  # TODO: use config API_ROOT
+            error=blackbook.api.errors.APITooManyRequestsError()
+        )
+        return Response(
+            response=str(document),
+            status=int(document.error.code),
+            mimetype=document.mimetype,
+            headers={"Retry-After": "1"}
+        )
+
     def api_root():
         document = collection_plus_json.Collection(
             href="/api/",  # TODO: use config API_ROOT
@@ -802,17 +1239,35 @@ def init_api(app):
             ]
         )
         if request.method in {"GET", "OPTIONS"}:
-            return Response(response=document, mimetype=document.mimetype)
+            return Response(response=document.iter_json(), mimetype=document.mimetype)
         else:
             return Response()
 
-    contact_view = Contact(database).as_view('contact_api')
+    def health():
+        # readiness probe, one request to the database and no file reads
+        try:
+            ready = database.is_setup
+        except (blackbook.database.DatabaseError, couchdb.HTTPError, OSError):
+            ready = False
+        return Response(
+            response=json.dumps({"ready": ready}),
+            status=200 if ready else 503,
+            mimetype="application/json"
+        )
+
+    contact_view = contact_api.as_view('contact_api', database)
+    session_view = Session.as_view('session_api', database)
 
+    api_blueprint.register_error_handler(blackbook.tools.hashing.PasswordHasherBusyError, hasher_busy)
     api_blueprint.add_url_rule('/', view_func=api_root, methods=["GET", "HEAD", "OPTIONS"])
-    api_blueprint.add_url_rule('/contact/', defaults={'user_id': None}, view_func=contact_view, methods=["GET", "POST"])
-    api_blueprint.add_url_rule('/contact/<contact_id>/', defaults={'user_id': None, 'contact_id': None},
+    api_blueprint.add_url_rule('/health/', view_func=health, methods=["GET", "HEAD"])
+    api_blueprint.add_url_rule('/contact/', defaults={'contact_id': None, 'user_id': None},
+                               view_func=contact_view, methods=["GET", "POST"])
+    api_blueprint.add_url_rule('/contact/<contact_id>/', defaults={'user_id': None},
                                view_func=contact_view, methods=["GET", "PATCH", "PUT", "DELETE"])
-    api_blueprint.add_url_rule('/user/<user_id>/contacts/', defaults={'user_id': None},
+    api_blueprint.add_url_rule('/user/<user_id>/contacts/', defaults={'contact_id': None},
                                view_func=contact_view, methods=["GET", "POST"])
+    api_blueprint.add_url_rule('/session/', view_func=session_view, methods=["GET", "POST"])
+    api_blueprint.add_url_rule('/session/<token>/', view_func=session_view, methods=["DELETE"])
 
     return api_blueprint
@@ -1,18 +1,65 @@
 import blackbook.database
 import blackbook.database.models as common_models
 import blackbook.database.couch.models as couch_models
+import blackbook.database.couch.pool
+import atexit
+import collections
 import couchdb
+import hashlib
 import json
 import glob
 import os.path
+import random
+import threading
+import time
 
+from blackbook.lib.search import InvertedIndex
 from flask import current_app
 
 __author__ = 'ievans3024'
 
+DESIGN_DOC_PATH = os.path.join(os.path.dirname(__file__), 'design_docs', '*.json')
+
+# design doc field holding a hash of the rest of the doc, compared to tell if the spec changed
+DESIGN_HASH_FIELD = 'spec_hash'
+
+_design_docs = {}  # path -> design docs, see load_design_docs()
+
+# applies a dict of fields to the latest revision of a document, see design_docs/document.json
+UPDATE_HANDLER = 'document/patch'
+
+
+def load_design_docs(path=DESIGN_DOC_PATH):
+    """
+    Load design docs from json files, once per process.
+
+    Each doc gets a DESIGN_HASH_FIELD with a hash of its contents, so checking
+    whether the docs in a database match only means comparing hashes.
+    :param path: Optional. A glob pattern for the json files.
+    :return: A tuple of design docs, shared by every caller so they must not be modified.
+    """
+    if path not in _design_docs:
+        designs = []
+        for filename in sorted(glob.glob(path)):
+            with open(filename) as docfile:
+                design = json.load(docfile)
+            design.pop(DESIGN_HASH_FIELD, None)
+            content = json.dumps(design, sort_keys=True, separators=(',', ':')).encode('utf-8')
+            design[DESIGN_HASH_FIELD] = hashlib.sha1(content).hexdigest()
+            designs.append(design)
+        _design_docs[path] = tuple(designs)
+    return _design_docs[path]
+
+
+class CouchDatabaseBase(blackbook.database.Database):
+    """
+    What the CouchDB backends share, whatever they talk to CouchDB through: the mapping between
+    common and couch models, configuration, and the logic that doesn't make requests itself.
+    That covers cascading deletes, replication, the search index and its indexer, and updates.
+
+    Subclasses make the requests, see CouchDatabase and blackbook.database.aiocouch.database.AsyncCouchDatabase.
+    """
 
-class CouchDatabase(blackbook.database.Database):
-    
     model_map = {
         common_models.Contact: couch_models.Contact,
         common_models.ContactAddress: couch_models.ContactAddress,
@@ -25,10 +72,429 @@ class CouchDatabase(blackbook.database.Database):
 
     type_map = {v.__name__.lower(): v for k, v in model_map.items()}
 
+    common_map = {v: k for k, v in model_map.items()}
+
+    # document type -> (field, weight) pairs indexed for full-text search, all keyed by contact id
+    search_fields = {
+        'contact': (('name_first', 3), ('name_last', 3)),
+        'contactaddress': (('line_1', 1), ('line_2', 1), ('city', 1), ('state', 1), ('zip', 1), ('country', 1)),
+        'contactemail': (('address', 2),),
+        'contactphone': (('number', 2),)
+    }
+
     def __init__(self):
         self.dbname = current_app.config.get('COUCHDB_NAME') or 'blackbook'
+        self.design_docs = load_design_docs()
+        self.warm_up_views = current_app.config.get('COUCHDB_WARM_UP_VIEWS', True)
+        self.batch_size = current_app.config.get('COUCHDB_BULK_BATCH_SIZE') or 500
+        self.search_index_path = current_app.config.get('SEARCH_INDEX_PATH')
+        self.search_index_save_every = current_app.config.get('SEARCH_INDEX_SAVE_EVERY') or 1000
+        self.search_index_poll_interval = current_app.config.get('SEARCH_INDEX_POLL_INTERVAL') or 5
+        self.search_index = None
+        self._search_index_changes = 0
+        self._search_indexer = None
+        self._search_indexer_lock = threading.Lock()
+        self._search_indexer_stop = threading.Event()
+        # called with a user's id after the user is updated or deleted, e.g. to drop cached sessions
+        self.user_listeners = []
+        if self.search_index_path:
+            if os.path.exists(self.search_index_path):
+                self.search_index = InvertedIndex.load(self.search_index_path)
+            atexit.register(self.save_search_index)
+        retries = current_app.config.get('COUCHDB_READ_RETRIES')
+        backoff = current_app.config.get('COUCHDB_RETRY_BACKOFF') or 0.1
+        self.retry_backoff = backoff
+        # seconds to wait before each retry of a failed read
+        self.read_retry_delays = [backoff * 2 ** attempt for attempt in range(3 if retries is None else retries)]
+        self.update_handler = current_app.config.get('COUCHDB_UPDATE_HANDLER', True)
+        self.update_retries = current_app.config.get('COUCHDB_UPDATE_RETRIES')
+        if self.update_retries is None:
+            self.update_retries = 10
+
+    def _to_document(self, data):
+        model = self.model_map.get(data.__class__)
+        if model is None:
+            raise blackbook.database.InvalidModelError()
+
+        data.touch()
+        data_dict = data.serialize()
+        if data_dict.get('id') is None:
+            # let the couch model default a new id
+            del data_dict['id']
+
+        doc = model(**data_dict)
+        # the couch model's id is a plain field, the document's _id has to match it
+        # for reads by id, and for existing entries to be detected when creating
+        doc._data['_id'] = doc.id
+        return doc
+
+    @staticmethod
+    def _document_id(data):
+        if isinstance(data, couch_models.CouchModel):
+            return data.doc_id
+        return data.id
+
+    @staticmethod
+    def _cascade_owned(levels):
+        """
+        The ids owned by the last level of documents, that haven't been found yet.
+        """
+        found = set(i for level in levels for i in level)
+        return list(collections.OrderedDict.fromkeys(
+            i for doc in levels[-1].values() for i in doc.owns if i is not None and i not in found
+        ))
+
+    @staticmethod
+    def _cascade_level(parents, documents):
+        """
+        The documents that are still owned by one of their parents, so stale references aren't followed.
+        """
+        return collections.OrderedDict(
+            (i, doc) for i, doc in documents.items() if any(owner in parents for owner in doc.owner)
+        )
+
+    @staticmethod
+    def _cascade_references(levels):
+        """
+        Owners outside of the documents being deleted, mapped to the ids they reference among them.
+        """
+        found = set(i for level in levels for i in level)
+        referenced = collections.OrderedDict()
+        for level in levels:
+            for i, doc in level.items():
+                for owner in doc.owner:
+                    if owner is not None and owner not in found:
+                        referenced.setdefault(owner, []).append(i)
+        return referenced
+
+    @staticmethod
+    def _cascade_docs(deletes, owners, referenced):
+        """
+        The tombstones and dereferenced owners to write for a batch of delete_cascade().
+        """
+        docs = [{'_id': i, '_rev': doc._data['_rev'], '_deleted': True} for i, doc in deletes.items()]
+        for i, owner in owners.items():
+            for key in referenced[i]:
+                owner.dereference(key)
+            if owner.changed_fields:
+                owner.touch()
+                docs.append(owner.unwrap())
+        return docs
+
+    def _cascade_written(self, deletes, owners, failed, stats):
+        """
+        Account for a written batch of delete_cascade().
+
+        :param failed: dict of id -> error for the documents that weren't written
+        :return: list of ids that were changed by others and have to be read again
+        """
+        conflicted = []
+        for i, doc in deletes.items():
+            if i not in failed:
+                stats['deleted'] += 1
+                self._unindex_document(i, doc._data)
+                if doc.type == 'user':
+                    self._user_changed(i)
+        for i, owner in owners.items():
+            if i not in failed and owner.changed_fields:
+                stats['dereferenced'] += 1
+                self._index_document(i, owner._data)
+                owner.mark_clean()
+                if owner.type == 'user':
+                    self._user_changed(i)
+        for i, error in failed.items():
+            if error != 'conflict':
+                raise blackbook.database.DatabaseError(
+                    'There was an error deleting or dereferencing document "{doc_id}" (Error: {error})'.format(
+                        doc_id=i,
+                        error=error
+                    )
+                )
+            conflicted.append(i)
+        stats['conflicts'] += len(conflicted)
+        return conflicted
+
+    def _change_entry(self, change):
+        if change['id'].startswith('_design/'):
+            return None
+        if change.get('deleted'):
+            return None, change['id'], None
+        doc = change.get('doc') or {}
+        couch_model = self.type_map.get(doc.get('type'))
+        if couch_model is None:
+            return None
+        data = dict(doc)
+        data.pop('_rev', None)
+        data.pop('_id', None)
+        return self.common_map[couch_model], change['id'], data
+
+    def _replicated_docs(self, entries, revs, stats):
+        """
+        Build the _bulk_docs documents for a batch of replicated entries.
+
+        :param entries: (common model class, id, data) tuples, data is None for deleted entries
+        :param revs: A dict of id -> current revision here, for the documents to overwrite or delete
+        :param stats: The replication statistics dict, entries that can't be converted count as errors
+        :return: A list of documents, as dicts
+        """
+        docs = []
+        for model, doc_id, data in entries:
+            if data is None:
+                if doc_id in revs:
+                    docs.append({'_id': doc_id, '_rev': revs[doc_id], '_deleted': True})
+                continue
+            couch_model = self.model_map.get(model)
+            if couch_model is None:
+                stats['errors'] += 1
+                continue
+            doc = couch_model.wrap(dict(data, _id=doc_id)).unwrap()
+            if doc_id in revs:
+                doc['_rev'] = revs[doc_id]
+            else:
+                doc.pop('_rev', None)
+            docs.append(doc)
+        return docs
+
+    def _replicated(self, docs, written, removed, stats):
+        """
+        Count and index a written batch of replicated documents.
+
+        :param docs: The documents written, see _replicated_docs()
+        :param written: (success, id) tuples, one per document
+        :param removed: A dict of id -> document, the old versions of deleted documents
+        :param stats: The replication statistics dict
+        """
+        for doc, (success, doc_id) in zip(docs, written):
+            if not success:
+                # changed here since the revisions were read, the local change wins
+                stats['errors'] += 1
+            elif doc.get('_deleted'):
+                stats['deleted'] += 1
+                if doc_id in removed:
+                    self._unindex_document(doc_id, removed[doc_id])
+            else:
+                stats['written'] += 1
+                self._index_document(doc_id, doc)
+
+    def _index_document(self, doc_id, doc, index=None):
+        """
+        Add a contact, or contact address/email/phone, to the search index under its contact's id.
+        Does nothing for other document types, or if the index hasn't been built yet.
+        """
+        index = self.search_index if index is None else index
+        fields = self.search_fields.get(doc.get('type'))
+        if index is None or fields is None:
+            return
+        text = [(doc.get(field), weight) for field, weight in fields]
+        if doc.get('type') == 'contact':
+            index.add(doc_id, text, source=doc_id, scope=doc.get('user'))
+        elif doc.get('contact'):
+            index.add(doc.get('contact'), text, source=doc_id)
+        self._search_index_changed()
+
+    def _unindex_document(self, doc_id, doc):
+        if self.search_index is None or doc.get('type') not in self.search_fields:
+            return
+        if doc.get('type') == 'contact':
+            self.search_index.remove(doc_id)
+        elif doc.get('contact'):
+            self.search_index.remove(doc.get('contact'), source=doc_id)
+        self._search_index_changed()
+
+    def _search_index_changed(self):
+        # saved by the search indexer, off the request path
+        self._search_index_changes += 1
+
+    def start_search_indexer(self):
+        """
+        Keep the search index up to date in a background thread, unless one is already running.
+
+        The thread builds the index, or catches up the saved copy, from the _changes feed since the
+        update sequence saved with it. Then it reads the feed again every SEARCH_INDEX_POLL_INTERVAL
+        seconds, which picks up writes made by other processes too. The index is saved every
+        SEARCH_INDEX_SAVE_EVERY changes. search() starts it on first use.
+        """
+        with self._search_indexer_lock:
+            # a forked child doesn't inherit the thread, it gets its own
+            if self._search_indexer is None or not self._search_indexer.is_alive():
+                self._search_indexer_stop.clear()
+                self._search_indexer = threading.Thread(
+                    target=self._run_search_indexer, name='search-indexer', daemon=True
+                )
+                self._search_indexer.start()
+
+    def stop_search_indexer(self, timeout=None):
+        """
+        Stop the search indexer thread, and wait for it to finish.
+        :param timeout: Optional. Max seconds to wait
+        """
+        self._search_indexer_stop.set()
+        indexer = self._search_indexer
+        if indexer is not None and indexer is not threading.current_thread():
+            indexer.join(timeout)
+
+    def _run_search_indexer(self):
+        index = self.search_index if self.search_index is not None else InvertedIndex()
+        while not self._search_indexer_stop.is_set():
+            try:
+                self._catch_up_search_index(index)
+            except (couchdb.HTTPError, OSError, blackbook.database.DatabaseError):
+                # the database is unreachable for now, try again next time
+                pass
+            else:
+                built = self.search_index is not index
+                # searchable once it has caught up
+                self.search_index = index
+                if built or self._search_index_changes >= self.search_index_save_every:
+                    self.save_search_index()
+            self._search_indexer_stop.wait(self.search_index_poll_interval)
+
+    def _catch_up_search_index(self, index):
+        """
+        Apply everything changed since index.seq to a search index, batch_size changes per request.
+        """
+        while True:
+            feed = self._read_changes(index.seq, self.batch_size)
+            results = feed.get('results') or []
+            for change in results:
+                if change.get('deleted') or not change.get('doc'):
+                    index.discard(change['id'])
+                else:
+                    self._index_document(change['id'], change['doc'], index=index)
+            index.seq = feed.get('last_seq', index.seq)
+            if len(results) < self.batch_size:
+                # rather than in the first search after
+                index.sort_tokens()
+                return
+
+    def save_search_index(self):
+        """
+        Write the search index to config option SEARCH_INDEX_PATH, if it is set.
+        """
+        if self.search_index is not None and self.search_index_path:
+            self.search_index.save(self.search_index_path)
+        self._search_index_changes = 0
+
+    @staticmethod
+    def _view_paths(designs):
+        # each design doc's views share one index, so querying any of them builds them all
+        return collections.OrderedDict(
+            (design['_id'], '/'.join([design['_id'][len('_design/'):], sorted(design['views'])[0]]))
+            for design in designs if design.get('views')
+        )
+
+    def _indexing_progress(self, tasks):
+        """
+        Get the progress of view index builds for this database from a list of CouchDB active tasks.
+        :param tasks: The tasks, as listed by /_active_tasks
+        :return: A dict of design doc id -> percent done, averaged over shards
+        """
+        shards = collections.defaultdict(list)
+        for task in tasks:
+            # "blackbook", or "shards/<range>/blackbook.<suffix>" on a cluster
+            database = task.get('database', '').split('/')[-1].split('.')[0]
+            if task.get('type') == 'indexer' and database == self.dbname:
+                shards[task.get('design_document')].append(task.get('progress', 0))
+        return {design_id: sum(done) / len(done) for design_id, done in shards.items()}
+
+    def _update_plan(self, data):
+        """
+        Work out what update() has to write.
+        :return: tuple (document id, dict of changed fields, the document as loaded or None)
+        """
+        if isinstance(data, couch_models.CouchModel):
+            changes = data.changes()
+            loaded = dict(data._data) if data._data.get('_rev') else None
+            doc_id = self._document_id(data)
+        else:
+            changed = data.changed_fields
+            doc = self._to_document(data).unwrap()
+            # the common models' field names are the document keys, id is stored as _id
+            changes = {k: v for k, v in doc.items() if not k.startswith('_') and k in changed}
+            loaded = None
+            doc_id = data.id
+        if doc_id is None:
+            raise blackbook.database.NotFoundError()
+        return doc_id, changes, loaded
+
+    def _updated(self, data, doc):
+        self._index_document(doc['_id'], doc)
+        if doc.get('type') == 'user':
+            self._user_changed(doc['_id'])
+        if isinstance(data, couch_models.CouchModel):
+            data._data = doc
+            data.mark_clean()
+            return data
+        data.mark_clean()
+        return self.type_map[doc['type']].wrap(doc)
+
+    def _user_changed(self, user_id):
+        for listener in self.user_listeners:
+            listener(user_id)
+
+    def _update_conflict(self, doc_id, attempt, retries):
+        if attempt >= retries:
+            raise blackbook.database.ConflictError(
+                'Document "{doc_id}" was still being changed by others after {retries} retries'.format(
+                    doc_id=doc_id,
+                    retries=retries
+                )
+            )
+        # jittered, so writers that collided don't all retry at the same moment
+        return random.uniform(0, self.retry_backoff * 2 ** attempt)
+
+    def _index_documents(self, docs):
+        """
+        Add (id, document) pairs to the search index, see _index_document().
+        """
+        for doc_id, doc in docs:
+            self._index_document(doc_id, doc)
+
+    def _read_changes(self, since, limit):
+        """
+        Read a batch of the _changes feed, with the documents.
+
+        Implementations should return a dict with the changes as "results", and the update sequence
+        they go up to as "last_seq". Called from the search indexer thread.
+        """
+        raise NotImplementedError()
+
+    def _search_hits(self, query, model=None, owner=None, limit=None):
+        """
+        Search the index for search(), starting the search indexer if it isn't running.
+        :return: list (contact id, score) tuples, best matches first
+        :raises InvalidModelError: If model isn't Contact
+        :raises DatabaseNotReadyError: If the search index hasn't been built yet
+        """
+        if model is not None and self.model_map.get(model, model) is not couch_models.Contact:
+            raise blackbook.database.InvalidModelError()
+        self.start_search_indexer()
+        index = self.search_index
+        if index is None:
+            raise blackbook.database.DatabaseNotReadyError('The search index is still being built.')
+        return index.search(query, scope=owner, limit=limit)
+
+
+class CouchDatabase(CouchDatabaseBase):
+    """
+    CouchDB through couchdb-python, see CouchDatabaseBase.
+    """
+
+    def __init__(self):
+        super(CouchDatabase, self).__init__()
+        # one pool for every request made through this database, shared by all the API views using it
+        self.session = blackbook.database.couch.pool.PooledSession(
+            timeout=current_app.config.get('COUCHDB_TIMEOUT'),
+            max_connections=current_app.config.get('COUCHDB_MAX_CONNECTIONS') or 10,
+            keep_alive=current_app.config.get('COUCHDB_KEEP_ALIVE') or 60,
+            acquire_timeout=current_app.config.get('COUCHDB_POOL_TIMEOUT'),
+            read_retry_delays=self.read_retry_delays
+        )
         try:
-            self.server = couchdb.Server(current_app.config.get('COUCHDB_URI') or 'http://localhost:5984')
+            self.server = couchdb.Server(
+                current_app.config.get('COUCHDB_URI') or 'http://localhost:5984',
+                session=self.session
+            )
         except ConnectionRefusedError as e:
             raise blackbook.database.DatabaseUnreachableError(
                 'The connection to the database was refused. (Error: {error})\n' +
@@ -51,70 +517,402 @@ class CouchDatabase(blackbook.database.Database):
             self.db = self.server[self.dbname]
         except couchdb.ResourceNotFound:
             self.setup()
+        else:
+            if not self.is_setup:
+                # design docs changed since the last deploy
+                self.setup()
 
-    @staticmethod
-    def __iterate_design_docs():
-
-        design_doc_path = os.path.join(os.path.dirname(__file__), 'design_docs', '*.json')
-        design_docs = glob.glob(design_doc_path)
+    @property
+    def pool_stats(self):
+        """
+        Connection pool utilization: open connections in use and idle, connections created, reused,
+        expired and discarded after errors, waits for a free connection and read retries.
+        """
+        return self.session.stats
 
-        for design in design_docs:
-            with open(design) as docfile:
-                yield json.load(docfile)
+    def _outdated_design_docs(self, db):
+        """
+        Find the design docs missing from a database or out of date with the spec, in one request.
+        :param db: The couchdb.Database to check
+        :return: A list of (design doc, current revision or None) tuples
+        """
+        rows = db.view('_all_docs', keys=[design['_id'] for design in self.design_docs], include_docs=True)
+        current = {row.id: row.doc for row in rows if row.doc is not None}
+        outdated = []
+        for design in self.design_docs:
+            doc = current.get(design['_id'])
+            if doc is None or doc.get(DESIGN_HASH_FIELD) != design[DESIGN_HASH_FIELD]:
+                outdated.append((design, doc['_rev'] if doc is not None else None))
+        return outdated
 
     @property
     def is_setup(self):
+        db = getattr(self, 'db', None)
         try:
-            db = self.server[self.dbname]
+            if db is None:
+                db = self.server[self.dbname]
+            return not self._outdated_design_docs(db)
         except couchdb.ResourceNotFound:
             return False
 
-        for design in self.__iterate_design_docs():
-            doc = self.db.get(design.get('_id'))
-            if not doc:
-                return False
-            else:
-                if design != doc:
-                    return False
-
-        return True
-
     def create(self, data):
-        model = self.model_map.get(data.__class__)
-        if model is None:
-            raise blackbook.database.InvalidModelError()
+        doc = self._to_document(data)
 
-        existing = self.db.get(data.id)
+        existing = self.db.get(doc.id)
         if existing is not None:
             raise blackbook.database.EntryExistsError()
 
-        data_dict = data.serialize()
-        del data_dict['id']
-        data_dict['_id'] = data.id
-
-        doc = model(**data_dict)
-        doc.save(self.db)
+        doc.store(self.db)
 
         if data.id is None:
             data.id = doc.id
 
+        self._index_document(data.id, doc)
+        data.mark_clean()
+
         return data
 
+    def create_many(self, models, batch_size=None):
+        """
+        Create many entries with _bulk_docs, writing batch_size documents per request.
+
+        Existing entries are detected from the per-document bulk response
+        instead of reading every id beforehand.
+
+        :param models: An iterable of blackbook.database.models.Model instances
+        :param batch_size: Optional. Documents per request, defaults to config option COUCHDB_BULK_BATCH_SIZE.
+        :return: A list of (model, error) tuples in input order, error is None if the model was created.
+        """
+        batch_size = batch_size or self.batch_size
+        results = []
+        batch = []
+
+        for data in models:
+            try:
+                doc = self._to_document(data)
+            except blackbook.database.InvalidModelError as e:
+                results.append((data, e))
+            else:
+                results.append((data, None))
+                batch.append((len(results) - 1, doc))
+                if len(batch) >= batch_size:
+                    self._write_batch(batch, results)
+                    batch = []
+
+        if batch:
+            self._write_batch(batch, results)
+
+        return results
+
+    def _write_batch(self, batch, results):
+        try:
+            written = self.db.update([doc for position, doc in batch])
+        except couchdb.HTTPError as e:
+            raise blackbook.database.DatabaseError(
+                'There was an error writing a batch of {count} documents. (Error: {error})'.format(
+                    count=len(batch),
+                    error=e.args[0]
+                )
+            )
+
+        for (position, doc), (success, doc_id, rev_or_exc) in zip(batch, written):
+            data = results[position][0]
+            if success:
+                if data.id is None:
+                    data.id = doc_id
+                self._index_document(doc_id, doc)
+                data.mark_clean()
+            elif isinstance(rev_or_exc, couchdb.http.ResourceConflict):
+                results[position] = (data, blackbook.database.EntryExistsError(doc_id))
+            else:
+                results[position] = (data, blackbook.database.DatabaseError(doc_id, rev_or_exc))
+
     def delete(self, data):
         existing = self.db.get(data.id)
         if existing is None:
             raise blackbook.database.NotFoundError()
 
         self.db.delete(existing)
+        self._unindex_document(data.id, existing)
+        if existing.get('type') == 'user':
+            self._user_changed(data.id)
+
+    def delete_cascade(self, data, batch_size=None, progress=None, retries=None):
+        """
+        Delete an entry and everything it owns (see CouchModel.owns), e.g. a user with their contacts
+        and all of the contacts' addresses, emails and phone numbers.
+
+        The owned documents are read a level at a time, batch_size per _all_docs request, and deleted
+        deepest first with _bulk_docs, batch_size at a time. The entry itself is deleted last, in the
+        same batch as its owners (e.g. the user of a contact) with their references to it removed by
+        dereference(). If this is interrupted, the entry is still there referencing whatever is left,
+        so calling delete_cascade() again finishes the job.
+
+        Documents changed by others meanwhile are read again and retried.
+
+        :param data: The Model instance to delete along with everything it owns.
+        :param batch_size: Optional. Documents per request, defaults to config option COUCHDB_BULK_BATCH_SIZE.
+        :param progress: Optional. Called with the statistics dict after every batch read or written.
+        :param retries: Optional. Retries per batch, defaults to config option COUCHDB_UPDATE_RETRIES.
+        :return: A dict of statistics: documents found, deleted and dereferenced, conflicts retried and seconds taken.
+        """
+        batch_size = batch_size or self.batch_size
+        retries = self.update_retries if retries is None else retries
+        stats = {'found': 0, 'deleted': 0, 'dereferenced': 0, 'conflicts': 0, 'seconds': 0.0}
+        started = time.monotonic()
+
+        def report():
+            stats['seconds'] = time.monotonic() - started
+            if progress is not None:
+                progress(dict(stats))
+
+        doc_id = self._document_id(data)
+        levels = [self._fetch_documents([doc_id])]
+        if doc_id not in levels[0]:
+            raise blackbook.database.NotFoundError()
+        stats['found'] = 1
+
+        while True:
+            owned = self._cascade_owned(levels)
+            level = collections.OrderedDict()
+            for start in range(0, len(owned), batch_size):
+                found = self._cascade_level(levels[-1], self._fetch_documents(owned[start:start + batch_size]))
+                level.update(found)
+                stats['found'] += len(found)
+                report()
+            if not level:
+                break
+            levels.append(level)
+
+        referenced = self._cascade_references(levels)
+        owners = self._fetch_documents(referenced)
+
+        # deepest first, and the entry last, so nothing is left unreachable from it
+        deletes = [(i, doc) for level in reversed(levels[1:]) for i, doc in level.items()]
+        for start in range(0, len(deletes), batch_size):
+            self._cascade_batch(collections.OrderedDict(deletes[start:start + batch_size]), {}, {}, stats, retries)
+            report()
+        self._cascade_batch(levels[0], owners, referenced, stats, retries)
+        report()
+
+        return stats
+
+    def _cascade_batch(self, deletes, owners, referenced, stats, retries):
+        attempt = 0
+        while deletes or owners:
+            docs = self._cascade_docs(deletes, owners, referenced)
+            if not docs:
+                return
+            try:
+                written = self.db.update(docs)
+            except couchdb.HTTPError as e:
+                raise blackbook.database.DatabaseError(
+                    'There was an error writing a batch of {count} documents. (Error: {error})'.format(
+                        count=len(docs),
+                        error=e.args[0]
+                    )
+                )
+            failed = {
+                doc_id: 'conflict' if isinstance(rev_or_exc, couchdb.http.ResourceConflict) else rev_or_exc
+                for success, doc_id, rev_or_exc in written if not success
+            }
+            conflicted = self._cascade_written(deletes, owners, failed, stats)
+            if not conflicted:
+                return
+            time.sleep(self._update_conflict(conflicted[0], attempt, retries))
+            attempt += 1
+            # deleted by others meanwhile is as good as deleted here
+            current = self._fetch_documents(conflicted)
+            deletes = collections.OrderedDict((i, current[i]) for i in conflicted if i in deletes and i in current)
+            owners = collections.OrderedDict((i, current[i]) for i in conflicted if i in owners and i in current)
+
+    def _fetch_documents(self, ids):
+        """
+        Fetch documents by id in a single _all_docs request, wrapped in their couch model classes.
+
+        Deleted, missing and untyped documents are left out.
+
+        :param ids: An iterable of document ids
+        :return: An OrderedDict of id -> couch model instance, in the order the ids were given
+        """
+        documents = collections.OrderedDict()
+        keys = list(collections.OrderedDict.fromkeys(i for i in ids if i is not None))
+        if not keys:
+            return documents
+        for row in self.db.view('_all_docs', keys=keys, include_docs=True):
+            if row.doc is None:
+                continue
+            model = self.type_map.get(row.doc.get('type'))
+            if model is not None:
+                documents[row.id] = model.wrap(row.doc)
+        return documents
 
     def read(self, model, _id=None):
-        pass
+        """
+        Read one or more entries from the database.
+
+        :param model: A common model class (a key of model_map) or a couch model class (a value of model_map)
+        :param _id: Optional. The id of a specific entry, or an iterable of ids to fetch in one request.
+        :return: A list of couch model instances. Ids that don't exist or aren't of the model's type
+                 are left out when _id is an iterable, NotFoundError is raised when _id is a single id.
+        """
+        couch_model = self.model_map.get(model, model)
+        if couch_model not in self.type_map.values():
+            raise blackbook.database.InvalidModelError()
+        type_name = couch_model.__name__.lower()
 
-    def replicate(self, database):
-        pass
+        if _id is None:
+            # no id means everything of this type
+            return [
+                couch_model.wrap(row.doc) for row in self.db.view('_all_docs', include_docs=True)
+                if row.doc is not None and row.doc.get('type') == type_name
+            ]
+
+        single = isinstance(_id, str)
+        documents = self._fetch_documents([_id] if single else _id)
+        found = [doc for doc in documents.values() if doc.type == type_name]
+
+        if single and not found:
+            raise blackbook.database.NotFoundError()
+        return found
+
+    def read_owned(self, documents):
+        """
+        Read every document owned by some documents (see CouchModel.owns) in a single request.
+
+        Together with read(), rendering a page of contacts and their addresses, emails and
+        phone numbers takes two requests instead of one per document.
+
+        :param documents: An iterable of couch model instances
+        :return: An OrderedDict of id -> couch model instance
+        """
+        return self._fetch_documents(owned for doc in documents for owned in doc.owns)
+
+    @property
+    def replication_id(self):
+        return self.db.resource.url
 
-    def search(self, query, model=None):
-        pass
+    def iter_changes(self, since=None, batch_size=None):
+        """
+        Stream documents from the _changes feed, batch_size changes per request.
+
+        Checkpoints are update sequences, so a later call with the last one only sees
+        documents changed since. Design documents and untyped documents are left out.
+
+        :param since: Optional. An update sequence from a previous batch.
+        :param batch_size: Optional. Changes per request, defaults to config option COUCHDB_BULK_BATCH_SIZE.
+        :return: An iterator of (update sequence, entries) tuples, see Database.iter_changes()
+        """
+        batch_size = batch_size or self.batch_size
+        since = since or 0
+        while True:
+            feed = self.db.changes(since=since, limit=batch_size, include_docs=True, style='main_only')
+            results = feed.get('results') or []
+            if not results:
+                return
+            since = feed['last_seq']
+            yield since, [entry for entry in (self._change_entry(change) for change in results) if entry is not None]
+            if len(results) < batch_size:
+                return
+
+    def replicate(self, database, batch_size=None, progress=None):
+        """
+        Copy another database's entries into this one, a batch at a time.
+
+        Entries are read with database.iter_changes(), converted to this database's models
+        through model_map and written with _bulk_docs, replacing what is here under the same id.
+        The source's checkpoint is saved here (as a _local document, which is never replicated
+        itself) after every batch, and the next replicate() from the same source resumes from it.
+
+        :param database: An instance of blackbook.database.Database
+        :param batch_size: Optional. Entries per batch, defaults to config option COUCHDB_BULK_BATCH_SIZE.
+        :param progress: Optional. Called with the statistics dict after every batch.
+        :return: A dict of statistics, see Database.replicate()
+        """
+        checkpoint_id = '_local/replication-' + hashlib.sha1(database.replication_id.encode('utf-8')).hexdigest()
+        checkpoint = self.db.get(checkpoint_id) or {'_id': checkpoint_id, 'source': database.replication_id}
+        stats = {'written': 0, 'deleted': 0, 'errors': 0, 'seconds': 0.0, 'per_second': 0.0}
+        started = time.monotonic()
+
+        for since, entries in database.iter_changes(since=checkpoint.get('since'), batch_size=batch_size or self.batch_size):
+            self._replicate_batch(entries, stats)
+            checkpoint['since'] = since
+            self.db.save(checkpoint)
+            stats['seconds'] = time.monotonic() - started
+            stats['per_second'] = (stats['written'] + stats['deleted']) / stats['seconds'] if stats['seconds'] else 0.0
+            if progress is not None:
+                progress(dict(stats))
+
+        stats['seconds'] = time.monotonic() - started
+        stats['per_second'] = (stats['written'] + stats['deleted']) / stats['seconds'] if stats['seconds'] else 0.0
+        return stats
+
+    def _replicate_batch(self, entries, stats):
+        if not entries:
+            return
+        # current revisions, to overwrite or delete what is already here
+        revs = {
+            row.key: row.value['rev'] for row in self.db.view('_all_docs', keys=[entry[1] for entry in entries])
+            if row.id is not None and not row.value.get('deleted')
+        }
+        # old versions of deleted documents, to drop them from the search index
+        removed = {}
+        deleted_ids = [doc_id for model, doc_id, data in entries if data is None and doc_id in revs]
+        if deleted_ids:
+            removed = {
+                row.id: row.doc for row in self.db.view('_all_docs', keys=deleted_ids, include_docs=True)
+                if row.doc is not None
+            }
+
+        docs = self._replicated_docs(entries, revs, stats)
+        try:
+            written = self.db.update(docs)
+        except couchdb.HTTPError as e:
+            raise blackbook.database.DatabaseError(
+                'There was an error writing a batch of {count} replicated documents. (Error: {error})'.format(
+                    count=len(docs),
+                    error=e.args[0]
+                )
+            )
+        self._replicated(docs, [(success, doc_id) for success, doc_id, rev_or_exc in written], removed, stats)
+
+    def _read_changes(self, since, limit):
+        """
+        Read a batch of the _changes feed, with the documents.
+        :return: dict with the changes as "results", and the update sequence they go up to as "last_seq"
+        """
+        return self.db.changes(since=since or 0, limit=limit, include_docs=True, style='main_only')
+
+    def rebuild_search_index(self):
+        """
+        Build the search index from scratch with one pass over the _changes feed, and save it.
+
+        Takes a while on big databases, the search indexer does this off the request path.
+        """
+        index = InvertedIndex()
+        self._catch_up_search_index(index)
+        self.search_index = index
+        self.save_search_index()
+
+    def search(self, query, model=None, owner=None, limit=None):
+        """
+        Full-text search over contact names, emails, phone numbers and addresses.
+
+        Terms match words starting with them, every term has to match, best matches come first.
+        The index is kept in memory, updated by create(), create_many(), update() and delete(), and
+        kept up to date with everything else by the search indexer (see start_search_indexer()), which
+        writes it to config option SEARCH_INDEX_PATH. Until the indexer has built it, if there is no
+        saved copy, DatabaseNotReadyError is raised.
+
+        :param query: The search terms
+        :param model: Optional. Only contacts are searchable, anything else raises InvalidModelError
+        :param owner: Optional. Only return contacts belonging to this User.id
+        :param limit: Optional. The max number of results
+        :return: A list of couch Contact instances
+        """
+        hits = self._search_hits(query, model=model, owner=owner, limit=limit)
+        documents = self._fetch_documents(key for key, score in hits)
+        return [documents[key] for key, score in hits if key in documents]
 
     def setup(self):
         if not self.is_setup:
@@ -141,26 +939,124 @@ class CouchDatabase(blackbook.database.Database):
                     )
                 )
 
-            for design in self.__iterate_design_docs():
-                existing = self.db.get(design.get('_id'))
-                if not existing:
-                    # Create new
-                    self.db.save(design)
+            docs = []
+            for design, rev in self._outdated_design_docs(self.db):
+                # the spec replaces whatever is there
+                docs.append(dict(design, _rev=rev) if rev is not None else dict(design))
+            for success, doc_id, rev_or_exc in self.db.update(docs):
+                if not success:
+                    raise blackbook.database.DatabaseError(
+                        'There was an error saving design doc "{doc_id}" (Error: {error})'.format(
+                            doc_id=doc_id,
+                            error=rev_or_exc
+                        )
+                    )
+            if docs and self.warm_up_views:
+                self.warm_up(designs=docs)
+
+    def warm_up(self, designs=None, progress=None, poll_interval=1.0):
+        """
+        Build the view indexes of design docs ahead of the queries that need them.
+
+        CouchDB builds a view index when the view is queried, so without this the first request
+        after a design doc changes waits for the whole build. A stale=update_after query per design
+        doc starts every build at once without waiting on it, then /_active_tasks is polled until
+        they are done. Without the admin rights /_active_tasks needs, each index is waited on in turn.
+
+        :param designs: Optional. Design docs to warm up, defaults to all of them.
+        :param progress: Optional. Called with a dict of design doc id -> percent done after every poll.
+        :param poll_interval: Optional. Seconds between polls.
+        :return: A dict of design doc id -> seconds taken until its indexes were built
+        """
+        pending = self._view_paths(self.design_docs if designs is None else designs)
+        started = time.monotonic()
+        for path in pending.values():
+            self.db.view(path, limit=0, stale='update_after').rows
+
+        built = collections.OrderedDict()
+        while pending:
+            try:
+                building = self._indexing_progress(self.server.tasks())
+            except (couchdb.Unauthorized, couchdb.Forbidden):
+                building = {}
+            for design_id in [design_id for design_id in pending if design_id not in building]:
+                # no build running, or it hasn't shown up yet: a regular query returns once the index is current
+                self.db.view(pending.pop(design_id), limit=0).rows
+                built[design_id] = time.monotonic() - started
+            if progress is not None:
+                report = {design_id: 100.0 for design_id in built}
+                report.update((design_id, float(building.get(design_id, 0))) for design_id in pending)
+                progress(report)
+            if pending:
+                time.sleep(poll_interval)
+
+        return built
+
+    def update(self, data, retries=None):
+        """
+        Update an existing entry, writing only the fields that changed.
+
+        For couch documents (e.g. from read()) those are the fields changed since the document was
+        loaded, see CouchModel.changed_fields; for blackbook.database.models.Model instances, the fields
+        assigned since the model was made or last saved (every field for a new model), see
+        Model.changed_fields. With config option COUCHDB_UPDATE_HANDLER the fields are sent to the
+        _design/document/_update/patch handler, which applies them to the latest revision in one
+        request. Otherwise they are applied to the document as loaded, or the latest revision.
+
+        A conflict with a concurrent write is retried on the new latest revision, so fields changed
+        by the other writer are kept; of two writes to the same field, the last one wins.
+
+        :param data: A couch model document, or a blackbook.database.models.Model instance
+        :param retries: Optional. Max retries after conflicts, defaults to config option COUCHDB_UPDATE_RETRIES.
+        :return: The updated couch model document
+        :raises NotFoundError: If the document was deleted meanwhile
+        :raises ConflictError: If the document was still being changed by others after the retries
+        """
+        doc_id, changes, loaded = self._update_plan(data)
+        if not changes:
+            return data
+        retries = self.update_retries if retries is None else retries
+
+        attempt = 0
+        while True:
+            try:
+                if self.update_handler:
+                    doc = self._patch_document(doc_id, changes)
                 else:
-                    # Update existing
-                    for k, v in design.items():
-                        if k in existing:
-                            # Update existing from spec
-                            if existing[k] != v:
-                                existing[k] = v
-                        else:
-                            # Add new from spec
-                            existing[k] = v
-                    for k in existing:
-                        # Delete items not in spec
-                        if k not in design:
-                            del existing[k]
-                    self.db.save(existing)
-
-    def update(self, data):
-        pass
+                    doc = self._save_changes(doc_id, changes, loaded)
+                break
+            except couchdb.ResourceConflict:
+                time.sleep(self._update_conflict(doc_id, attempt, retries))
+                attempt += 1
+                loaded = None
+
+        return self._updated(data, doc)
+
+    def _patch_document(self, doc_id, changes):
+        try:
+            headers, body = self.db.update_doc(UPDATE_HANDLER, doc_id, body=changes)
+        except couchdb.ResourceNotFound:
+            raise blackbook.database.NotFoundError()
+        except (couchdb.Forbidden, couchdb.ServerError) as e:
+            raise blackbook.database.DatabaseError(
+                'There was an error updating document "{doc_id}" (Error: {error})'.format(doc_id=doc_id, error=e.args[0])
+            )
+        doc = json.loads(body.read().decode('utf-8'))
+        doc['_rev'] = headers.get('X-Couch-Update-NewRev', doc.get('_rev'))
+        return doc
+
+    def _save_changes(self, doc_id, changes, loaded=None):
+        doc = loaded
+        if doc is None:
+            doc = self.db.get(doc_id)
+            if doc is None:
+                raise blackbook.database.NotFoundError()
+            doc = dict(doc)
+        doc.update(changes)
+        try:
+            self.db.save(doc)
+        except (couchdb.Forbidden, couchdb.ServerError) as e:
+            raise blackbook.database.DatabaseError(
+                'There was an error updating document "{doc_id}" (Error: {error})'.format(doc_id=doc_id, error=e.args[0])
+            )
+        return doc
@@ -24,7 +24,7 @@ exports.design = {
         all: {
             map: function (doc) {
                 if (doc.subtype === 'employee' || doc.subtype === 'admin') {
-                    emit(doc.id, doc);
+                    emit(doc._id, doc);
                 }
             }
         },
@@ -1,15 +1,14 @@
 import blackbook.database
+import blackbook.database.models
 import couchdb.mapping
 import datetime
 import uuid
+import werkzeug.security
 
 from flask import current_app
 
 __author__ = 'ievans3024'
 
-# TODO: full-text search with couch-lucene (and pylucene?)
-#   see: https://wiki.apache.org/couch/Full_text_search
-
 LOGIN_TIMEOUT = current_app.config.get('LOGIN_TIMEOUT') or {'days': 14}
 
 
@@ -20,18 +19,79 @@ class CouchModel(couchdb.mapping.Document):
     date_modified = couchdb.mapping.DateTimeField(default=datetime.datetime.now)
     type = couchdb.mapping.TextField()
 
+    _changed = None  # names of fields changed since load, None while the constructor assigns them
+
     def __init__(self, *args, **kwargs):
         super(CouchModel, self).__init__(*args, **kwargs)
         self.type = self.__class__.__name__.lower()
+        self._changed = set()
+
+    @classmethod
+    def wrap(cls, data):
+        # loaded data already has every field, skip the constructor assigning each of them
+        instance = cls.__new__(cls)
+        instance._data = data
+        instance._changed = set()
+        return instance
 
     def __setattr__(self, key, value):
-        if key == 'date_created' and self.date_created is not None:
+        if key.startswith('_'):
+            # couchdb.mapping internals (e.g. _data), not document fields
+            super(CouchModel, self).__setattr__(key, value)
+            return
+        if key == 'date_created' and self._data.get('date_created') is not None:
+            # retain ctime, the stored value rather than the field's default
             value = self.date_created
-        elif key == 'date_modified':
-            value = datetime.datetime.now()
-        else:
-            self.date_modified = datetime.datetime.now()
         super(CouchModel, self).__setattr__(key, value)
+        if self._changed is not None and key in self._fields:
+            self._changed.add(key)
+
+    @property
+    def changed_fields(self):
+        """
+        Names of the fields changed since the document was made or loaded (e.g. with wrap()).
+
+        Assignments are tracked, changes made in place (e.g. appending to a ListField) need mark_changed().
+        :return: frozenset
+        """
+        return frozenset(self._changed)
+
+    def mark_changed(self, *fields):
+        """
+        Record fields as changed, for changes __setattr__ can't see.
+        :param fields: Field names
+        """
+        self._changed.update(fields)
+
+    def mark_clean(self):
+        """
+        Forget the changed fields, e.g. once they are saved.
+        """
+        self._changed.clear()
+
+    def touch(self):
+        """
+        Stamp date_modified once for everything changed since load, unless it was set explicitly.
+        """
+        if self._changed and 'date_modified' not in self._changed:
+            self.date_modified = datetime.datetime.now()
+
+    def changes(self):
+        """
+        The changed fields as they would be stored, with date_modified stamped.
+        :return: dict of document key -> json value
+        """
+        self.touch()
+        return {self._fields[field].name: self._data.get(self._fields[field].name) for field in self._changed}
+
+    @property
+    def doc_id(self):
+        """
+        The document's _id, what read() and the views know it by. The id field is a copy of it,
+        except in documents stored before the two were kept in step.
+        :return: str, or the id field if the document hasn't been given an _id yet
+        """
+        return self._data.get('_id') or self.id
 
     @property
     def owner(self):
@@ -78,11 +138,18 @@ class Contact(CouchModel):
     emails = couchdb.mapping.ListField(couchdb.mapping.TextField())  # list of ContactEmail.id
     phone_numbers = couchdb.mapping.ListField(couchdb.mapping.TextField())  # list of ContactPhone.id
 
-    # Views
+    # Views, see design_docs/contact.json
+    # by_address, by_email and by_phone_number rows link to the contact, query them with include_docs=True
     all = couchdb.mapping.ViewField("contact", "")
+    by_address = couchdb.mapping.ViewField("contact", "")
+    by_email = couchdb.mapping.ViewField("contact", "")
     by_name = couchdb.mapping.ViewField("contact", "")
+    by_phone_number = couchdb.mapping.ViewField("contact", "")
     by_surname = couchdb.mapping.ViewField("contact", "")
     by_user = couchdb.mapping.ViewField("contact", "")
+    # cards rows are each contact followed by links to what it owns, page through them with a CardPaginator
+    cards = couchdb.mapping.ViewField("contact", "")
+    cards_by_user = couchdb.mapping.ViewField("contact", "")
 
     @property
     def owner(self):
@@ -90,12 +157,15 @@ class Contact(CouchModel):
 
     @property
     def owns(self):
-        return self.addresses + self.emails + self.phone_numbers
+        # ListField proxies don't support +, the underlying list object is empty
+        return list(self.addresses) + list(self.emails) + list(self.phone_numbers)
 
     def dereference(self, key):
-        for l in (self.addresses, self.emails, self.phone_numbers):
+        for field in ('addresses', 'emails', 'phone_numbers'):
+            l = getattr(self, field)
             if key in l:
                 l.pop(l.index(key))
+                self.mark_changed(field)
 
 
 class ContactInformation(CouchModel):
@@ -137,6 +207,32 @@ class Permissible(CouchModel):
     permissions = couchdb.mapping.ListField(couchdb.mapping.TextField())
     groups = couchdb.mapping.ListField(couchdb.mapping.TextField())  # list of Group.id
 
+    _group_permissions = ()  # permissions of the groups, see load_groups()
+    _permission_trie = (None, None)  # (permissions it was compiled from, trie)
+
+    def load_groups(self, groups):
+        """
+        Take in the permissions of the model's groups, so has_permission() counts them.
+        :param groups: The Group documents of the model's groups, e.g. from CouchDatabase.read(Group, model.groups)
+        """
+        self._group_permissions = tuple(
+            permission for group in groups if group.doc_id in self.groups for permission in group.permissions
+        )
+
+    def has_permission(self, *perms, operator='and'):
+        """
+        Check permission names against the model's permissions and its groups', see load_groups().
+        :param perms: The permission names to check
+        :param operator: 'and' if every one of perms is required, 'or' if any of them is enough
+        :return: bool
+        """
+        permissions = tuple(self.permissions) + self._group_permissions
+        compiled_from, trie = self._permission_trie
+        if compiled_from != permissions:
+            trie = blackbook.database.models.compile_permission_trie(permissions)
+            self._permission_trie = (permissions, trie)
+        return blackbook.database.models.trie_has_permission(trie, *perms, operator=operator)
+
     @property
     def owner(self):
         return []
@@ -148,6 +244,7 @@ class Permissible(CouchModel):
     def dereference(self, key):
         if key in self.groups:
             self.groups.pop(self.groups.index(key))
+            self.mark_changed('groups')
 
 
 class Group(Permissible):
@@ -170,9 +267,11 @@ class Session(CouchModel):
     user = couchdb.mapping.TextField()
     token = couchdb.mapping.TextField()
     expiry = couchdb.mapping.DateTimeField(
-        default=lambda: datetime.datetime.now() + datetime.datetime.timedelta(**LOGIN_TIMEOUT)
+        default=lambda: datetime.datetime.now() + datetime.timedelta(**LOGIN_TIMEOUT)
     )
 
+    by_token = couchdb.mapping.ViewField('session', '', include_docs=True)  # the view emits no value
+
     @property
     def owner(self):
         return [self.user]
@@ -193,6 +292,21 @@ class User(Permissible):
     last_active = couchdb.mapping.DateTimeField()
 
     all = couchdb.mapping.ViewField('user', '')
+    by_email = couchdb.mapping.ViewField('user', '', include_docs=True)  # keyed on the lowercased email
+
+    # Optional blackbook.tools.hashing.PasswordHasher to move hashing off of the calling thread.
+    # Hashing happens inline with werkzeug.security when this is None.
+    password_hasher = None
+
+    def set_password(self, password, method='pbkdf2:sha512', salt_length=12):
+        hasher = self.password_hasher or werkzeug.security
+        self.password_hash = hasher.generate_password_hash(password, method=method, salt_length=salt_length)
+
+    def check_password(self, password):
+        if not self.password_hash:
+            return False
+        hasher = self.password_hasher or werkzeug.security
+        return hasher.check_password_hash(self.password_hash, password)
 
     @property
     def owner(self):
@@ -201,9 +315,10 @@ class User(Permissible):
     @property
     def owns(self):
         owns = super(User, self).owns
-        owns = owns + self.contacts
+        owns = owns + list(self.contacts)
         return owns
 
     def dereference(self, key):
         if key in self.contacts:
             self.contacts.pop(self.contacts.index(key))
+            self.mark_changed('contacts')
@@ -0,0 +1,271 @@
+import base64
+import collections
+import json
+
+__author__ = 'ievans3024'
+
+
+def encode_cursor(key, docid):
+    """
+    Encode a view row's position as an opaque, url-safe cursor.
+    :param key: The row's view key
+    :param docid: The row's document id
+    :returns: str
+    """
+    data = json.dumps([key, docid], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor made by encode_cursor().
+    :param cursor: The cursor
+    :returns: tuple (key, docid)
+    :raises ValueError: If the cursor is malformed
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key, docid = json.loads(data.decode("utf-8"))
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor: {cursor}".format(cursor=cursor)) from e
+    if not isinstance(docid, str):
+        raise ValueError("Invalid cursor: {cursor}".format(cursor=cursor))
+    return key, docid
+
+
+class Page(object):
+    """
+    One page of view results.
+
+    next_cursor and prev_cursor are None when there is no page in that direction.
+    owned is an OrderedDict of id -> the documents the items own, for pages read with a CardPaginator.
+    """
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None, owned=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.owned = owned
+
+
+class KeysetPaginator(object):
+    """
+    Paginates a couch view by (key, docid) position instead of skip/offset.
+
+    Every page is a single view query. Rows are ordered by key, then docid, so pages stay
+    stable with duplicate view keys (e.g. many contacts with the same user) and cost the
+    same no matter how deep into the view they are.
+
+        paginator = KeysetPaginator(couch_models.Contact.by_user, key=user.id)
+        page = paginator.page(db, after=request.args.get("after"))
+        # page.items, then link to ?after=page.next_cursor and ?before=page.prev_cursor
+
+    Works the same way for any view, e.g. User.all or Group.all.
+    """
+
+    def __init__(self, view, key=None, per_page=10, **options):
+        """
+        :param view: The couchdb.design.ViewDefinition to page through, e.g. couch Contact.by_user
+        :param key: Optional. Only page through rows with this view key
+        :param per_page: The number of items per page
+        :param options: Optional. Extra view options, e.g. include_docs=True
+        """
+        self.view = view
+        self.key = key
+        self.per_page = per_page
+        self.options = options
+
+    def _options(self, cursor, descending):
+        options = dict(self.options, limit=self.per_page + 1, descending=descending)
+        if cursor is not None:
+            # one more row, in case the first is the cursor's own row
+            options["limit"] += 1
+            options["startkey"] = cursor[0] if self.key is None else self.key
+            options["startkey_docid"] = cursor[1]
+        elif self.key is not None:
+            options["startkey"] = self.key
+        if self.key is not None:
+            options["endkey"] = self.key
+        return options
+
+    @staticmethod
+    def _plan(after, before):
+        if after is not None or before is None:
+            return (decode_cursor(after) if after is not None else None), False
+        return decode_cursor(before), True
+
+    def _build(self, rows, cursor, descending):
+        if cursor is not None and rows and rows[0].id == cursor[1] and \
+                (self.key is not None or rows[0].key == cursor[0]):
+            rows = rows[1:]
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if descending:
+            rows = list(reversed(rows))
+            has_next, has_prev = True, more
+        else:
+            has_next, has_prev = more, cursor is not None
+
+        if not rows:
+            return Page([])
+        wrapper = self.view.wrapper
+        return Page(
+            [wrapper(row) for row in rows] if wrapper is not None else list(rows),
+            next_cursor=encode_cursor(rows[-1].key, rows[-1].id) if has_next else None,
+            prev_cursor=encode_cursor(rows[0].key, rows[0].id) if has_prev else None
+        )
+
+    def page(self, db, after=None, before=None):
+        """
+        Fetch a page of results.
+        :param db: The couchdb.Database to query
+        :param after: Optional. A cursor, get the page following it
+        :param before: Optional. A cursor, get the page preceding it. Ignored if after is given.
+        :returns: Page
+        :raises ValueError: If a cursor is malformed
+        """
+        cursor, descending = self._plan(after, before)
+        rows = self.view(db, wrapper=None, **self._options(cursor, descending)).rows
+        return self._build(rows, cursor, descending)
+
+    async def page_async(self, db, after=None, before=None):
+        """
+        Fetch a page of results through an asyncio database.
+        :param db: The blackbook.database.aiocouch.database.AsyncCouchDatabase to query
+        :param after: Optional. A cursor, get the page following it
+        :param before: Optional. A cursor, get the page preceding it. Ignored if after is given.
+        :returns: Page
+        :raises ValueError: If a cursor is malformed
+        """
+        cursor, descending = self._plan(after, before)
+        rows = await db.query(self.view, wrapper=None, **self._options(cursor, descending))
+        return self._build(rows, cursor, descending)
+
+
+class CardPaginator(KeysetPaginator):
+    """
+    Paginates a view of cards: documents read along with the documents they own, e.g. couch Contact.cards_by_user.
+
+    A card is a row keyed [<key>, <id>, 0] for the document itself, followed by rows keyed [<key>, <id>, 1, ...]
+    linking each document it owns for include_docs (without a key, the rows are keyed [<id>, 0] and so on).
+    Pages are read rows_per_item rows per item at a time, so a page is a single view query unless its items
+    own more than that on average.
+
+        paginator = CardPaginator(couch_models.Contact.cards_by_user, key=user.id, types=db.type_map)
+        page = paginator.page(db, after=request.args.get("after"))
+        # page.items, with their addresses, emails and phone numbers in page.owned
+    """
+
+    def __init__(self, view, key=None, per_page=10, types=None, rows_per_item=4, **options):
+        """
+        :param view: The couchdb.design.ViewDefinition of cards to page through, e.g. couch Contact.cards_by_user
+        :param key: Optional. Only page through cards with this key
+        :param per_page: The number of items per page
+        :param types: dict of document type -> couch model class to wrap owned documents in, e.g. CouchDatabase.type_map
+        :param rows_per_item: The number of rows to read per item, the document and what it owns
+        :param options: Optional. Extra view options, e.g. stale="update_after"
+        """
+        super(CardPaginator, self).__init__(view, key=key, per_page=per_page, include_docs=True, **options)
+        self.types = types or {}
+        self.rows_per_item = rows_per_item
+        self.prefix = [] if key is None else [key]
+
+    def _options(self, cursor, descending):
+        options = dict(self.options, limit=(self.per_page + 1) * self.rows_per_item, descending=descending)
+        if cursor is not None:
+            if not isinstance(cursor[0], list) or len(cursor[0]) != len(self.prefix) + 2 or \
+                    cursor[0][:len(self.prefix)] != self.prefix:
+                raise ValueError("Invalid cursor: {cursor}".format(cursor=cursor))
+            # past every row of the cursor's card, {} sorts after any key
+            options["startkey"] = cursor[0][:-1] if descending else cursor[0][:-1] + [{}]
+        elif self.prefix:
+            options["startkey"] = self.prefix
+        if self.prefix:
+            options["endkey"] = self.prefix if descending else self.prefix + [{}]
+        return options
+
+    def _is_item(self, row):
+        return len(row.key) == len(self.prefix) + 2
+
+    def _read(self, rows, batch, options):
+        """
+        Add a batch of rows to the ones read so far.
+        :return: The options to read the next batch with, or None if there are enough rows for the page
+        """
+        exhausted = len(batch) < options["limit"]
+        if rows and batch and batch[0].key == rows[-1].key:
+            # the next batch starts at the last row read
+            batch = batch[1:]
+        rows.extend(batch)
+        if exhausted or sum(1 for row in rows if self._is_item(row)) > self.per_page:
+            return None
+        return dict(options, startkey=rows[-1].key, startkey_docid=rows[-1].id)
+
+    def _build(self, rows, cursor, descending):
+        # in view order, a card's document comes first, descending pages were read from the other end
+        cards = collections.OrderedDict()
+        for row in (reversed(rows) if descending else rows):
+            item_id = row.key[len(self.prefix)]
+            if self._is_item(row):
+                cards[item_id] = (row, [])
+            elif item_id in cards and row.doc is not None:
+                cards[item_id][1].append(row.doc)
+        cards = list(cards.values())
+
+        more = len(cards) > self.per_page
+        cards = cards[-self.per_page:] if descending else cards[:self.per_page]
+        if descending:
+            has_next, has_prev = True, more
+        else:
+            has_next, has_prev = more, cursor is not None
+
+        if not cards:
+            return Page([], owned=collections.OrderedDict())
+        owned = collections.OrderedDict()
+        for row, docs in cards:
+            for doc in docs:
+                model = self.types.get(doc.get("type"))
+                if model is not None:
+                    wrapped = model.wrap(doc)
+                    # only what still belongs to the card's document, it can list ids of documents moved elsewhere
+                    if row.id in wrapped.owner:
+                        owned[doc["_id"]] = wrapped
+        wrapper = self.view.wrapper
+        return Page(
+            [wrapper(row) for row, docs in cards] if wrapper is not None else [row for row, docs in cards],
+            next_cursor=encode_cursor(cards[-1][0].key, cards[-1][0].id) if has_next else None,
+            prev_cursor=encode_cursor(cards[0][0].key, cards[0][0].id) if has_prev else None,
+            owned=owned
+        )
+
+    def page(self, db, after=None, before=None):
+        """
+        Fetch a page of cards.
+        :param db: The couchdb.Database to query
+        :param after: Optional. A cursor, get the page following it
+        :param before: Optional. A cursor, get the page preceding it. Ignored if after is given.
+        :returns: Page
+        :raises ValueError: If a cursor is malformed
+        """
+        cursor, descending = self._plan(after, before)
+        options = self._options(cursor, descending)
+        rows = []
+        while options is not None:
+            options = self._read(rows, self.view(db, wrapper=None, **options).rows, options)
+        return self._build(rows, cursor, descending)
+
+    async def page_async(self, db, after=None, before=None):
+        """
+        Fetch a page of cards through an asyncio database.
+        :param db: The blackbook.database.aiocouch.database.AsyncCouchDatabase to query
+        :param after: Optional. A cursor, get the page following it
+        :param before: Optional. A cursor, get the page preceding it. Ignored if after is given.
+        :returns: Page
+        :raises ValueError: If a cursor is malformed
+        """
+        cursor, descending = self._plan(after, before)
+        options = self._options(cursor, descending)
+        rows = []
+        while options is not None:
+            options = self._read(rows, await db.query(self.view, wrapper=None, **options), options)
+        return self._build(rows, cursor, descending)
@@ -0,0 +1,256 @@
+import collections
+import itertools
+import socket
+import threading
+import time
+import blackbook.database
+import couchdb.http
+
+from couchdb import util
+
+__author__ = 'ievans3024'
+
+
+class PoolTimeoutError(blackbook.database.DatabaseUnreachableError):
+    """Error class for when no database connection frees up in time."""
+    pass
+
+
+class BoundedConnectionPool(couchdb.http.ConnectionPool):
+    """
+    A couchdb.http.ConnectionPool with a cap on open connections and an idle timeout.
+
+    couchdb-python's own pool opens a new connection whenever none is idle and keeps every one of them
+    forever. This one opens at most max_connections, makes callers wait up to acquire_timeout seconds
+    for one to be released, and closes connections left idle for longer than keep_alive seconds.
+    """
+
+    def __init__(self, timeout=None, max_connections=10, keep_alive=60, acquire_timeout=None,
+                 disable_ssl_verification=False):
+        """
+        BoundedConnectionPool Constructor
+        :param timeout: Socket timeout for each request in seconds, None for no timeout
+        :param max_connections: Max number of connections open at once
+        :param keep_alive: Seconds an idle connection is kept open for reuse
+        :param acquire_timeout: Seconds to wait for a free connection, None to wait forever
+        :param disable_ssl_verification: Don't verify https certificates
+        :return:
+        """
+        super(BoundedConnectionPool, self).__init__(timeout, disable_ssl_verification=disable_ssl_verification)
+        self.max_connections = max_connections
+        self.keep_alive = keep_alive
+        self.acquire_timeout = acquire_timeout
+        self.conns = {}  # (scheme, host) -> [(connection, released at)], most recently released last
+        self._available = max_connections
+        self._waiters = collections.deque()  # locks held for threads waiting on a connection, first come first served
+        self._checked_out = {}  # id(connection) -> (connection, thread id, checkout number)
+        self._checkouts = itertools.count()
+        self.created = 0
+        self.reused = 0
+        self.expired = 0
+        self.discarded = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    @property
+    def stats(self):
+        with self.lock:
+            idle = sum(len(conns) for conns in self.conns.values())
+            return {
+                "max_connections": self.max_connections,
+                "in_use": len(self._checked_out),
+                "idle": idle,
+                "created": self.created,
+                "reused": self.reused,
+                "expired": self.expired,
+                "discarded": self.discarded,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "timeouts": self.timeouts
+            }
+
+    def _acquire_slot(self):
+        with self.lock:
+            if self._available and not self._waiters:
+                self._available -= 1
+                return
+            waiter = threading.Lock()
+            waiter.acquire()
+            self._waiters.append(waiter)
+        started = time.monotonic()
+        acquired = waiter.acquire(timeout=-1 if self.acquire_timeout is None else self.acquire_timeout)
+        with self.lock:
+            if not acquired:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    # handed a slot just as the wait timed out
+                    acquired = True
+            self.waits += 1
+            self.wait_time += time.monotonic() - started
+            if not acquired:
+                self.timeouts += 1
+        if not acquired:
+            raise PoolTimeoutError(
+                'No database connection was freed within {timeout} seconds. '.format(timeout=self.acquire_timeout) +
+                'Consider raising option "COUCHDB_MAX_CONNECTIONS" in config.py'
+            )
+
+    def _release_slot(self):
+        with self.lock:
+            if self._waiters:
+                # hand the slot straight to the longest waiting thread
+                self._waiters.popleft().release()
+            else:
+                self._available += 1
+
+    def _connect(self, scheme, host):
+        if scheme == 'http':
+            cls = couchdb.http.HTTPConnection
+        elif scheme == 'https':
+            if self.disable_ssl_verification:
+                cls = couchdb.http.InsecureHTTPSConnection
+            else:
+                cls = couchdb.http.HTTPSConnection
+        else:
+            raise ValueError('%s is not a supported scheme' % scheme)
+        conn = cls(host, timeout=self.timeout)
+        conn.connect()
+        return conn
+
+    def get(self, url):
+        scheme, host = util.urlsplit(url, 'http', False)[:2]
+
+        self._acquire_slot()
+        try:
+            conn = None
+            expired = []
+            with self.lock:
+                conns = self.conns.setdefault((scheme, host), [])
+                oldest_usable = time.monotonic() - self.keep_alive
+                while conns and conns[0][1] < oldest_usable:
+                    expired.append(conns.pop(0)[0])
+                self.expired += len(expired)
+                if conns:
+                    conn = conns.pop(-1)[0]
+                    self.reused += 1
+            for candidate in expired:
+                candidate.close()
+
+            if conn is None:
+                conn = self._connect(scheme, host)
+                with self.lock:
+                    self.created += 1
+        except BaseException:
+            self._release_slot()
+            raise
+
+        with self.lock:
+            self._checked_out[id(conn)] = (conn, threading.get_ident(), next(self._checkouts))
+        return conn
+
+    def release(self, url, conn):
+        scheme, host = util.urlsplit(url, 'http', False)[:2]
+        with self.lock:
+            if self._checked_out.pop(id(conn), None) is None:
+                # already released or discarded
+                return
+            self.conns.setdefault((scheme, host), []).append((conn, time.monotonic()))
+        self._release_slot()
+
+    def mark(self):
+        """
+        Get a marker for discard_since().
+        :returns: int
+        """
+        with self.lock:
+            return next(self._checkouts)
+
+    def discard_since(self, marker):
+        """
+        Close connections the current thread checked out after mark() and never released.
+
+        couchdb.http.Session doesn't give a connection back when a request fails halfway,
+        so without this each failure would use up one of the max_connections for good.
+        :param marker: A value returned by mark()
+        """
+        thread = threading.get_ident()
+        with self.lock:
+            leaked = [
+                key for key, (conn, owner, checkout) in self._checked_out.items()
+                if owner == thread and checkout > marker
+            ]
+            conns = [self._checked_out.pop(key)[0] for key in leaked]
+            self.discarded += len(conns)
+        for conn in conns:
+            conn.close()
+            self._release_slot()
+
+    def close(self):
+        """Close every idle connection."""
+        with self.lock:
+            conns = [conn for idle in self.conns.values() for conn, released in idle]
+            self.conns = {}
+        for conn in conns:
+            conn.close()
+
+    def __del__(self):
+        self.close()
+
+
+class PooledSession(couchdb.http.Session):
+    """
+    A couchdb.http.Session using a BoundedConnectionPool, with retries and backoff for reads.
+
+    GET and HEAD requests failing with a socket error or a 5xx response are retried after each of
+    read_retry_delays in turn. Writes are never retried here, since CouchDB may have applied them.
+    """
+
+    def __init__(self, timeout=None, max_connections=10, keep_alive=60, acquire_timeout=None,
+                 read_retry_delays=(0.1, 0.2, 0.4), **kwargs):
+        """
+        PooledSession Constructor
+        :param timeout: Socket timeout for each request in seconds, None for no timeout
+        :param max_connections: Max number of connections open at once
+        :param keep_alive: Seconds an idle connection is kept open for reuse
+        :param acquire_timeout: Seconds to wait for a free connection, None to wait forever
+        :param read_retry_delays: Seconds to wait before each retry of a failed read
+        :param kwargs: Passed on to couchdb.http.Session
+        :return:
+        """
+        super(PooledSession, self).__init__(timeout=timeout, **kwargs)
+        self.connection_pool = BoundedConnectionPool(
+            timeout,
+            max_connections=max_connections,
+            keep_alive=keep_alive,
+            acquire_timeout=acquire_timeout
+        )
+        self.read_retry_delays = list(read_retry_delays)
+        self.retries = 0
+
+    @property
+    def stats(self):
+        stats = self.connection_pool.stats
+        stats["retries"] = self.retries
+        return stats
+
+    def request(self, method, url, *args, **kwargs):
+        delays = iter(self.read_retry_delays if method.upper() in ('GET', 'HEAD') else ())
+        while True:
+            marker = self.connection_pool.mark()
+            try:
+                return super(PooledSession, self).request(method, url, *args, **kwargs)
+            except (socket.error, couchdb.http.ServerError) as e:
+                self.connection_pool.discard_since(marker)
+                if isinstance(e, couchdb.http.ServerError) and e.args[0][0] < 500:
+                    raise
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                with self.connection_pool.lock:
+                    self.retries += 1
+                time.sleep(delay)
+            except BaseException:
+                self.connection_pool.discard_since(marker)
+                raise
@@ -1,7 +1,7 @@
-import collections
+import collections.abc
 import datetime
-import re
 import uuid
+import weakref
 import werkzeug.security
 
 __author__ = 'ievans3024'
@@ -222,12 +222,16 @@ class ModelField(object):
             raise TypeError('Parameter "cls" must be a class.')
         self.cls = cls
         self.nullable = bool(nullable)
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
 
     def __get__(self, instance, owner):
         if instance is None:
             return self
         else:
-            return instance.__dict__.get(self._get_own_name(owner))
+            return instance.__dict__.get(self.name or self._get_own_name(owner))
 
     def __set__(self, instance, value):
         if value is None and not self.nullable:
@@ -238,16 +242,21 @@ class ModelField(object):
                     cls='.'.join([self.cls.__module__, self.cls.__name__])
                 )
             )
-        instance.__dict__[self._get_own_name(type(instance))] = value
+        instance.__dict__[self.name or self._get_own_name(type(instance))] = value
 
     def __delete__(self, instance):
         if instance:
-            del instance.__dict__[self._get_own_name(type(instance))]
+            del instance.__dict__[self.name or self._get_own_name(type(instance))]
 
     def _get_own_name(self, owner):
-        for attr in dir(owner):
-            if getattr(owner, attr) is self:
-                return attr
+        # Fallback for descriptors that never had __set_name__ called, resolved once and cached
+        if self.name is None:
+            for klass in owner.__mro__:
+                for attr, value in vars(klass).items():
+                    if value is self:
+                        self.name = attr
+                        return attr
+        return self.name
 
 
 class Array(collections.UserList):
@@ -262,7 +271,7 @@ class Array(collections.UserList):
         else:
             self.cls = cls
 
-        if not isinstance(iterable, collections.Iterable):
+        if not isinstance(iterable, collections.abc.Iterable):
             raise TypeError('Parameter "iterable" must be iterable.')
         else:
             iterable_ok, reason = self._items_allowed(*iterable)
@@ -289,7 +298,7 @@ class Array(collections.UserList):
             super(Array, self).__setitem__(key, value)
 
     def __add__(self, other):
-        if not isinstance(other, collections.Iterable):
+        if not isinstance(other, collections.abc.Iterable):
             raise TypeError('can only concatenate iterable (not "{cls}") to Array'.format(cls=other.__class__.__name__))
         else:
             iterable_ok, reason = self._items_allowed(*other)
@@ -339,11 +348,13 @@ class ArrayField(ModelField):
         super(ArrayField, self).__init__(Array, nullable=nullable)
 
     def __set__(self, instance, value):
-        if isinstance(value, collections.Iterable):
-            if not all([isinstance(i, self.cls) for i in value]):
-                raise ValueError('Value must be an iterable containing {cls} instances.'.format(cls=self.cls.__name__))
+        if isinstance(value, collections.abc.Iterable):
+            if not all([isinstance(i, self.contains) or (self.allow_none and i is None) for i in value]):
+                raise ValueError(
+                    'Value must be an iterable containing {cls} instances.'.format(cls=self.contains.__name__)
+                )
             else:
-                instance.__dict__[self._get_own_name(type(instance))] = Array(
+                instance.__dict__[self.name or self._get_own_name(type(instance))] = Array(
                     iterable=value,
                     cls=self.contains,
                     allow_none=self.allow_none
@@ -353,26 +364,63 @@ class ArrayField(ModelField):
 
 
 class Model(object):
-    """Abstract base class for generic Models"""
+    """
+    Abstract base class for generic Models
+
+    Assigned fields are recorded in changed_fields until mark_clean() is called, e.g. by a database
+    once the model is saved. date_modified is stamped by touch(), once for all of those changes.
+    """
+
+    # outside of __dict__, so it never gets serialized
+    __slots__ = ('_changed',)
 
     id = ModelField(object, nullable=True)
     date_created = ModelField(datetime.datetime)
     date_modified = ModelField(datetime.datetime)
 
-    def __init__(self, _id=None, ctime=datetime.datetime.now(), mtime=datetime.datetime.now()):
+    def __init__(self, _id=None, ctime=None, mtime=None):
+        object.__setattr__(self, '_changed', set())
+        now = datetime.datetime.now() if ctime is None or mtime is None else None
         self.id = _id
-        self.date_created = ctime
-        self.date_modified = mtime
+        self.date_created = ctime if ctime is not None else now
+        self.date_modified = mtime if mtime is not None else now
 
     def __setattr__(self, key, value):
-        # Retain ctime, change mtime to now otherwise
+        # Retain ctime
         if key == 'date_created' and self.date_created is not None:
             value = self.date_created
-        elif key == 'date_modified':
-            value = datetime.datetime.now()
-        else:
-            self.date_modified = datetime.datetime.now()
         super(Model, self).__setattr__(key, value)
+        self._changed.add(key)
+
+    @property
+    def changed_fields(self):
+        """
+        Names of the fields assigned since the model was made or last marked clean.
+
+        A new model has every field changed. Changes made in place (e.g. Array.append()) need mark_changed().
+        :return: frozenset
+        """
+        return frozenset(self._changed)
+
+    def mark_changed(self, *fields):
+        """
+        Record fields as changed, for changes __setattr__ can't see.
+        :param fields: Field names
+        """
+        self._changed.update(fields)
+
+    def mark_clean(self):
+        """
+        Forget the changed fields, e.g. once they are saved.
+        """
+        self._changed.clear()
+
+    def touch(self):
+        """
+        Stamp date_modified once for everything changed, unless it was set explicitly.
+        """
+        if self._changed and 'date_modified' not in self._changed:
+            self.date_modified = datetime.datetime.now()
 
     def serialize(self):
         data = dict(**self.__dict__)
@@ -543,68 +591,125 @@ class ContactPhone(ContactInformation, ContactPhoneBase):
         self.number = number
 
 
+def compile_permission_trie(permissions):
+    """
+    Compile permission names into a prefix trie.
+
+    Each node is a dict of permission name segment -> child node. A node containing the key None
+    marks a held permission, granting everything beneath it.
+    :param permissions: An iterable of permission names, e.g. "blackbook.read.contact"
+    :return: dict
+    """
+    trie = {}
+    for permission in permissions:
+        node = trie
+        for segment in permission.split('.'):
+            node = node.setdefault(segment, {})
+        node[None] = True
+    return trie
+
+
+def trie_has_permission(trie, *perms, operator='and'):
+    """
+    Check permission names against a trie from compile_permission_trie().
+    :param perms: The permission names to check
+    :param operator: 'and' if every one of perms is required, 'or' if any of them is enough
+    :return: bool
+    """
+    ops = {'and', 'or'}
+    if operator not in ops:
+        raise ValueError('Parameter "operator" must be one of {ops}'.format(ops=str(ops)))
+    if not len(perms):
+        # If no perms are provided, assume nobody has permission
+        return False
+    permission_matches = {}
+    for perm in perms:
+        permission_matches[perm] = False  # assume no permission until permission is found
+        node = trie
+        for segment in perm.split('.'):
+            node = node.get(segment)
+            if node is None:
+                break
+            if None in node:
+                # only need to find the first held permission along the way
+                permission_matches[perm] = True
+                break
+
+    if operator == 'or':
+        return any([permission_matches.get(perm) for perm in perms])
+    return all([permission_matches.get(perm) for perm in perms])
+
+
 class Permissible(Model):
-    """A model that is part of a permissions hierarchy"""
+    """
+    A model that is part of a permissions hierarchy
+
+    Permissions are dotted names, holding a permission grants it and everything beneath it, e.g.
+    "one" grants "one.two" and "one.two.three", "one.two" does not grant "one", "one.three" or "four.one.two".
+
+    The permissions of a model and all of its groups are compiled into a prefix trie on first use.
+    Assigning permissions or groups drops the compiled trie; changing a Group invalidates every compiled trie,
+    since any model may inherit from it. In-place changes (e.g. permissions.append()) are not tracked,
+    call invalidate_permissions() after making them.
+    """
 
     permissions = ArrayField(str)
     groups = ArrayField(GroupBase)
 
+    # bumped whenever a Group's permissions change, compiled tries from an older generation are stale
+    _permissions_generation = 0
+    # instance -> (generation, trie), kept outside of the instance so it never gets serialized
+    _compiled_permissions = weakref.WeakKeyDictionary()
+
     def __init__(self, permissions=(), groups=(), **kwargs):
         super(Permissible, self).__init__(**kwargs)
         self.permissions = permissions
         self.groups = groups
 
-    def compile_permissions(self, permissions=None, groups_checked=None):
-        if not permissions:
-            permissions = self.permissions
-        else:
-            permissions = [p for p in permissions if p not in self.permissions]
+    def __setattr__(self, key, value):
+        if key in {'permissions', 'groups'}:
+            self.invalidate_permissions()
+        super(Permissible, self).__setattr__(key, value)
 
-        if not groups_checked:
+    def compile_permissions(self, permissions=None, groups_checked=None):
+        if permissions is None:
+            permissions = []
+        if groups_checked is None:
             groups_checked = []
 
-        if len(self.groups):
-            for group in self.groups:
-                if group.id not in groups_checked:
-                    groups_checked.append(group.id)
-                    permissions, groups_checked = group.compile_permissions(
-                        permissions=permissions,
-                        groups_checked=groups_checked
-                    )
+        permissions = permissions + [p for p in self.permissions if p not in permissions]
+
+        for group in self.groups:
+            if group.id not in groups_checked:
+                groups_checked.append(group.id)
+                permissions, groups_checked = group.compile_permissions(
+                    permissions=permissions,
+                    groups_checked=groups_checked
+                )
         return permissions, groups_checked
 
+    def get_permission_trie(self):
+        """
+        Get the compiled permissions for this model and its groups, see compile_permission_trie().
+        :return: dict
+        """
+        cached = self._compiled_permissions.get(self)
+        if cached is not None and cached[0] == Permissible._permissions_generation:
+            return cached[1]
+
+        permissions, groups = self.compile_permissions()
+        trie = compile_permission_trie(permissions)
+        self._compiled_permissions[self] = (Permissible._permissions_generation, trie)
+        return trie
+
     def has_permission(self, *perms, operator='and'):
-        ops = {'and', 'or'}
-        if operator not in ops:
-            raise ValueError('Parameter "operator" must be one of {ops}'.format(ops=str(ops)))
-        else:
-            if not len(perms):
-                # If no perms are provided, assume nobody has permission
-                return False
-            permissions, groups = self.compile_permissions()
-            permission_matches = {}
-            for perm in perms:
-                permission_matches[perm] = False  # assume no permission until permission is found
-                for permission in permissions:
-                    # match will be truthy:
-                    # permission = "one"
-                    # perm is "one.two", "one.three", "one.two.three", "one.two.four", etc.
-
-                    # match will not be truthy:
-                    # permission = "one.two"
-                    # perm is "one", "one.three", "four.one.two", "four.five.six", etc.
-
-                    # need to escape separator to avoid false positives
-                    regex = re.compile("^" + permission.replace(".", "\."))
-                    match = regex.match(perm)
-                    if match:
-                        permission_matches[perm] = True
-                        break  # only need to look for the first matching permission
-
-            if operator == 'or':
-                return any([permission_matches.get(perm) for perm in perms])
-            if operator == 'and':
-                return all([permission_matches.get(perm) for perm in perms])
+        return trie_has_permission(self.get_permission_trie(), *perms, operator=operator)
+
+    def invalidate_permissions(self):
+        """Drop compiled permissions, for all models if this is a Group others may inherit from."""
+        self._compiled_permissions.pop(self, None)
+        if isinstance(self, GroupBase):
+            Permissible._permissions_generation += 1
 
 
 class Group(Permissible, GroupBase):
@@ -644,6 +749,10 @@ class User(Permissible, UserBase):
     active = ModelField(bool)
     last_active = ModelField(datetime.datetime, nullable=True)
 
+    # Optional blackbook.tools.hashing.PasswordHasher to move hashing off of the calling thread.
+    # Hashing happens inline with werkzeug.security when this is None.
+    password_hasher = None
+
     def __init__(self, email, display_name, password_hash='',
                  contacts=(), email_verified=False, active=False, last_active=None, **kwargs):
         super(User, self).__init__(**kwargs)
@@ -656,7 +765,9 @@ class User(Permissible, UserBase):
         self.last_active = last_active
 
     def set_password(self, password, method='pbkdf2:sha512', salt_length=12):
-        self.password_hash = werkzeug.security.generate_password_hash(password, method=method, salt_length=salt_length)
+        hasher = self.password_hasher or werkzeug.security
+        self.password_hash = hasher.generate_password_hash(password, method=method, salt_length=salt_length)
 
     def check_password(self, password):
-        return werkzeug.security.check_password_hash(self.password_hash, password)
+        hasher = self.password_hasher or werkzeug.security
+        return hasher.check_password_hash(self.password_hash, password)
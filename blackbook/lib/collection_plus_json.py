@@ -3,10 +3,33 @@ __version__ = '0.0.4'
 
 from json import dumps, JSONEncoder, loads
 from collections import UserList
+from types import MemberDescriptorType
 
 MIMETYPE = "application/vnd.collection+json"
 
 
+def _properties(obj):
+    """
+    Iterate over the (name, value) pairs of an object's properties.
+    Standard properties stored in slots (see __fields__) come first, then anything in the instance __dict__.
+    """
+    for name in getattr(obj, "__fields__", ()):
+        yield name, getattr(obj, name)
+    yield from obj.__dict__.items()
+
+
+def _get_property(obj, name):
+    """Get a standard or non-standard property's value from an object, None if it doesn't have it."""
+    if name in getattr(obj, "__fields__", ()):
+        return getattr(obj, name)
+    return obj.__dict__.get(name)
+
+
+def _has_property(obj, name):
+    """Check whether an object has a standard or non-standard property, regardless of value."""
+    return name in getattr(obj, "__fields__", ()) or name in obj.__dict__
+
+
 class Comparable(object):
     """
     An object that needs to be comparable.
@@ -14,16 +37,18 @@ class Comparable(object):
     See https://github.com/ricardokirkner/collection-json.python
     """
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super(Comparable, self).__init__()
 
     def __eq__(self, other):
-        if type(self) == type(other) and self.__dict__ == other.__dict__:
+        if type(self) == type(other) and dict(_properties(self)) == dict(_properties(other)):
             return True
         return False
 
     def __ne__(self, other):
-        if type(self) != type(other) or self.__dict__ != other.__dict__:
+        if type(self) != type(other) or dict(_properties(self)) != dict(_properties(other)):
             return True
         return False
 
@@ -40,12 +65,26 @@ class CollectionField(object):
             self.nullable = nullable
         else:
             self.nullable = False
+        self.name = None
+        self.slot = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        # slotted owners keep the value in a "_<name>" slot rather than in __dict__
+        slot = vars(owner).get("_" + name)
+        if isinstance(slot, MemberDescriptorType):
+            self.slot = slot
 
     def __get__(self, instance, owner):
         if instance is None:
             return self
+        elif self.slot is not None:
+            try:
+                return self.slot.__get__(instance, owner)
+            except AttributeError:
+                return None
         else:
-            return instance.__dict__.get(self.get_own_name(owner))
+            return instance.__dict__.get(self.name or self.get_own_name(owner))
 
     def __set__(self, instance, value):
         if (not value) and self.truthy:
@@ -55,17 +94,37 @@ class CollectionField(object):
                 raise ValueError("Value cannot be None.")
         elif not isinstance(value, self.cls):
             raise TypeError("Value must be an instance of {cls}.".format(cls=self.cls.__name__))
-        instance.__dict__[self.get_own_name(type(instance))] = value
+        self._store(instance, value)
 
     def __delete__(self, instance):
+        name = self.name or self.get_own_name(type(instance))
         if not self.nullable:
-            raise ValueError("{name} cannot be deleted.".format(name=self.get_own_name(type(instance))))
-        del instance.__dict__[self.get_own_name(type(instance))]
+            raise ValueError("{name} cannot be deleted.".format(name=name))
+        if self.slot is not None:
+            self.slot.__delete__(instance)
+        else:
+            del instance.__dict__[name]
+
+    def _store(self, instance, value):
+        if self.slot is not None:
+            self.slot.__set__(instance, value)
+        else:
+            instance.__dict__[self.name or self.get_own_name(type(instance))] = value
 
     def get_own_name(self, owner):
-        for attr in dir(owner):
-            if getattr(owner, attr) is self:
-                return attr
+        """
+        Find the attribute name this descriptor is bound to on a class.
+        Only scans the class when __set_name__ was never called; the result is cached on the descriptor.
+        :param owner: The class (or subclass) the descriptor was found on
+        :returns: str The attribute name, or None if the descriptor is not on the class.
+        """
+        if self.name is None:
+            for klass in owner.__mro__:
+                for attr, value in vars(klass).items():
+                    if value is self:
+                        self.name = attr
+                        return attr
+        return self.name
 
 
 class CollectionArrayField(CollectionField):
@@ -86,7 +145,7 @@ class CollectionArrayField(CollectionField):
             raise TypeError("Value must be an instance of {cls}.".format(cls=self.cls.__name__))
         if not all([isinstance(i, self.contains) for i in value]):
             raise TypeError("Value must contain instances of {cls}".format(cls=self.contains.__name__))
-        instance.__dict__[self.get_own_name(type(instance))] = value
+        self._store(instance, value)
 
 
 class RequiresProperties(object):
@@ -116,27 +175,36 @@ class RequiresProperties(object):
 class Serializable(object):
     """
     An object that needs to be JSON serializable.
+
+    Subclasses may list their standard properties in __fields__ and declare matching "_<name>" __slots__
+    (plus "__dict__" for non-standard properties) to avoid carrying a full __dict__ per instance.
     """
 
+    __slots__ = ()
+    __fields__ = ()
+
     class Encoder(JSONEncoder):
         def default(self, o):
             if isinstance(o, Serializable):
                 return o.get_serializable()
             return JSONEncoder.default(self, o)
 
+    # shared encoder for leaf values in iter_json(), json.dumps would build a new one per call
+    _encode = Encoder().encode
+
     def __init__(self, *args, **kwargs):
         super(Serializable, self).__init__()
 
     def __repr__(self):
-        value = " ".join(["{k}={v}".format(k=k, v=repr(v)) for k, v in self.__dict__.items()])
+        value = " ".join(["{k}={v}".format(k=k, v=repr(v)) for k, v in _properties(self)])
         return "<{classname} {value}>".format(classname=self.__class__.__name__, value=value)
 
     def __str__(self):
-        return dumps(self, cls=self.Encoder)
+        return "".join(self.iter_json())
 
     def get_serializable(self):
         serializable = {}
-        for k, v in self.__dict__.items():
+        for k, v in _properties(self):
             if v:
                 if isinstance(v, Serializable):
                     serializable[k] = v.get_serializable()
@@ -144,16 +212,40 @@ class Serializable(object):
                     serializable[k] = v
         return serializable
 
+    def iter_json(self):
+        """
+        Encode this object as JSON in a single pass, without building the get_serializable() tree first.
+        Suitable for handing straight to a streamed flask.Response.
+        :returns: generator Chunks of JSON text which join to the same document as json.dumps would produce
+        """
+        yield "{"
+        separator = ""
+        for k, v in _properties(self):
+            if v:
+                yield separator + self._encode(k) + ": "
+                separator = ", "
+                if isinstance(v, Serializable):
+                    yield from v.iter_json()
+                else:
+                    yield self._encode(v)
+        yield "}"
+
 
 class Array(Serializable, Comparable, UserList):
     """
     A serializable, comparable list-like object that contains objects of a certain type.
     See: http://amundsen.com/media-types/collection/format/#arrays
+
+    With indexed=True, get() and search() lazily build a {value: positions} index per property name
+    the first time that property is looked up, and drop all indexes whenever the Array is mutated.
+    Changing a property on an object already in the Array is not detected, call reindex() after doing so.
     """
 
-    def __init__(self, iterable=[], cls=object, *args, **kwargs):
+    def __init__(self, iterable=[], cls=object, *args, indexed=False, **kwargs):
         super(Array, self).__init__(self, iterable, *args, **kwargs)
         self.required_class = cls
+        self.indexed = bool(indexed)
+        self._indexes = {}
         for item in iterable:
             if isinstance(item, cls):
                 self.data.append(item)
@@ -163,8 +255,8 @@ class Array(Serializable, Comparable, UserList):
     def __add__(self, other):
         if type(self) is type(other):
             if self.required_class == other.required_class:
-                merged = self.data + other.data
-                return Array(merged, self.required_class)
+                # both operands are already validated, don't check every element again
+                return Array.from_validated(self.data + other.data, self.required_class, indexed=self.indexed)
             else:
                 raise TypeError(
                     "unsupported operand type(s) for +: 'Array[{self_type}]' and 'Array[{other_type}]'".format(
@@ -176,6 +268,22 @@ class Array(Serializable, Comparable, UserList):
                 "unsupported operand type(s) for +: 'Array' and '{other_type}'".format(other_type=type(other).__name__)
             )
 
+    def __delitem__(self, i):
+        self._indexes.clear()
+        super(Array, self).__delitem__(i)
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, n):
+        self._indexes.clear()
+        return super(Array, self).__imul__(n)
+
+    def __setitem__(self, i, item):
+        self._indexes.clear()
+        super(Array, self).__setitem__(i, item)
+
     def __sub__(self, other):
         if type(self) is type(other):
             if self.required_class == other.required_class:
@@ -214,18 +322,90 @@ class Array(Serializable, Comparable, UserList):
 
     def append(self, item):
         if isinstance(item, self.required_class):
+            self._indexes.clear()
             super(Array, self).append(item)
         else:
             raise TypeError("item must be an instance of {type}".format(type=self.required_class.__name__))
 
+    def extend(self, other):
+        """
+        Append every object from an iterable, in place.
+        Arrays whose required class is the same as (or a subclass of) this one's are trusted as-is,
+        anything else is type checked one element at a time like append().
+        :param other: An Array or other iterable of objects
+        """
+        if isinstance(other, Array) and issubclass(other.required_class, self.required_class):
+            self._indexes.clear()
+            self.data.extend(other.data)
+        else:
+            for item in other:
+                self.append(item)
+
+    @classmethod
+    def from_validated(cls, data, required_class=object, indexed=False):
+        """
+        Wrap a list whose elements are already known to be instances of required_class.
+        Skips the per-element checks and conversions done by __init__; the list is used, not copied.
+        :param data: A list of required_class instances
+        :param required_class: The class contained objects must be instances of
+        :param indexed: Whether get() and search() should use lazily built indexes
+        :returns: Array
+        """
+        array = cls(cls=required_class, indexed=indexed)
+        array.data = data
+        return array
+
+    def _get_index(self, name):
+        """
+        Get the {value: [positions]} index for a property, building it on first use.
+        :param name: The property name
+        :returns: dict The index, or None if indexing is off or the property holds unhashable values.
+        """
+        if not self.indexed:
+            return None
+        try:
+            return self._indexes[name]
+        except KeyError:
+            index = {}
+            try:
+                for position, obj in enumerate(self.data):
+                    index.setdefault(_get_property(obj, name), []).append(position)
+            except TypeError:
+                # unhashable values, remember that so lookups go straight to a scan
+                index = None
+            self._indexes[name] = index
+            return index
+
+    def _candidates(self, name, value):
+        """
+        Get the positions of objects whose property equals value, None if no index can answer that.
+        """
+        index = self._get_index(name)
+        if index is None:
+            return None
+        try:
+            return index.get(value, ())
+        except TypeError:
+            return None
+
+    def clear(self):
+        self._indexes.clear()
+        super(Array, self).clear()
+
     def get(self, **kwargs):
         """
         Find the first contained object that matches certain criteria
         :param kwargs: Keyword arguments for property name:value pairs to match
         :returns: object The first contained object found to match all the criteria, None if no match.
         """
-        for obj in self.data:
-            matches = all([v == obj.__dict__.get(k) for k, v in kwargs.items()])
+        objects = self.data
+        for k, v in kwargs.items():
+            positions = self._candidates(k, v)
+            if positions is not None:
+                objects = [self.data[p] for p in positions]
+                break
+        for obj in objects:
+            matches = all([v == _get_property(obj, k) for k, v in kwargs.items()])
             if matches:
                 return obj
         return None
@@ -239,6 +419,42 @@ class Array(Serializable, Comparable, UserList):
                 data.append(item)
         return data
 
+    def iter_json(self):
+        # One chunk per element keeps streamed responses from degenerating into thousands of tiny writes
+        yield "["
+        separator = ""
+        for item in self.data:
+            if isinstance(item, Serializable):
+                yield separator + "".join(item.iter_json())
+            else:
+                yield separator + self._encode(item)
+            separator = ", "
+        yield "]"
+
+    def insert(self, i, item):
+        self._indexes.clear()
+        super(Array, self).insert(i, item)
+
+    def pop(self, i=-1):
+        self._indexes.clear()
+        return super(Array, self).pop(i)
+
+    def reindex(self):
+        """Drop any built indexes, e.g. after changing a property of an object in this Array."""
+        self._indexes.clear()
+
+    def remove(self, item):
+        self._indexes.clear()
+        super(Array, self).remove(item)
+
+    def reverse(self):
+        self._indexes.clear()
+        super(Array, self).reverse()
+
+    def sort(self, *args, **kwargs):
+        self._indexes.clear()
+        super(Array, self).sort(*args, **kwargs)
+
     def search(self, operator, *args, **kwargs):
         """
         Search for all contained objects that match certain criteria
@@ -252,14 +468,35 @@ class Array(Serializable, Comparable, UserList):
             "or": any
         }
 
-        if str(operator).lower() in operations:
-            op = operations[operator]
+        operator = str(operator).lower()
+        if operator not in operations:
+            raise ValueError('Parameter "operator" must be one of {ops}'.format(ops=str(set(operations))))
+        op = operations[operator]
+
+        objects = self.data
+        if kwargs:
+            if operator == "and":
+                # every match has to be in the smallest single-property result, so only check those
+                for k, v in kwargs.items():
+                    positions = self._candidates(k, v)
+                    if positions is not None:
+                        objects = [self.data[p] for p in positions]
+                        break
+            elif not args:
+                union = set()
+                for k, v in kwargs.items():
+                    positions = self._candidates(k, v)
+                    if positions is None:
+                        break
+                    union.update(positions)
+                else:
+                    objects = [self.data[p] for p in sorted(union)]
 
         results = []
-        for obj in self.data:
-            has_props = op([k in obj.__dict__ for k in args])
-            has_items = op([v == obj.__dict__.get(k) for k, v in kwargs.items()])
-            if has_props or has_items:
+        for obj in objects:
+            criteria = [_has_property(obj, k) for k in args]
+            criteria += [v == _get_property(obj, k) for k, v in kwargs.items()]
+            if op(criteria):
                 results.append(obj)
         return tuple(results)
 
@@ -271,6 +508,9 @@ class Data(Serializable, Comparable):
     See: http://amundsen.com/media-types/collection/format/#arrays-data
     """
 
+    __fields__ = ("name", "prompt", "value")
+    __slots__ = tuple("_" + f for f in __fields__) + ("__dict__",)
+
     name = CollectionField(str, truthy=True)
     prompt = CollectionField(str)
     value = CollectionField(object)
@@ -295,6 +535,8 @@ class Error(Serializable, Comparable):
     """
     A dict-like object containing error information.
     See: http://amundsen.com/media-types/collection/format/#objects-error
+
+    Not slotted: blackbook.api.errors.APIError mixes this with BaseException, whose layout conflicts with slots.
     """
 
     code = CollectionField(str)
@@ -320,6 +562,9 @@ class Link(Serializable, Comparable):
     See: http://amundsen.com/media-types/collection/format/#arrays-links
     """
 
+    __fields__ = ("href", "rel", "name", "prompt", "render")
+    __slots__ = tuple("_" + f for f in __fields__) + ("__dict__",)
+
     href = CollectionField(str, truthy=True)
     rel = CollectionField(str, truthy=True)
     name = CollectionField(str)
@@ -354,10 +599,14 @@ class Query(Serializable, Comparable):
     See: http://amundsen.com/media-types/collection/format/#arrays-queries
     """
 
+    __fields__ = ("href", "rel", "name", "prompt", "data")
+    __slots__ = tuple("_" + f for f in __fields__) + ("__dict__",)
+
     href = CollectionField(str, truthy=True)
     rel = CollectionField(str, truthy=True)
     name = CollectionField(str)
     prompt = CollectionField(str)
+    data = CollectionArrayField(Array, contains=Data)
 
     '''
     __should__ = {
@@ -389,6 +638,9 @@ class Item(Serializable, Comparable):
     http://amundsen.com/media-types/collection/format/#arrays-items
     """
 
+    __fields__ = ("href", "data", "links")
+    __slots__ = tuple("_" + f for f in __fields__) + ("__dict__",)
+
     href = CollectionField(str, truthy=True)
     data = CollectionArrayField(Array, contains=Data)
     links = CollectionArrayField(Array, contains=Link)
@@ -439,6 +691,28 @@ class Template(Serializable, Comparable):
             self.__setattr__(k, v)
 
 
+class CompiledTemplate(Template):
+    """
+    A Template encoded once, for templates every response repeats as they are.
+
+    iter_json() yields the cached JSON text, so a Collection holding it splices the text in
+    instead of encoding the template again. Compiled templates are shared between responses,
+    don't change them (or their data) after compiling.
+    """
+
+    __slots__ = ("_json",)
+
+    def __init__(self, template):
+        """
+        :param template: The Template to compile
+        """
+        super(CompiledTemplate, self).__init__(**dict(_properties(template)))
+        self._json = "".join(template.iter_json())
+
+    def iter_json(self):
+        yield self._json
+
+
 class Collection(Serializable, Comparable):
     """
     A dict-like object that contains a collection of information.
@@ -474,12 +748,11 @@ class Collection(Serializable, Comparable):
         self.href = href
         self.version = version
 
-        if error and not isinstance(error, Error):
-            error = Error(**error)  # let the class raise exceptions if something's amiss
+        if error:
+            # __setattr__ lets the class raise exceptions if something's amiss
             self.error = error
 
-        if template and not isinstance(template, Template):
-            template = Template(**template)
+        if template:
             self.template = template
 
         if items and not isinstance(items, Array):
@@ -528,3 +801,8 @@ class Collection(Serializable, Comparable):
     def get_serializable(self):
         return {"collection": super(Collection, self).get_serializable()}
 
+    def iter_json(self):
+        yield '{"collection": '
+        yield from super(Collection, self).iter_json()
+        yield "}"
+
@@ -0,0 +1,295 @@
+import bisect
+import heapq
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+
+__author__ = 'ievans3024'
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """
+    Split text into lowercased word tokens.
+
+    Runs of digits split by punctuation (e.g. phone numbers) also yield the digits joined together,
+    so "555-0123" matches "555", "0123" and "5550123".
+    :param text: The text to tokenize
+    :returns: list The tokens, possibly with duplicates
+    """
+    if not text:
+        return []
+    tokens = TOKEN_PATTERN.findall(str(text).lower())
+    if len(tokens) > 1 and all(token.isdigit() for token in tokens):
+        tokens.append("".join(tokens))
+    return tokens
+
+
+class InvertedIndex(object):
+    """
+    An in-memory, thread-safe inverted index with prefix matching and ranked results.
+
+    Each indexed key (e.g. a contact id) is built from one or more sources (e.g. the contact document
+    and each of its email documents), which can be replaced or removed on their own as they change.
+    Keys may also carry a scope (e.g. the owning user id) to restrict searches to.
+
+    The index can be written to and read from disk as JSON with save() and load(), along with seq:
+    whatever its data source uses to tell how far the index is up to date (e.g. a CouchDB update sequence).
+    """
+
+    # score multiplier for a token that only starts with the query term
+    prefix_weight = 0.5
+    # query terms shorter than this only match whole tokens, not every token starting with them
+    min_prefix_length = 2
+    # max tokens a query term matches by prefix, in alphabetical order, besides the term itself
+    max_prefix_expansions = 200
+
+    def __init__(self):
+        self._sources = {}  # key -> {source: {token: weight}}
+        self._scopes = {}  # key -> scope
+        self._postings = {}  # token -> {key: weight}
+        self._tokens = []  # sorted tokens for prefix lookups, as of the last search
+        self._new_tokens = set()  # tokens added since, sorted into _tokens by the next search
+        self._stale_tokens = set()  # tokens removed since, still in _tokens until there are enough of them
+        self._source_keys = {}  # source -> key, to discard a source without knowing its key
+        self._lock = threading.RLock()
+        self.seq = None
+
+    def __contains__(self, key):
+        return key in self._sources
+
+    def __len__(self):
+        return len(self._sources)
+
+    def _add_postings(self, key, tokens):
+        for token, weight in tokens.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                if token in self._stale_tokens:
+                    # removed and added back, still in _tokens
+                    self._stale_tokens.discard(token)
+                else:
+                    self._new_tokens.add(token)
+            postings[key] = postings.get(key, 0) + weight
+
+    def _remove_postings(self, key, tokens):
+        for token, weight in tokens.items():
+            postings = self._postings[token]
+            remaining = postings.get(key, 0) - weight
+            if remaining > 0:
+                postings[key] = remaining
+            else:
+                postings.pop(key, None)
+                if not postings:
+                    del self._postings[token]
+                    if token in self._new_tokens:
+                        self._new_tokens.discard(token)
+                    else:
+                        self._stale_tokens.add(token)
+
+    def sort_tokens(self):
+        """
+        Sort the tokens added since the last search into the prefix lookup list.
+
+        Keeping it sorted on every change takes time quadratic in the number of tokens, so searches
+        sort it when they need it: a few new tokens are inserted, many are merged in with one sort.
+        Call this after adding many at once (e.g. building the index) so the next search doesn't have to.
+        """
+        with self._lock:
+            if self._new_tokens:
+                if len(self._new_tokens) <= 32:
+                    for token in self._new_tokens:
+                        bisect.insort(self._tokens, token)
+                else:
+                    self._tokens.extend(self._new_tokens)
+                    self._tokens.sort()
+                self._new_tokens = set()
+            if len(self._stale_tokens) > len(self._tokens) // 4:
+                self._tokens = [token for token in self._tokens if token not in self._stale_tokens]
+                self._stale_tokens = set()
+
+    def _expand(self, term):
+        """
+        Get the indexed tokens a query term matches: the term itself, and tokens starting with it
+        if it is at least min_prefix_length long, at most max_prefix_expansions of them.
+        """
+        if len(term) < self.min_prefix_length:
+            return [term] if term in self._postings else []
+        tokens = []
+        most = self.max_prefix_expansions + (1 if term in self._postings else 0)
+        position = bisect.bisect_left(self._tokens, term)
+        while position < len(self._tokens) and len(tokens) < most:
+            token = self._tokens[position]
+            if not token.startswith(term):
+                break
+            if token in self._postings:
+                tokens.append(token)
+            position += 1
+        return tokens
+
+    def add(self, key, fields, source=None, scope=None):
+        """
+        Index (or re-index) a source's fields under a key.
+        :param key: What search results should return, e.g. a contact id
+        :param fields: An iterable of (text, weight) pairs
+        :param source: Optional. What the fields came from, replaces anything previously indexed for it
+        :param scope: Optional. Set the scope the key belongs to
+        """
+        tokens = {}
+        for text, weight in fields:
+            for token in tokenize(text):
+                tokens[token] = tokens.get(token, 0) + weight
+
+        with self._lock:
+            moved_from = self._source_keys.get(source)
+            if source is not None and moved_from is not None and moved_from != key:
+                # e.g. an email moved to another contact
+                self.remove(moved_from, source=source)
+            sources = self._sources.setdefault(key, {})
+            previous = sources.get(source)
+            if previous is not None:
+                self._remove_postings(key, previous)
+            sources[source] = tokens
+            if source is not None:
+                self._source_keys[source] = key
+            self._add_postings(key, tokens)
+            if scope is not None:
+                self._scopes[key] = scope
+
+    def remove(self, key, source=None):
+        """
+        Remove a source from a key, or the whole key if source is None.
+        :param key: The key to remove from
+        :param source: Optional. The source to remove
+        """
+        with self._lock:
+            sources = self._sources.get(key)
+            if sources is None:
+                return
+            removed = list(sources) if source is None else [source]
+            for name in removed:
+                tokens = sources.pop(name, None)
+                if tokens is not None:
+                    self._remove_postings(key, tokens)
+                    self._source_keys.pop(name, None)
+            if not sources:
+                del self._sources[key]
+                self._scopes.pop(key, None)
+
+    def discard(self, source):
+        """
+        Remove a source from whichever key it is indexed under, e.g. for a deleted document
+        whose key (e.g. contact id) is no longer known. A key that is its own source is removed entirely.
+        :param source: The source to remove
+        """
+        with self._lock:
+            if source in self._sources:
+                self.remove(source)
+            key = self._source_keys.get(source)
+            if key is not None:
+                self.remove(key, source=source)
+
+    def search(self, query, scope=None, limit=None):
+        """
+        Find keys matching every term in a query, best matches first.
+
+        A term matches tokens equal to it or starting with it, exact matches rank higher, see
+        min_prefix_length and max_prefix_expansions. Rarer terms count for more than common ones.
+        :param query: The search terms
+        :param scope: Optional. Only return keys in this scope
+        :param limit: Optional. The max number of results
+        :returns: list (key, score) tuples
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        with self._lock:
+            self.sort_tokens()
+            total = len(self._sources)
+            scores = None
+            # rarest terms first, so the candidate set shrinks as fast as possible
+            for term in sorted(terms, key=lambda t: len(self._postings.get(t, ()))):
+                term_scores = {}
+                for token in self._expand(term):
+                    multiplier = 1.0 if token == term else self.prefix_weight
+                    postings = self._postings[token]
+                    if scores is None:
+                        matches = postings.items()
+                        if scope is not None:
+                            matches = [(key, weight) for key, weight in matches if self._scopes.get(key) == scope]
+                    elif len(scores) < len(postings):
+                        # look the candidates up, rather than going through every key of a common token
+                        matches = [(key, postings[key]) for key in scores if key in postings]
+                    else:
+                        matches = [(key, weight) for key, weight in postings.items() if key in scores]
+                    for key, weight in matches:
+                        term_scores[key] = term_scores.get(key, 0) + weight * multiplier
+                if not term_scores:
+                    return []
+                idf = math.log(1 + total / len(term_scores))
+                if scores is None:
+                    scores = {key: score * idf for key, score in term_scores.items()}
+                else:
+                    scores = {key: scores[key] + score * idf for key, score in term_scores.items()}
+
+        rank = lambda item: (-item[1], str(item[0]))
+        if limit is not None:
+            return heapq.nsmallest(limit, scores.items(), key=rank)
+        return sorted(scores.items(), key=rank)
+
+    def save(self, path):
+        """
+        Write the index to disk, atomically replacing any existing file.
+
+        Only taking a snapshot holds the lock, the (much slower) encoding and writing don't.
+        :param path: The file to write to
+        """
+        with self._lock:
+            # token dicts are replaced on change, never changed in place, so sharing them is safe
+            data = {
+                "seq": self.seq,
+                "sources": [
+                    [key, list(sources.items()), self._scopes.get(key)]
+                    for key, sources in self._sources.items()
+                ]
+            }
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "w") as temp_file:
+                json.dump(data, temp_file)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read an index written by save().
+        :param path: The file to read from
+        :returns: InvertedIndex
+        """
+        with open(path) as index_file:
+            data = json.load(index_file)
+        index = cls()
+        for key, sources, scope in data["sources"]:
+            index._sources[key] = {}
+            for source, tokens in sources:
+                index._sources[key][source] = tokens
+                if source is not None:
+                    index._source_keys[source] = key
+                for token, weight in tokens.items():
+                    postings = index._postings.setdefault(token, {})
+                    postings[key] = postings.get(key, 0) + weight
+            if scope is not None:
+                index._scopes[key] = scope
+        index._tokens = sorted(index._postings)
+        index.seq = data.get("seq")
+        return index
@@ -0,0 +1,71 @@
+import concurrent.futures
+import threading
+import werkzeug.security
+
+__author__ = 'ievans3024'
+
+
+class PasswordHasherBusyError(Exception):
+    """Error class for when too many password hashing jobs are already pending."""
+    pass
+
+
+class PasswordHasher(object):
+    """
+    Runs werkzeug password hashing and checking in a process pool, off of the request thread.
+
+    The request thread still waits for the result, but without holding the GIL, so other requests
+    handled by the same worker keep moving during a burst of logins. At most max_pending jobs may be
+    queued or running at once; past that, calls fail immediately with PasswordHasherBusyError instead
+    of piling up.
+
+    The process pool is started on first use rather than by the constructor, so that servers which
+    create the hasher and then fork their workers (e.g. gunicorn --preload) give each worker its own.
+    """
+
+    def __init__(self, workers=None, max_pending=32, timeout=None):
+        """
+        PasswordHasher Constructor
+        :param workers: Number of hashing processes, defaults to the number of CPUs
+        :param max_pending: Max number of jobs queued or running at once
+        :param timeout: Seconds to wait for a result before giving up, None to wait forever
+        :return:
+        """
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _run(self, func, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusyError(
+                'There are already {max_pending} password hashing jobs pending.'.format(max_pending=self.max_pending)
+            )
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future.result(timeout=self.timeout)
+
+    def check_password_hash(self, pwhash, password):
+        return self._run(werkzeug.security.check_password_hash, pwhash, password)
+
+    def generate_password_hash(self, password, method='pbkdf2:sha512', salt_length=12):
+        return self._run(werkzeug.security.generate_password_hash, password, method=method, salt_length=salt_length)
+
+    def shutdown(self, wait=True):
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
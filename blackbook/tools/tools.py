@@ -4,13 +4,12 @@ __author__ = 'ievans3024'
 
 
 def check_angular_xsrf():
-    if request.headers['X-XSRF-TOKEN']:
+    if request.headers.get('X-XSRF-TOKEN'):
         if not session.get('XSRF-TOKEN'):
             return False
         elif request.headers['X-XSRF-TOKEN'] == session.get('XSRF-TOKEN'):
             return True
-    else:
-        return False
+    return False
 
 
 def request_accepts(request, *mimetypes):
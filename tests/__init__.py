@@ -0,0 +1,53 @@
+"""
+Blackbook modules read current_app.config when they are imported, so the tests push an
+application context for the whole run, configured against a couchstub server.
+"""
+import unittest
+import uuid
+
+from flask import Flask
+
+from tests import couchstub
+
+__author__ = 'ievans3024'
+
+app = Flask('blackbook')
+app.config.from_pyfile('config.py', silent=True)
+app.config.update(
+    COUCHDB_WARM_UP_VIEWS=False,
+    COUCHDB_RETRY_BACKOFF=0.001,
+    SEARCH_INDEX_PATH=None
+)
+app.app_context().push()
+
+server = couchstub.Server().start()
+app.config['COUCHDB_URI'] = server.url
+
+
+def user_docs(user_id, contacts=1):
+    """Raw documents for a user with some contacts."""
+    contact_ids = ['{user}-c{n}'.format(user=user_id, n=n) for n in range(contacts)]
+    docs = [{
+        '_id': user_id, 'id': user_id, 'type': 'user', 'email': user_id + '@example.com', 'name': user_id,
+        'contacts': contact_ids, 'groups': [], 'permissions': []
+    }]
+    docs += [{
+        '_id': i, 'id': i, 'type': 'contact', 'user': user_id, 'name_first': 'First', 'name_last': 'Last',
+        'addresses': [], 'emails': [], 'phone_numbers': []
+    } for i in contact_ids]
+    return docs
+
+
+class CouchTestCase(unittest.TestCase):
+    """Gives every test its own, set up, database on the stub server."""
+
+    def setUp(self):
+        import blackbook.database.couch.database
+
+        app.config['COUCHDB_NAME'] = 'test-' + uuid.uuid4().hex
+        self.db = blackbook.database.couch.database.CouchDatabase()
+        self.db.setup()
+
+    def tearDown(self):
+        with server.lock:
+            server.databases.pop(self.db.dbname, None)
@@ -0,0 +1,333 @@
+"""
+An in-memory stand-in for a CouchDB server, enough of its HTTP API for the couch and aiocouch backends.
+
+Design doc javascript can't run here, so views are python map functions registered in VIEWS,
+mirroring the ones in blackbook/database/couch/design_docs. Update handlers are python functions in UPDATES.
+"""
+import http.server
+import json
+import socketserver
+import threading
+import time
+import uuid
+
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+
+__author__ = 'ievans3024'
+
+
+def collation_key(value):
+    """Order values the way CouchDB collates view keys: null, false, true, numbers, strings, arrays, objects."""
+    if value is None:
+        return 0,
+    if value is False:
+        return 1,
+    if value is True:
+        return 2,
+    if isinstance(value, (int, float)):
+        return 3, value
+    if isinstance(value, str):
+        return 4, value
+    if isinstance(value, list):
+        return 5, tuple(collation_key(v) for v in value)
+    return 6, tuple(sorted((k, collation_key(v)) for k, v in value.items()))
+
+
+def _cards(prefix):
+    def cards(doc):
+        if doc.get('type') != 'contact':
+            return []
+        rows = [(prefix(doc) + [doc['_id'], 0], None)]
+        for i, field in enumerate(('addresses', 'emails', 'phone_numbers')):
+            rows += [(prefix(doc) + [doc['_id'], 1, i, j], {'_id': c}) for j, c in enumerate(doc.get(field) or [])]
+        return rows
+    return cards
+
+
+VIEWS = {
+    'contact/all': lambda d: [(d['_id'], d)] if d.get('type') == 'contact' else [],
+    'contact/by_user': lambda d: [(d.get('user'), d)] if d.get('type') == 'contact' else [],
+    'contact/by_name': lambda d: [(d['name_first'].lower(), None)]
+    if d.get('type') == 'contact' and d.get('name_first') else [],
+    'contact/by_surname': lambda d: [(d['name_last'].lower(), None)]
+    if d.get('type') == 'contact' and d.get('name_last') else [],
+    'contact/by_address': lambda d: [
+        (d[f].lower(), {'_id': d['contact']})
+        for f in ('line_1', 'line_2', 'city', 'state', 'zip', 'country') if d.get(f)
+    ] if d.get('type') == 'contactaddress' and d.get('contact') else [],
+    'contact/by_phone_number': lambda d: [(''.join(c for c in d['number'] if c.isdigit()), {'_id': d['contact']})]
+    if d.get('type') == 'contactphone' and d.get('contact') and d.get('number') else [],
+    'contact/by_email': lambda d: [(d['address'].lower(), {'_id': d['contact']})]
+    if d.get('type') == 'contactemail' and d.get('contact') and d.get('address') else [],
+    'contact/cards': _cards(lambda d: []),
+    'contact/cards_by_user': _cards(lambda d: [d.get('user')]),
+    'session/by_token': lambda d: [(d['token'], None)] if d.get('type') == 'session' else [],
+    'user/by_email': lambda d: [(d['email'].lower(), None)] if d.get('type') == 'user' and d.get('email') else [],
+}
+
+
+def _patch(doc, body):
+    if doc is None:
+        return 404, {'error': 'not_found', 'reason': 'missing'}
+    if 'type' in body and body['type'] != doc.get('type'):
+        return 400, {'error': 'bad_request', 'reason': 'type'}
+    doc.update((k, v) for k, v in body.items() if not k.startswith('_'))
+    return None, doc
+
+
+UPDATES = {'document/patch': _patch}
+
+
+class Database(object):
+
+    def __init__(self):
+        self.docs = {}  # _id -> latest revision, deleted ones too
+        self.seq = 0
+        self.changes = {}  # _id -> seq of its last change
+
+    def live(self, doc_id):
+        doc = self.docs.get(doc_id)
+        return None if doc is None or doc.get('_deleted') else doc
+
+    def write(self, doc):
+        """Store a revision, checking it against the current one. :return: (status, response body)"""
+        doc_id = doc.get('_id') or uuid.uuid4().hex
+        current = self.docs.get(doc_id)
+        if current is not None and not current.get('_deleted'):
+            if doc.get('_rev') != current['_rev']:
+                return 409, {'id': doc_id, 'error': 'conflict', 'reason': 'Document update conflict.'}
+        elif doc.get('_rev') and (current is None or doc['_rev'] != current['_rev']):
+            return 409, {'id': doc_id, 'error': 'conflict', 'reason': 'Document update conflict.'}
+        generation = int(current['_rev'].split('-')[0]) if current is not None else 0
+        doc = dict(doc, _id=doc_id, _rev='{n}-{h}'.format(n=generation + 1, h=uuid.uuid4().hex))
+        if doc_id.startswith('_local/'):
+            self.docs[doc_id] = doc
+            return 201, {'ok': True, 'id': doc_id, 'rev': doc['_rev']}
+        if doc.get('_deleted'):
+            doc = {'_id': doc_id, '_rev': doc['_rev'], '_deleted': True}
+        self.docs[doc_id] = doc
+        self.seq += 1
+        self.changes[doc_id] = self.seq
+        return 201, {'ok': True, 'id': doc_id, 'rev': doc['_rev']}
+
+    def view(self, name, query, keys=None):
+        rows = []
+        for doc_id, doc in list(self.docs.items()):
+            if doc.get('_deleted') or doc_id.startswith('_'):
+                continue
+            for key, value in VIEWS[name](doc):
+                rows.append({'id': doc_id, 'key': key, 'value': value})
+        return self._select(rows, query, keys)
+
+    def all_docs(self, query, keys=None):
+        if keys is not None:
+            rows = []
+            for key in keys:
+                doc = self.docs.get(key)
+                if doc is None or key.startswith('_local/'):
+                    rows.append({'key': key, 'error': 'not_found'})
+                elif doc.get('_deleted'):
+                    rows.append({'id': key, 'key': key, 'value': {'rev': doc['_rev'], 'deleted': True}, 'doc': None})
+                else:
+                    rows.append({'id': key, 'key': key, 'value': {'rev': doc['_rev']}, 'doc': doc})
+            if not query.get('include_docs'):
+                for row in rows:
+                    row.pop('doc', None)
+            return rows
+        rows = [
+            {'id': i, 'key': i, 'value': {'rev': d['_rev']}} for i, d in self.docs.items()
+            if not d.get('_deleted') and not i.startswith('_local/')
+        ]
+        return self._select(rows, query)
+
+    def _select(self, rows, query, keys=None):
+        rows.sort(key=lambda r: (collation_key(r['key']), r['id']))
+        descending = query.get('descending') is True
+        if descending:
+            rows.reverse()
+        if keys is not None:
+            rows = [r for key in keys for r in rows if r['key'] == key]
+        if 'key' in query:
+            rows = [r for r in rows if r['key'] == query['key']]
+        if 'startkey' in query:
+            start = (collation_key(query['startkey']), query.get('startkey_docid', '￿' if descending else ''))
+            if descending:
+                rows = [r for r in rows if (collation_key(r['key']), r['id']) <= start]
+            else:
+                rows = [r for r in rows if (collation_key(r['key']), r['id']) >= start]
+        if 'endkey' in query:
+            end = collation_key(query['endkey'])
+            if descending:
+                rows = [r for r in rows if collation_key(r['key']) >= end]
+            else:
+                rows = [r for r in rows if collation_key(r['key']) <= end]
+        rows = rows[query.get('skip', 0):]
+        if 'limit' in query:
+            rows = rows[:query['limit']]
+        if query.get('include_docs'):
+            for row in rows:
+                value = row['value']
+                linked = value['_id'] if isinstance(value, dict) and '_id' in value else row['id']
+                row['doc'] = self.live(linked)
+        return rows
+
+    def changes_since(self, since, limit=None, include_docs=False):
+        changed = sorted((seq, doc_id) for doc_id, seq in self.changes.items() if seq > since)
+        if limit is not None:
+            changed = changed[:limit]
+        results = []
+        for seq, doc_id in changed:
+            doc = self.docs[doc_id]
+            result = {'seq': seq, 'id': doc_id, 'changes': [{'rev': doc['_rev']}]}
+            if doc.get('_deleted'):
+                result['deleted'] = True
+            if include_docs:
+                result['doc'] = doc
+            results.append(result)
+        return {'results': results, 'last_seq': changed[-1][0] if changed else since}
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    A CouchDB stand-in on a free local port, serving from a thread.
+
+        server = Server()
+        server.start()
+        ... server.url ...
+        server.stop()
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self):
+        super(Server, self).__init__(('127.0.0.1', 0), Handler)
+        self.databases = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        # seconds every request takes before it is handled, e.g. a network round trip, not holding the lock
+        self.latency = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{port}'.format(port=self.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _value(raw):
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, which would wait on the client's delayed ack
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def handle_method(self):
+        server = self.server
+        url = urlsplit(self.path)
+        parts = [unquote(p) for p in url.path.strip('/').split('/') if p]
+        query = {k: _value(v[0]) for k, v in parse_qs(url.query).items()}
+        body = None
+        if self.headers.get('Content-Length'):
+            raw = self.rfile.read(int(self.headers['Content-Length']))
+            body = json.loads(raw.decode('utf-8')) if raw else None
+        if server.latency:
+            time.sleep(server.latency)
+
+        with server.lock:
+            server.requests += 1
+            if not parts:
+                return self.reply(200, {'couchdb': 'Welcome', 'version': '1.6.1'})
+            if parts[0] == '_active_tasks':
+                return self.reply(200, [])
+            if len(parts) == 1:
+                if self.command == 'PUT':
+                    if parts[0] in server.databases:
+                        return self.reply(412, {'error': 'file_exists', 'reason': 'exists'})
+                    server.databases[parts[0]] = Database()
+                    return self.reply(201, {'ok': True})
+                if parts[0] not in server.databases:
+                    return self.reply(404, {'error': 'not_found', 'reason': 'no_db_file'})
+                if self.command == 'DELETE':
+                    del server.databases[parts[0]]
+                    return self.reply(200, {'ok': True})
+                if self.command == 'POST':
+                    status, result = server.databases[parts[0]].write(body)
+                    return self.reply(status, result)
+                return self.reply(200, {'db_name': parts[0], 'update_seq': server.databases[parts[0]].seq})
+            db = server.databases.get(parts[0])
+            if db is None:
+                return self.reply(404, {'error': 'not_found', 'reason': 'no_db_file'})
+            return self.handle_database(db, parts[1:], query, body)
+
+    def handle_database(self, db, parts, query, body):
+        if parts[0] == '_changes':
+            return self.reply(200, db.changes_since(
+                int(query.get('since') or 0), limit=query.get('limit'), include_docs=query.get('include_docs') is True
+            ))
+        if parts[0] == '_all_docs':
+            keys = (body or {}).get('keys') if self.command == 'POST' else None
+            return self.reply(200, {'rows': db.all_docs(query, keys)})
+        if parts[0] == '_bulk_docs':
+            return self.reply(201, [db.write(doc)[1] for doc in body['docs']])
+        if parts[0] == '_design' and len(parts) == 4 and parts[2] == '_view':
+            keys = (body or {}).get('keys') if self.command == 'POST' else None
+            return self.reply(200, {'rows': db.view(parts[1] + '/' + parts[3], query, keys)})
+        if parts[0] == '_design' and len(parts) == 5 and parts[2] == '_update':
+            current = db.live(parts[4])
+            status, result = UPDATES[parts[1] + '/' + parts[3]](dict(current) if current else None, body or {})
+            if status is not None:
+                return self.reply(status, result)
+            status, written = db.write(result)
+            if status != 201:
+                return self.reply(status, written)
+            result['_rev'] = written['rev']
+            return self.reply(201, result, {'X-Couch-Update-NewRev': written['rev']})
+
+        doc_id = '/'.join(parts)
+        if self.command in ('GET', 'HEAD'):
+            doc = db.docs.get(doc_id) if doc_id.startswith('_local/') else db.live(doc_id)
+            if doc is None:
+                return self.reply(404, {'error': 'not_found', 'reason': 'missing'})
+            return self.reply(200, doc, {'ETag': '"{rev}"'.format(rev=doc['_rev'])})
+        if self.command == 'PUT':
+            status, result = db.write(dict(body, _id=doc_id))
+            return self.reply(status, result)
+        if self.command == 'DELETE':
+            status, result = db.write({'_id': doc_id, '_rev': query.get('rev'), '_deleted': True})
+            return self.reply(200 if status == 201 else status, result)
+        return self.reply(405, {'error': 'method_not_allowed', 'reason': self.command})
+
+    def do_GET(self):
+        self.handle_method()
+
+    do_HEAD = do_PUT = do_POST = do_DELETE = do_GET
@@ -0,0 +1,55 @@
+import uuid
+
+from flask import Flask
+
+from tests import app
+from tests import server
+from tests import user_docs
+from tests.test_aiocouch_database import AsyncCouchTestCase
+from tests.test_couch_api import session_doc
+
+__author__ = 'ievans3024'
+
+
+class AsyncContactGetTestCase(AsyncCouchTestCase):
+
+    def setUp(self):
+        super(AsyncContactGetTestCase, self).setUp()
+        import blackbook.database.aiocouch.api
+        import blackbook.database.couch.api
+
+        flask_app = Flask('blackbook')
+        flask_app.config.update(app.config)
+        flask_app.register_blueprint(blackbook.database.couch.api.init_api(
+            flask_app, database=self.async_db, contact_api=blackbook.database.aiocouch.api.Contact
+        ))
+        self.client = flask_app.test_client()
+
+        self.token = uuid.uuid4().hex
+        self.db.db.update(user_docs('u1', contacts=2) + user_docs('u2') + [session_doc('u1', self.token)])
+        self.async_db.run(self.async_db.replicate(self.db))
+
+        self.queries = []
+        query = self.async_db.query
+        # the names of the views queried, e.g. by_user
+        self.async_db.query = lambda view, *args, **kwargs: \
+            self.queries.append(getattr(view, 'name', view)) or query(view, *args, **kwargs)
+
+    def test_user_contacts(self):
+        with self.client.session_transaction() as flask_session:
+            flask_session['id'] = self.token
+        self.assertEqual(self.client.get('/api/user/u1/contacts/').status_code, 200)
+        self.assertIn('by_user', self.queries)
+        del self.queries[:]
+
+        # someone else's contacts aren't listed at all
+        self.assertEqual(self.client.get('/api/user/u2/contacts/').status_code, 404)
+        self.assertNotIn('by_user', self.queries)
+
+    def test_unauthenticated(self):
+        with server.lock:
+            requests = server.requests
+        self.assertEqual(self.client.get('/api/user/u1/contacts/').status_code, 401)
+        self.assertEqual(self.queries, [])
+        with server.lock:
+            self.assertEqual(server.requests, requests)
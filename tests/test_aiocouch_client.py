@@ -0,0 +1,74 @@
+import asyncio
+import json
+import unittest
+
+from blackbook.database.aiocouch.client import AsyncCouchClient
+
+__author__ = 'ievans3024'
+
+
+class StaleConnectionTestCase(unittest.TestCase):
+    """A server that closes every connection after one response, without saying so, like an expired keep-alive."""
+
+    def setUp(self):
+        self.requests = []
+
+    async def handle(self, reader, writer):
+        headers = {}
+        request_line = await reader.readline()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        self.requests.append((request_line.split()[0].decode('ascii'), json.loads(body.decode('utf-8'))))
+        if self.respond:
+            data = json.dumps([{'id': doc['_id'], 'rev': '1-a'} for doc in self.requests[-1][1]['docs']])
+            writer.write((
+                'HTTP/1.1 201 Created\r\nContent-Type: application/json\r\n'
+                'Content-Length: {length}\r\n\r\n{data}'.format(length=len(data), data=data)
+            ).encode('latin-1'))
+            await writer.drain()
+        writer.close()
+
+    def run_client(self, coroutine_function):
+        async def run():
+            server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            client = AsyncCouchClient('http://127.0.0.1:{port}'.format(port=port), 'test', timeout=5)
+            try:
+                return await coroutine_function(client)
+            finally:
+                client.close()
+                server.close()
+                await server.wait_closed()
+        return asyncio.run(run())
+
+    def test_post_retried_on_closed_connection(self):
+        self.respond = True
+
+        async def write(client):
+            first = await client.bulk_docs([{'_id': 'a'}])
+            # let the server's close arrive, the connection is still idle in the client
+            await asyncio.sleep(0.05)
+            second = await client.bulk_docs([{'_id': 'b'}])
+            return first, second, client.stats
+
+        first, second, stats = self.run_client(write)
+        self.assertEqual([result['id'] for result in first + second], ['a', 'b'])
+        self.assertEqual([docs for method, docs in self.requests], [{'docs': [{'_id': 'a'}]}, {'docs': [{'_id': 'b'}]}])
+        self.assertEqual((stats['created'], stats['reused'], stats['retries']), (2, 1, 1))
+
+    def test_post_not_retried_on_new_connection(self):
+        self.respond = False
+
+        async def write(client):
+            with self.assertRaises(ConnectionResetError):
+                await client.bulk_docs([{'_id': 'a'}])
+            return client.stats
+
+        stats = self.run_client(write)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual((stats['created'], stats['retries']), (1, 0))
@@ -0,0 +1,131 @@
+import threading
+import uuid
+
+import blackbook.database.couch.models as couch_models
+
+from blackbook.database import models
+from blackbook.database.aiocouch.database import AsyncCouchDatabase
+from blackbook.lib.search import InvertedIndex
+from tests import app
+from tests import CouchTestCase
+from tests import server
+from tests import user_docs
+
+__author__ = 'ievans3024'
+
+
+class AsyncCouchTestCase(CouchTestCase):
+    """Gives every test a second, asyncio backed, database next to the couch one."""
+
+    def setUp(self):
+        super(AsyncCouchTestCase, self).setUp()
+        app.config['COUCHDB_NAME'] = 'test-' + uuid.uuid4().hex
+        self.async_db = AsyncCouchDatabase()
+
+    def tearDown(self):
+        self.async_db.client.close()
+        self.async_db.loop.call_soon_threadsafe(self.async_db.loop.stop)
+        with server.lock:
+            server.databases.pop(self.async_db.dbname, None)
+        super(AsyncCouchTestCase, self).tearDown()
+
+
+class ReplicateTestCase(AsyncCouchTestCase):
+
+    def names(self, db, ids):
+        return sorted(doc.name for doc in db.read(models.Group, ids))
+
+    def async_names(self, ids):
+        return sorted(doc.name for doc in self.async_db.run(self.async_db.read(models.Group, ids)))
+
+    def test_replicate_from_couch(self):
+        groups = [models.Group('group{n}'.format(n=n), 'Group', _id='g{n}'.format(n=n)) for n in range(5)]
+        self.db.create_many(groups)
+        ids = [group.id for group in groups]
+
+        reports = []
+        stats = self.async_db.run(self.async_db.replicate(self.db, batch_size=2, progress=reports.append))
+        self.assertEqual((stats['written'], stats['deleted'], stats['errors']), (5, 0, 0))
+        # a report per batch, the design docs are in the source's changes too but never replicated
+        self.assertGreater(len(reports), 2)
+        self.assertEqual(reports[-1]['written'], 5)
+        self.assertEqual(self.async_names(ids), self.names(self.db, ids))
+
+        # resumes from the checkpoint: only the changes since are replicated
+        doc = self.db.read(models.Group, 'g1')[0]
+        doc.name = 'renamed'
+        self.db.update(doc)
+        self.db.delete(groups[0])
+        stats = self.async_db.run(self.async_db.replicate(self.db, batch_size=2))
+        self.assertEqual((stats['written'], stats['deleted'], stats['errors']), (1, 1, 0))
+        self.assertEqual(self.async_names(ids), ['group2', 'group3', 'group4', 'renamed'])
+
+    def test_replicate_to_couch(self):
+        groups = [models.Group('group{n}'.format(n=n), 'Group', _id='g{n}'.format(n=n)) for n in range(3)]
+        self.async_db.run(self.async_db.create_many(groups))
+        ids = [group.id for group in groups]
+
+        stats = self.db.replicate(self.async_db)
+        self.assertEqual((stats['written'], stats['deleted'], stats['errors']), (3, 0, 0))
+        self.assertEqual(self.names(self.db, ids), ['group0', 'group1', 'group2'])
+
+        self.async_db.run(self.async_db.delete(groups[2]))
+        stats = self.db.replicate(self.async_db)
+        self.assertEqual((stats['written'], stats['deleted'], stats['errors']), (0, 1, 0))
+        self.assertEqual(self.names(self.db, ids), ['group0', 'group1'])
+
+
+class UserListenersTestCase(AsyncCouchTestCase):
+
+    def test_update_user(self):
+        self.db.db.update(user_docs('u1'))
+        changed = []
+        self.async_db.user_listeners.append(changed.append)
+        self.async_db.run(self.async_db.replicate(self.db))
+        self.assertEqual(changed, [])
+
+        user = self.async_db.run(self.async_db.read(couch_models.User, 'u1'))[0]
+        user.permissions = ['blackbook']
+        self.async_db.run(self.async_db.update(user))
+        self.assertEqual(changed, ['u1'])
+
+
+class SearchIndexOffLoopTestCase(AsyncCouchTestCase):
+
+    def test_index_off_loop(self):
+        self.db.db.update(user_docs('u1', contacts=2))
+        self.async_db.run(self.async_db.replicate(self.db))
+        self.async_db.search_index = InvertedIndex()
+        threads = []
+
+        def recording(method):
+            return lambda *args: threads.append(threading.current_thread()) or method(*args)
+
+        self.async_db._index_document = recording(self.async_db._index_document)
+        self.async_db._unindex_document = recording(self.async_db._unindex_document)
+
+        contact = self.async_db.run(self.async_db.read(couch_models.Contact, 'u1-c0'))[0]
+        contact.name_first = 'Ada'
+        self.async_db.run(self.async_db.update(contact))
+        self.assertEqual([key for key, score in self.async_db.search_index.search('ada')], ['u1-c0'])
+        self.async_db.run(self.async_db.delete_cascade(contact))
+        self.assertEqual(self.async_db.search_index.search('ada'), [])
+
+        self.assertGreater(len(threads), 1)
+        self.assertNotIn(self.async_db._loop_thread, threads)
+
+    def test_search_off_loop(self):
+        self.db.db.update(user_docs('u1', contacts=2))
+        self.async_db.run(self.async_db.replicate(self.db))
+        self.async_db.search_index = InvertedIndex()
+        self.addCleanup(self.async_db.stop_search_indexer, 5)
+        self.async_db.run(self.async_db.rebuild_search_index())
+        threads = []
+        search = self.async_db.search_index.search
+        self.async_db.search_index.search = lambda *args, **kwargs: threads.append(threading.current_thread()) or \
+            search(*args, **kwargs)
+
+        found = self.async_db.run(self.async_db.search('first', model=couch_models.Contact))
+        self.assertEqual(sorted(contact.id for contact in found), ['u1-c0', 'u1-c1'])
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], self.async_db._loop_thread)
@@ -0,0 +1,51 @@
+import unittest
+
+from blackbook.lib.collection_plus_json import Array
+from blackbook.lib.collection_plus_json import Link
+
+__author__ = 'ievans3024'
+
+
+def links(*rels):
+    return [Link('/' + rel, rel) for rel in rels]
+
+
+class IndexedArrayTestCase(unittest.TestCase):
+    """Every mutator has to drop the lazily built indexes, or get() answers from stale positions."""
+
+    # name -> mutation of an indexed Array of links with rels r0, r1, r2
+    mutations = {
+        '__setitem__': lambda a: a.__setitem__(0, Link('/r3', 'r3')),
+        '__setitem__ slice': lambda a: a.__setitem__(slice(0, 2), links('r4', 'r3')),
+        '__delitem__': lambda a: a.__delitem__(0),
+        '__iadd__': lambda a: a.__iadd__(Array(links('r3'), Link)),
+        '__imul__': lambda a: a.__imul__(0),
+        'append': lambda a: a.append(Link('/r3', 'r3')),
+        'extend': lambda a: a.extend(Array(links('r3'), Link)),
+        'extend iterable': lambda a: a.extend(links('r3')),
+        'insert': lambda a: a.insert(0, Link('/r3', 'r3')),
+        'pop': lambda a: a.pop(0),
+        'remove': lambda a: a.remove(a[1]),
+        'reverse': lambda a: a.reverse(),
+        'sort': lambda a: a.sort(key=lambda link: link.rel, reverse=True),
+        'clear': lambda a: a.clear(),
+    }
+
+    def test_mutators(self):
+        for name, mutate in self.mutations.items():
+            with self.subTest(mutator=name):
+                array = Array(links('r0', 'r1', 'r2'), Link, indexed=True)
+                for rel in ('r0', 'r1', 'r2'):
+                    self.assertEqual(array.get(rel=rel).rel, rel)
+
+                mutate(array)
+                for rel in ('r0', 'r1', 'r2', 'r3', 'r4'):
+                    expected = next((link for link in array.data if link.rel == rel), None)
+                    self.assertIs(array.get(rel=rel), expected)
+
+    def test_sort(self):
+        array = Array(links('r1', 'r0'), Link, indexed=True)
+        self.assertEqual(array.get(rel='r0').href, '/r0')
+        array.sort(key=lambda link: link.rel)
+        self.assertEqual(array.get(rel='r0').href, '/r0')
+        self.assertEqual(array.get(rel='r1').href, '/r1')
@@ -0,0 +1,361 @@
+import collections
+import json
+import threading
+import time
+import unittest.mock
+import uuid
+import werkzeug.security
+
+from flask import Flask
+
+from tests import app
+from tests import CouchTestCase
+from tests import user_docs
+
+__author__ = 'ievans3024'
+
+
+def session_doc(user_id, token):
+    return {
+        '_id': 'session-' + token, 'id': 'session-' + token, 'type': 'session', 'user': user_id, 'token': token,
+        'expiry': '2099-01-01T00:00:00Z'
+    }
+
+
+class CouchAPITestCase(CouchTestCase):
+    """Drives the api blueprint's views, with requests authenticated as user u1."""
+
+    def setUp(self):
+        super(CouchAPITestCase, self).setUp()
+        import blackbook.database.couch.api
+
+        self.db.search_index_poll_interval = 0.01
+        self.addCleanup(self.db.stop_search_indexer, 5)
+        flask_app = Flask('blackbook')
+        flask_app.config.update(app.config)
+        flask_app.register_blueprint(blackbook.database.couch.api.init_api(flask_app, database=self.db))
+        self.client = flask_app.test_client()
+
+        self.token = uuid.uuid4().hex
+        self.db.db.update(user_docs('u1', contacts=2) + user_docs('u2') + [session_doc('u1', self.token)])
+        with self.client.session_transaction() as flask_session:
+            flask_session['id'] = self.token
+
+    def items(self, response):
+        """The items of a collection+json response, as {href: {data name: value}}."""
+        collection = json.loads(response.get_data(as_text=True))['collection']
+        return {item['href']: {d['name']: d.get('value') for d in item['data']} for item in collection['items']}
+
+    def template_names(self, response):
+        collection = json.loads(response.get_data(as_text=True))['collection']
+        return [d['name'] for d in collection.get('template', {}).get('data', [])]
+
+
+class ContactGetTestCase(CouchAPITestCase):
+
+    def test_unauthenticated(self):
+        with self.client.session_transaction() as flask_session:
+            flask_session.pop('id')
+        self.assertEqual(self.client.get('/api/contact/').status_code, 401)
+
+    def test_list(self):
+        response = self.client.get('/api/contact/')
+        self.assertEqual(response.status_code, 200)
+        items = self.items(response)
+        # only the user's own contacts
+        self.assertEqual(sorted(items), ['/api/contact/u1-c0/', '/api/contact/u1-c1/'])
+        self.assertEqual(items['/api/contact/u1-c0/']['name_first'], 'First')
+        self.assertEqual(self.template_names(response), ['name_first', 'name_last'])
+
+    def test_list_permission(self):
+        self.db.db.save(dict(self.db.db['u1'], permissions=[self.db.dbname + '.read.contact']))
+        response = self.client.get('/api/contact/')
+        self.assertEqual(sorted(self.items(response)), ['/api/contact/u1-c0/', '/api/contact/u1-c1/',
+                                                        '/api/contact/u2-c0/'])
+
+    def test_one(self):
+        response = self.client.get('/api/contact/u1-c1/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(self.items(response)), ['/api/contact/u1-c1/'])
+        self.assertEqual(self.template_names(response), ['name_first', 'name_last'])
+        # someone else's, or missing
+        self.assertEqual(self.client.get('/api/contact/u2-c0/').status_code, 404)
+        self.assertEqual(self.client.get('/api/contact/missing/').status_code, 404)
+
+    def test_user_contacts(self):
+        response = self.client.get('/api/user/u1/contacts/')
+        self.assertEqual(sorted(self.items(response)), ['/api/contact/u1-c0/', '/api/contact/u1-c1/'])
+        self.assertEqual(self.client.get('/api/user/u2/contacts/').status_code, 404)
+        self.assertEqual(self.client.get('/api/user/missing/contacts/').status_code, 404)
+
+    def test_search(self):
+        self.db.db.save(dict(self.db.db['u1-c1'], name_first='Ada'))
+        self.db.db.save(dict(self.db.db['u2-c0'], name_first='Ada'))
+        deadline = time.monotonic() + 5
+        response = self.client.get('/api/contact/?q=ada')
+        while response.status_code == 503 and time.monotonic() < deadline:
+            # the search index is being built
+            time.sleep(0.01)
+            response = self.client.get('/api/contact/?q=ada')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(self.items(response)), ['/api/contact/u1-c1/'])
+
+        response = self.client.get('/api/contact/?name=ada')
+        self.assertEqual(list(self.items(response)), ['/api/contact/u1-c1/'])
+
+
+class ContactUpdateTestCase(CouchAPITestCase):
+
+    def template(self, **values):
+        return json.dumps({'template': {'data': [{'name': k, 'value': v} for k, v in values.items()]}})
+
+    def test_put(self):
+        response = self.client.put('/api/contact/u1-c0/', data=self.template(name_first='Ada', name_last='Lovelace'),
+                                   content_type='application/vnd.collection+json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.items(response)['/api/contact/u1-c0/']['name_last'], 'Lovelace')
+        self.assertEqual(self.template_names(response), ['name_first', 'name_last'])
+        self.assertEqual(self.db.db['u1-c0']['name_first'], 'Ada')
+
+        # every field is required
+        response = self.client.put('/api/contact/u1-c0/', data=self.template(name_first='Ada'),
+                                   content_type='application/vnd.collection+json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_patch(self):
+        # changed elsewhere meanwhile, kept since PATCH only writes what it changes
+        self.db.db.save(dict(self.db.db['u1-c0'], emails=['e1']))
+        response = self.client.patch('/api/contact/u1-c0/', data=self.template(name_last='Lovelace'),
+                                     content_type='application/vnd.collection+json')
+        self.assertEqual(response.status_code, 200)
+        doc = self.db.db['u1-c0']
+        self.assertEqual((doc['name_first'], doc['name_last'], doc['emails']), ('First', 'Lovelace', ['e1']))
+
+        response = self.client.patch('/api/contact/u1-c0/', data=self.template(unknown='x'),
+                                     content_type='application/vnd.collection+json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_not_found(self):
+        for contact_id in ('u2-c0', 'missing'):
+            response = self.client.patch('/api/contact/{id}/'.format(id=contact_id),
+                                         data=self.template(name_last='Lovelace'),
+                                         content_type='application/vnd.collection+json')
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.db.db['u2-c0']['name_last'], 'Last')
+
+    def test_update_errors(self):
+        import blackbook.database
+
+        def fail(error):
+            def update(document):
+                raise error
+            return update
+
+        for error, status in ((blackbook.database.NotFoundError(), 404), (blackbook.database.ConflictError(), 409),
+                              (blackbook.database.DatabaseUnreachableError(), 503)):
+            self.db.update = fail(error)
+            response = self.client.put('/api/contact/u1-c0/',
+                                       data=self.template(name_first='Ada', name_last='Lovelace'),
+                                       content_type='application/vnd.collection+json')
+            self.assertEqual(response.status_code, status)
+
+
+class ContactDeleteTestCase(CouchAPITestCase):
+
+    def test_delete(self):
+        email = {'_id': 'u1-c0-e', 'id': 'u1-c0-e', 'type': 'contactemail', 'contact': 'u1-c0', 'address': 'a@b.c'}
+        self.db.db.update([email, dict(self.db.db['u1-c0'], emails=['u1-c0-e'])])
+
+        response = self.client.delete('/api/contact/u1-c0/')
+        self.assertEqual(response.status_code, 204)
+        # along with what it owns, and taken off its user
+        self.assertNotIn('u1-c0', self.db.db)
+        self.assertNotIn('u1-c0-e', self.db.db)
+        self.assertEqual(self.db.db['u1']['contacts'], ['u1-c1'])
+        self.assertEqual(self.client.get('/api/contact/u1-c0/').status_code, 404)
+
+    def test_not_found(self):
+        self.assertEqual(self.client.delete('/api/contact/u2-c0/').status_code, 404)
+        self.assertIn('u2-c0', self.db.db)
+        self.assertEqual(self.client.delete('/api/contact/missing/').status_code, 404)
+
+        with self.client.session_transaction() as flask_session:
+            flask_session.pop('id')
+        self.assertEqual(self.client.delete('/api/contact/u1-c0/').status_code, 401)
+        self.assertIn('u1-c0', self.db.db)
+
+    def test_permission(self):
+        self.db.db.save(dict(self.db.db['u1'], permissions=[self.db.dbname + '.delete.contact']))
+        self.assertEqual(self.client.delete('/api/contact/u2-c0/').status_code, 204)
+        self.assertNotIn('u2-c0', self.db.db)
+        self.assertEqual(self.db.db['u2']['contacts'], [])
+
+
+class ContactCardsTestCase(CouchAPITestCase):
+    """Listings read from the cards views, see COUCHDB_CONTACT_CARDS."""
+
+    def setUp(self):
+        import blackbook.database.couch.api
+
+        # a class attribute read from config at import, so set it for these tests only
+        patcher = unittest.mock.patch.object(blackbook.database.couch.api.Contact, 'contact_cards', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(ContactCardsTestCase, self).setUp()
+
+    def test_consistent_under_concurrent_edits(self):
+        email = {'_id': 'e', 'id': 'e', 'type': 'contactemail', 'contact': 'u1-c0', 'address': 'v0@example.com'}
+        self.db.db.update([email, dict(self.db.db['u1-c0'], emails=['e'], name_last='v0')])
+
+        stop = threading.Event()
+        errors = []
+
+        def edit():
+            # move the email back and forth, and stamp each version on the contact it belongs to
+            n = 0
+            while not stop.is_set():
+                n += 1
+                moved_to, moved_from = ('u1-c1', 'u1-c0') if n % 2 else ('u1-c0', 'u1-c1')
+                version = 'v{n}'.format(n=n)
+                results = self.db.db.update([
+                    dict(self.db.db['e'], contact=moved_to, address=version + '@example.com'),
+                    dict(self.db.db[moved_to], emails=['e'], name_last=version),
+                    dict(self.db.db[moved_from], emails=[])
+                ])
+                errors.extend(doc_id for ok, doc_id, rev in results if not ok)
+
+        editor = threading.Thread(target=edit)
+        editor.start()
+        shown = 0
+        try:
+            for _ in range(50):
+                response = self.client.get('/api/contact/')
+                self.assertEqual(response.status_code, 200)
+                for href, data in self.items(response).items():
+                    for rendered in data['emails'] or []:
+                        shown += 1
+                        # only under the contact it belongs to, as of the same read
+                        self.assertEqual(href, '/api/contact/{id}/'.format(id=rendered['contact']))
+                        self.assertEqual(rendered['address'], data['name_last'] + '@example.com')
+        finally:
+            stop.set()
+            editor.join()
+        self.assertEqual(errors, [])
+        self.assertGreater(shown, 0)
+
+
+class SessionPostTestCase(CouchAPITestCase):
+
+    # cheap enough for tests, the method and iterations are stored with the hash
+    password_hash = werkzeug.security.generate_password_hash('secret', method='pbkdf2:sha512:20000')
+
+    def setUp(self):
+        super(SessionPostTestCase, self).setUp()
+        import blackbook.database.couch.models
+
+        self.hasher = blackbook.database.couch.models.User.password_hasher
+        self.addCleanup(self.hasher.shutdown)
+        self.db.db.save(dict(self.db.db['u1'], password_hash=self.password_hash))
+        with self.client.session_transaction() as flask_session:
+            flask_session.pop('id')
+
+    def login(self, email='u1@example.com', password='secret'):
+        return self.client.post('/api/session/', data=json.dumps({'template': {'data': [
+            {'name': 'email', 'value': email}, {'name': 'password', 'value': password}
+        ]}}), content_type='application/vnd.collection+json')
+
+    def test_login(self):
+        response = self.login(email='U1@example.com')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.get('/api/contact/').status_code, 200)
+        # started in the hasher's pool
+        self.assertIsNotNone(self.hasher._executor)
+
+    def test_login_failed(self):
+        response = self.login(password='guess')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.template_names(response), ['email', 'password'])
+        self.assertEqual(self.login(email='nobody@example.com').status_code, 401)
+        self.assertEqual(self.login(password='').status_code, 400)
+        self.assertEqual(self.client.get('/api/contact/').status_code, 401)
+
+    def test_hasher_busy(self):
+        for _ in range(self.hasher.max_pending):
+            self.hasher._slots.acquire()
+            self.addCleanup(self.hasher._slots.release)
+        response = self.login()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(self.client.get('/api/contact/').status_code, 401)
+
+    def test_login_storm(self):
+        """Other requests keep moving while logins are waiting on the hasher."""
+
+        def latencies(count):
+            timings = []
+            for _ in range(count):
+                started = time.perf_counter()
+                self.assertEqual(client.get('/api/contact/').status_code, 200)
+                timings.append(time.perf_counter() - started)
+            return sorted(timings)
+
+        # one client logged in for the requests timed, the storm logs in with others
+        client = self.client.application.test_client()
+        with client.session_transaction() as flask_session:
+            flask_session['id'] = self.token
+        quiet = latencies(60)
+
+        stop = threading.Event()
+        statuses = collections.Counter()
+
+        def storm():
+            storm_client = self.client.application.test_client()
+            while not stop.is_set():
+                response = storm_client.post('/api/session/', data=json.dumps({'template': {'data': [
+                    {'name': 'email', 'value': 'u1@example.com'}, {'name': 'password', 'value': 'secret'}
+                ]}}), content_type='application/vnd.collection+json')
+                statuses[response.status_code] += 1
+
+        threads = [threading.Thread(target=storm) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        try:
+            stormy = latencies(60)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+        p99 = lambda timings: timings[int(len(timings) * 0.99) - 1]
+        self.assertGreater(statuses[201], 0)
+        self.assertLess(p99(stormy), max(p99(quiet) * 20, 0.25), (p99(quiet), p99(stormy), statuses))
+
+
+class DescriptorOverheadTestCase(CouchAPITestCase):
+
+    def test_handler_hot_path(self):
+        """Handlers read self.db and self.model all the time, the descriptors behind them look their name up once."""
+        import blackbook.api
+
+        get = blackbook.api.APIType.__get__
+        spent = []
+
+        def timed_get(descriptor, instance, owner):
+            started = time.perf_counter()
+            try:
+                return get(descriptor, instance, owner)
+            finally:
+                spent.append(time.perf_counter() - started)
+
+        self.client.get('/api/contact/')
+        with unittest.mock.patch.object(blackbook.api.APIType, '__get__', timed_get), \
+                unittest.mock.patch.object(blackbook.api.APIType, 'get_own_name') as get_own_name:
+            started = time.perf_counter()
+            for path in ('/api/contact/', '/api/contact/u1-c1/') * 10:
+                self.assertEqual(self.client.get(path).status_code, 200)
+            total = time.perf_counter() - started
+
+        self.assertGreater(len(spent), 0)
+        get_own_name.assert_not_called()
+        # scanning dir() of the view class on every read took about 15% of a request
+        self.assertLess(sum(spent), total * 0.02)
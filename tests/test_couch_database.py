@@ -0,0 +1,225 @@
+import threading
+
+import blackbook.database
+import blackbook.database.couch.models as couch_models
+import blackbook.database.couch.pagination
+
+from blackbook.database import models
+from tests import CouchTestCase
+from tests import user_docs
+
+__author__ = 'ievans3024'
+
+
+class CreateTestCase(CouchTestCase):
+
+    def test_create_read_round_trip(self):
+        group = models.Group('admins', 'Administrators', permissions=['blackbook'])
+        self.db.create(group)
+
+        doc, = self.db.read(models.Group, group.id)
+        self.assertEqual(doc.id, group.id)
+        self.assertEqual(doc['_id'], group.id)
+        self.assertEqual(doc.name, 'admins')
+        self.assertEqual(doc.permissions, ['blackbook'])
+        self.assertEqual(doc.date_created, group.date_created)
+
+    def test_create_keeps_given_id(self):
+        self.db.create(models.Group('admins', 'Administrators', _id='admins'))
+        self.assertEqual(self.db.read(models.Group, 'admins')[0].name, 'admins')
+
+    def test_create_existing(self):
+        self.db.create(models.Group('admins', 'Administrators', _id='admins'))
+        with self.assertRaises(blackbook.database.EntryExistsError):
+            self.db.create(models.Group('admins', 'Again', _id='admins'))
+
+    def test_create_many_existing(self):
+        self.db.create(models.Group('admins', 'Administrators', _id='admins'))
+        results = self.db.create_many([
+            models.Group('admins', 'Again', _id='admins'),
+            models.Group('users', 'Users', _id='users')
+        ])
+        self.assertIsInstance(results[0][1], blackbook.database.EntryExistsError)
+        self.assertIsNone(results[1][1])
+        self.assertEqual(self.db.read(models.Group, 'users')[0].description, 'Users')
+        self.assertEqual(self.db.read(models.Group, 'admins')[0].description, 'Administrators')
+
+
+class DocumentIdTestCase(CouchTestCase):
+    """Views key and link on _id, documents stored before create() kept id in step have an id field that differs."""
+
+    def setUp(self):
+        super(DocumentIdTestCase, self).setUp()
+        docs = user_docs('u1')
+        docs[1].update(id='legacy', emails=['e1'])
+        docs.append({'_id': 'e1', 'id': 'e1', 'type': 'contactemail', 'contact': 'u1-c0', 'address': 'a@example.com'})
+        self.db.db.update(docs)
+
+    def test_doc_id(self):
+        contact, = self.db.read(couch_models.Contact, 'u1-c0')
+        self.assertEqual(contact.id, 'legacy')
+        self.assertEqual(contact.doc_id, 'u1-c0')
+        self.assertEqual(couch_models.Contact(id='new').doc_id, 'new')
+
+    def test_views_readable(self):
+        for view, options in (('all', {}), ('by_email', {'key': 'a@example.com', 'include_docs': True})):
+            with self.subTest(view=view):
+                contact, = getattr(couch_models.Contact, view)(self.db.db, **options)
+                self.assertEqual(self.db.read(couch_models.Contact, contact.doc_id)[0].name_first, 'First')
+
+
+class UpdateContentionTestCase(CouchTestCase):
+    """Many writers changing one contact at once, through the update handler and through plain saves."""
+
+    writers = 8
+
+    def setUp(self):
+        super(UpdateContentionTestCase, self).setUp()
+        self.db.db.update(user_docs('u1'))
+
+    def write_all(self, fields):
+        errors = []
+        start = threading.Barrier(len(fields))
+
+        def write(n, field):
+            contact = self.db.read(couch_models.Contact, 'u1-c0')[0]
+            setattr(contact, field, 'writer{n}'.format(n=n))
+            start.wait()
+            try:
+                self.db.update(contact, retries=100)
+            except blackbook.database.DatabaseError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(n, field)) for n, field in enumerate(fields)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        return self.db.db['u1-c0']
+
+    def test_writers(self):
+        for update_handler in (True, False):
+            with self.subTest(update_handler=update_handler):
+                self.db.update_handler = update_handler
+                rev = int(self.db.db['u1-c0']['_rev'].split('-')[0])
+                doc = self.write_all(['name_first', 'name_last'] * (self.writers // 2))
+
+                # every write went in, and none of them lost the other field's writes
+                self.assertEqual(int(doc['_rev'].split('-')[0]), rev + self.writers)
+                self.assertIn(doc['name_first'], ['writer{n}'.format(n=n) for n in range(0, self.writers, 2)])
+                self.assertIn(doc['name_last'], ['writer{n}'.format(n=n) for n in range(1, self.writers, 2)])
+
+    def test_retries_exhausted(self):
+        self.db.update_handler = False
+        contact = self.db.read(couch_models.Contact, 'u1-c0')[0]
+        contact.name_first = 'Mine'
+        self.db.db.save(dict(self.db.db['u1-c0'], name_last='Theirs'))
+        with self.assertRaises(blackbook.database.ConflictError):
+            self.db.update(contact, retries=0)
+
+        self.assertEqual(self.db.update(contact, retries=1).name_first, 'Mine')
+        self.assertEqual(self.db.db['u1-c0']['name_last'], 'Theirs')
+
+    def test_deleted(self):
+        contact = self.db.read(couch_models.Contact, 'u1-c0')[0]
+        contact.name_first = 'Mine'
+        self.db.db.delete(self.db.db['u1-c0'])
+        for update_handler in (True, False):
+            with self.subTest(update_handler=update_handler):
+                self.db.update_handler = update_handler
+                with self.assertRaises(blackbook.database.NotFoundError):
+                    self.db.update(contact)
+
+
+class UserListenersTestCase(CouchTestCase):
+
+    def setUp(self):
+        super(UserListenersTestCase, self).setUp()
+        self.db.db.update(user_docs('u1', contacts=2))
+        self.changed = []
+        self.db.user_listeners.append(self.changed.append)
+
+    def test_update_user(self):
+        user = self.db.read(couch_models.User, 'u1')[0]
+        user.permissions = ['blackbook']
+        self.db.update(user)
+        self.assertEqual(self.changed, ['u1'])
+
+    def test_update_other(self):
+        contact = self.db.read(couch_models.Contact, 'u1-c0')[0]
+        contact.name_first = 'Changed'
+        self.db.update(contact)
+        self.assertEqual(self.changed, [])
+
+    def test_delete_cascade_dereferences_user(self):
+        self.db.delete_cascade(self.db.read(couch_models.Contact, 'u1-c0')[0])
+        self.assertEqual(self.changed, ['u1'])
+        self.assertEqual(self.db.read(couch_models.User, 'u1')[0].contacts, ['u1-c1'])
+
+    def test_delete_cascade_user(self):
+        self.db.delete_cascade(self.db.read(couch_models.User, 'u1')[0])
+        self.assertEqual(self.changed, ['u1'])
+
+
+class PaginationTestCase(CouchTestCase):
+    """Views key contacts by their user, so pages split runs of equal keys."""
+
+    def setUp(self):
+        super(PaginationTestCase, self).setUp()
+        docs = user_docs('u1', contacts=7) + user_docs('u2', contacts=3)
+        for doc in docs[1:4]:
+            # cards with more rows than others, some spanning reads
+            email_ids = [doc['_id'] + '-e' + str(n) for n in range(3)]
+            doc['emails'] = email_ids
+            docs += [
+                {'_id': i, 'id': i, 'type': 'contactemail', 'contact': doc['_id'], 'address': i} for i in email_ids
+            ]
+        self.db.db.update(docs)
+
+    def walk(self, paginator):
+        """Page forward to the end, then back to the start, returning the ids of each page both ways."""
+        forward, page = [], paginator.page(self.db.db)
+        forward.append([item.doc_id for item in page.items])
+        while page.next_cursor is not None:
+            # a cursor that doesn't move past its own row pages forever
+            self.assertLess(len(forward), 20)
+            page = paginator.page(self.db.db, after=page.next_cursor)
+            forward.append([item.doc_id for item in page.items])
+        backward = [forward[-1]]
+        while page.prev_cursor is not None:
+            self.assertLess(len(backward), 20)
+            page = paginator.page(self.db.db, before=page.prev_cursor)
+            backward.insert(0, [item.doc_id for item in page.items])
+        return forward, backward
+
+    def assertPages(self, paginator, ids, per_page):
+        forward, backward = self.walk(paginator)
+        self.assertEqual(forward, [ids[n:n + per_page] for n in range(0, len(ids), per_page)])
+        self.assertEqual(backward, forward)
+
+    def test_keyset(self):
+        u1 = ['u1-c{n}'.format(n=n) for n in range(7)]
+        u2 = ['u2-c{n}'.format(n=n) for n in range(3)]
+        for key, ids in (('u1', u1), (None, u1 + u2)):
+            for per_page in (1, 3, 4, 7, 10):
+                with self.subTest(key=key, per_page=per_page):
+                    paginator = blackbook.database.couch.pagination.KeysetPaginator(
+                        couch_models.Contact.by_user, key=key, per_page=per_page
+                    )
+                    self.assertPages(paginator, ids, per_page)
+
+    def test_cards(self):
+        ids = ['u1-c{n}'.format(n=n) for n in range(7)]
+        for per_page in (1, 3, 4, 7):
+            for rows_per_item in (1, 4):
+                with self.subTest(per_page=per_page, rows_per_item=rows_per_item):
+                    paginator = blackbook.database.couch.pagination.CardPaginator(
+                        couch_models.Contact.cards_by_user, key='u1', per_page=per_page,
+                        types=self.db.type_map, rows_per_item=rows_per_item
+                    )
+                    self.assertPages(paginator, ids, per_page)
+                    page = paginator.page(self.db.db)
+                    self.assertEqual(
+                        sorted(page.owned), sorted(e for c in page.items for e in c.emails)
+                    )
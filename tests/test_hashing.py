@@ -0,0 +1,23 @@
+import unittest
+
+from blackbook.tools.hashing import PasswordHasher
+
+__author__ = 'ievans3024'
+
+
+class PasswordHasherTestCase(unittest.TestCase):
+
+    def test_pool_started_on_first_use(self):
+        hasher = PasswordHasher(workers=1)
+        self.addCleanup(hasher.shutdown)
+        self.assertIsNone(hasher._executor)
+
+        pwhash = hasher.generate_password_hash('secret')
+        self.assertIsNotNone(hasher._executor)
+        self.assertTrue(hasher.check_password_hash(pwhash, 'secret'))
+        self.assertFalse(hasher.check_password_hash(pwhash, 'guess'))
+
+        # started again after a shutdown
+        hasher.shutdown()
+        self.assertIsNone(hasher._executor)
+        self.assertTrue(hasher.check_password_hash(pwhash, 'secret'))
@@ -0,0 +1,172 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import blackbook.database
+
+from blackbook.database import models
+from blackbook.lib.search import InvertedIndex
+from tests import app
+from tests import CouchTestCase
+from tests import user_docs
+
+__author__ = 'ievans3024'
+
+
+class InvertedIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add('c1', [('Ada Lovelace', 3)], source='c1', scope='u1')
+        self.index.add('c1', [('ada@example.com', 2)], source='e1')
+        self.index.add('c2', [('Charles Babbage', 3)], source='c2', scope='u1')
+
+    def keys(self, query, **kwargs):
+        return [key for key, score in self.index.search(query, **kwargs)]
+
+    def test_discard(self):
+        self.index.discard('e1')
+        self.assertEqual(self.keys('example'), [])
+        self.assertEqual(self.keys('ada'), ['c1'])
+        self.index.discard('c1')
+        self.assertNotIn('c1', self.index)
+        self.assertEqual(self.keys('ada'), [])
+
+    def test_source_moved(self):
+        self.index.add('c2', [('ada@example.com', 2)], source='e1')
+        self.assertEqual(self.keys('example'), ['c2'])
+        self.index.discard('e1')
+        self.assertEqual(self.keys('example'), [])
+
+    def test_prefix(self):
+        self.assertEqual(self.keys('lovel'), ['c1'])
+        self.assertEqual(self.keys('ad'), ['c1'])
+        # too short to match by prefix
+        self.assertEqual(self.keys('a'), [])
+        self.index.add('c3', [('A', 1)], source='c3')
+        self.assertEqual(self.keys('a'), ['c3'])
+
+    def test_prefix_expansions(self):
+        self.index.max_prefix_expansions = 2
+        self.index.add('c3', [('Ada Adams', 3)], source='c3')
+        self.index.add('c4', [('Adb Adc', 3)], source='c4')
+        # the first two tokens starting with the term, ada and adams
+        self.assertEqual(sorted(self.keys('ad')), ['c1', 'c3'])
+        # and the term itself, if it is a token
+        self.index.add('c5', [('ad', 1)], source='c5')
+        self.assertEqual(sorted(self.keys('ad')), ['c1', 'c3', 'c5'])
+
+    def test_tokens_removed_and_added(self):
+        self.assertEqual(self.keys('babb'), ['c2'])
+        self.index.remove('c2')
+        self.assertEqual(self.keys('babb'), [])
+        self.index.add('c3', [('Babbage', 3)], source='c3')
+        # listed once, not once more for adding it back
+        self.assertEqual(self.index.search('babb'), [('c3', self.index.search('babbage')[0][1] * 0.5)])
+
+        for n in range(100):
+            self.index.add('n{n}'.format(n=n), [('token{n}'.format(n=n), 1)], source='n{n}'.format(n=n))
+        self.assertEqual(len(self.keys('token')), 100)
+        for n in range(100):
+            self.index.remove('n{n}'.format(n=n))
+        self.assertEqual(self.keys('token'), [])
+        self.assertEqual(self.keys('lovel'), ['c1'])
+
+    def test_save_load(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'index.json')
+        self.index.seq = 42
+        self.index.save(path)
+
+        loaded = InvertedIndex.load(path)
+        self.assertEqual(loaded.seq, 42)
+        self.assertEqual(loaded.search('ada', scope='u1'), self.index.search('ada', scope='u1'))
+        loaded.discard('e1')
+        self.assertEqual([key for key, score in loaded.search('example')], [])
+
+
+def contact_docs(contact_id, name_first, email):
+    doc, = [d for d in user_docs('u1') if d['type'] == 'contact']
+    email_id = contact_id + '-e'
+    return [
+        dict(doc, _id=contact_id, id=contact_id, name_first=name_first, emails=[email_id]),
+        {'_id': email_id, 'id': email_id, 'type': 'contactemail', 'contact': contact_id, 'address': email}
+    ]
+
+
+class SearchIndexerTestCase(CouchTestCase):
+
+    def setUp(self):
+        super(SearchIndexerTestCase, self).setUp()
+        self.db.search_index_poll_interval = 0.01
+        self.addCleanup(self.db.stop_search_indexer, 5)
+        self.db.db.update(
+            contact_docs('c1', 'Ada', 'ada@example.com') + contact_docs('c2', 'Adam', 'adam@example.com')
+        )
+
+    def search(self, db, query, **kwargs):
+        """Search once the indexer has built the index."""
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                return [contact.id for contact in db.search(query, model=models.Contact, **kwargs)]
+            except blackbook.database.DatabaseNotReadyError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+
+    def wait_for(self, db, query, expected):
+        deadline = time.monotonic() + 5
+        while self.search(db, query) != expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.search(db, query), expected)
+
+    def test_not_ready(self):
+        self.db.search_index_poll_interval = 60
+        self.db._read_changes = lambda since, limit: time.sleep(0.5) or {'results': [], 'last_seq': since}
+        with self.assertRaises(blackbook.database.DatabaseNotReadyError):
+            self.db.search('ada', model=models.Contact)
+
+    def test_limit(self):
+        self.assertEqual(self.search(self.db, 'ada'), ['c1', 'c2'])
+        self.assertEqual(self.search(self.db, 'ada', limit=1), ['c1'])
+
+    def test_writes_from_elsewhere(self):
+        self.assertEqual(self.search(self.db, 'ada'), ['c1', 'c2'])
+
+        # written without going through this database, e.g. by another process
+        self.db.db.update(contact_docs('c3', 'Ada', 'lovelace@example.com'))
+        self.wait_for(self.db, 'lovelace', ['c3'])
+
+        email = self.db.db['c3-e']
+        self.db.db.delete(email)
+        self.wait_for(self.db, 'lovelace', [])
+        self.assertEqual(self.search(self.db, 'ada'), ['c1', 'c3', 'c2'])
+
+    def test_catch_up_saved(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.db.search_index_path = os.path.join(directory, 'index.json')
+        self.assertEqual(self.search(self.db, 'ada'), ['c1', 'c2'])
+        self.db.stop_search_indexer(5)
+        self.assertTrue(os.path.exists(self.db.search_index_path))
+
+        self.db.db.update(contact_docs('c3', 'Ada', 'lovelace@example.com'))
+        app.config.update(SEARCH_INDEX_PATH=self.db.search_index_path, COUCHDB_NAME=self.db.dbname)
+        self.addCleanup(app.config.update, SEARCH_INDEX_PATH=None)
+        restarted = type(self.db)()
+        restarted.search_index_poll_interval = 0.01
+        self.addCleanup(restarted.stop_search_indexer, 5)
+        # saved at exit otherwise, after the directory is gone
+        self.addCleanup(setattr, restarted, 'search_index_path', None)
+
+        # searchable from the saved copy at once, caught up from its update sequence
+        self.assertEqual(restarted.search_index.seq, self.db.search_index.seq)
+        since = []
+        read_changes = restarted._read_changes
+        restarted._read_changes = lambda seq, limit: since.append(seq) or read_changes(seq, limit)
+        self.wait_for(restarted, 'lovelace', ['c3'])
+        self.assertEqual(since[0], self.db.search_index.seq)